@@ -26,9 +26,7 @@ bool AnythingSensor::begin()
 
     commInit();
 
-    dataInit();
-
-    return true;
+    return dataInit();
 }
 
 void AnythingSensor::spiInit()
@@ -134,7 +132,7 @@ void AnythingSensor::requestData()
     digitalWrite(signalPin, LOW);
 }
 
-void AnythingSensor::dataInit()
+bool AnythingSensor::dataInit()
 {
     requestData();
 
@@ -155,6 +153,17 @@ void AnythingSensor::dataInit()
     // buffer[2] - Unused
     // buffer[3] - Unused
 
+    // The compact and delta data types send messages of varying length and a status header,
+    // which this library can't parse yet. Refuse them instead of reading the stream out of
+    // step. The signal pin stays LOW, so the Coral never sends data.
+    if(buffer[0] != FLOAT32)
+    {
+        Serial.print("Unsupported data type ");
+        Serial.print(buffer[0]);
+        Serial.println(", only float32 is supported. Set \"spi_format\": \"float32\".");
+        return false;
+    }
+
     // Create a data array to store the data from the Anything Sensor
     dataLength = buffer[1];
     data = new float[dataLength];
@@ -172,13 +181,21 @@ void AnythingSensor::dataInit()
     // Re-enable SPI interrupt
     SPCR |= _BV(SPIE);
     Serial.println(dataLength);
+
+    return true;
 }
 
 bool AnythingSensor::read()
 {
+    // No data is sent after an unsupported config
+    if(data == nullptr)
+        return false;
+
     requestData();
 
     memcpy(data, buffer, bufferLength);
+
+    return true;
 }
 
 
@@ -186,6 +203,36 @@ void AnythingSensor::_isr()
 {
     switch(commState)
     {
+    case INIT:
+    {
+        // Answer every run of 0xFF start bytes with 0xFF, 0xFE, 0xFD, so the Coral can connect
+        // whenever the sketch is in INIT, not only right after boot. Any other byte, like a
+        // heartbeat the Coral sends before it notices a reset, starts the run over.
+        if(SPDR == 0xFF)
+            startBytes++;
+        else
+            startBytes = 0;
+
+        if(startBytes == 4)
+        {
+            AnythingSensor::buffer[0] = 0xFF;
+            AnythingSensor::buffer[1] = 0xFF;
+            AnythingSensor::buffer[2] = 0xFF;
+            AnythingSensor::buffer[3] = 0xFF;
+            AnythingSensor::dataAvailable = true;
+            pos = 0;
+            startBytes = 0;
+            commState = WAITING_FOR_HEADER;
+            SPDR = 0xFC;
+        }
+        else
+        {
+            SPDR = startBytes == 0 ? 0x00 : 0x100 - startBytes;
+        }
+
+        // The heartbeat counter only runs once the Coral is connected
+        return;
+    }
     case WAITING_FOR_HEADER:
     {
         byte header = SPDR;
@@ -218,7 +265,7 @@ void AnythingSensor::_isr()
 
         break;
     }
-    default: // This is used for the INIT, RECEIVING_CONFIG, or RECEIVING_MESSAGE states
+    default: // This is used for the RECEIVING_CONFIG or RECEIVING_MESSAGE states
     {
         AnythingSensor::buffer[pos] = SPDR;
 
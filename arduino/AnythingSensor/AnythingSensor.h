@@ -1,6 +1,14 @@
 #include "Arduino.h"
 //#include "AnythingSensorData.h"
 
+// Data types of the config message. Only FLOAT32 is supported.
+enum DataType
+{
+    FLOAT32 = 0,
+    COMPACT = 1,
+    DELTA = 2
+};
+
 enum SPIState
 {
     INIT,
@@ -25,13 +33,16 @@ class AnythingSensor
 
         volatile byte heartbeatCounter = 0xFF;
 
+        // Number of 0xFF start bytes in a row received in the INIT state
+        volatile byte startBytes = 0;
+
 
 
         // Stores the data after it is converted to floating point
-        float* data;
+        float* data = nullptr;
 
         // Stores the length of the buffer
-        int dataLength;
+        int dataLength = 0;
 
         // This is the pin that the Arduino will send a signal to the
         // coral board over.
@@ -43,7 +54,7 @@ class AnythingSensor
 
         void commInit();
 
-        void dataInit();
+        bool dataInit();
 
         void requestData();
 
@@ -7,9 +7,12 @@ object detection model.
 '''
 
 import argparse
+import os
 import time
 import subprocess
 import json
+import metrics
+import model_cache
 import pipeline_factory
 from flask import Flask, render_template, Response, request
 from flask_api import status
@@ -32,7 +35,25 @@ def update_config():
     global config
     global pipeline
 
-    config = request.get_json()["app_params"]
+    new_config = request.get_json()["app_params"]
+
+    # A running pipeline swaps the model and keeps its camera and streams. The reply waits for
+    # the swap, so a model that fails to load is reported and the old config stays. Any other
+    # change is refused until the app restarts.
+    if pipeline is not None:
+        try:
+            pipeline, swapped = factory.update_pipeline(new_config)
+        except pipeline_factory.RestartRequiredError as e:
+            return {"error": str(e), "restart_required": e.keys}, status.HTTP_409_CONFLICT
+        except ValueError as e:
+            return {"error": str(e)}, status.HTTP_400_BAD_REQUEST
+        except Exception as e:
+            return {"error": str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+        config = dict(config, engine=new_config.get("engine"))
+        return {"model_swap": swapped}
+
+    config = new_config
     pipeline = factory.create_pipeline(config)
     pipeline.start()
 
@@ -46,24 +67,34 @@ def index():
         return {}, status.HTTP_204_NO_CONTENT
 
 
-def gen(source):
-    while True:
-        frame = source.get_output_frame_bytes()
-        yield (b'--frame\r\n'
-                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-
-
-
 @app.route('/video_feed')
 def video_feed():
     global pipeline
 
     if(config["stream_flask"] == True):
-        return Response(gen(pipeline),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+        # Every client shares the frames encoded once by the pipeline's video stream
+        return Response(pipeline.video_stream.stream(),
+                        mimetype=pipeline.video_stream.MIMETYPE)
     else:
         return {}, status.HTTP_204_NO_CONTENT
 
+@app.route('/video_feed/<name>')
+def named_video_feed(name):
+    global pipeline
+
+    # Each model or camera has its own video stream when the pipeline runs several of them
+    video_streams = getattr(pipeline, "video_streams", {})
+    if(config["stream_flask"] == True and name in video_streams):
+        return Response(video_streams[name].stream(),
+                        mimetype=video_streams[name].MIMETYPE)
+    else:
+        return {}, status.HTTP_404_NOT_FOUND
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Everything is computed here, on scrape, so collection stays cheap between scrapes
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
@@ -80,6 +111,12 @@ if __name__ == "__main__":
 
     factory = pipeline_factory.get_instance("detection")
 
+    # Load the most recently used models while waiting for the config. The debug reloader runs
+    # this module in a watcher process too, which never serves and must not hold the Edge TPU.
+    factory.model_cache = model_cache.ModelCache(state_path=model_cache.DEFAULT_STATE_PATH)
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        factory.model_cache.prewarm_async(factory.load_inference_engine)
+
     pipeline = None
 
     app.run(host='0.0.0.0', debug=True)
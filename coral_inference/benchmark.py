@@ -0,0 +1,370 @@
+''' End-to-end pipeline benchmark that runs on any Linux machine.
+
+Builds the threaded Pipeline from a replay source and a SimulatedEngine, attaches synthetic SPI
+and HTTP consumers, and measures a fixed run after a warm-up. The results are written as JSON
+so runs on different commits can be compared:
+
+    python benchmark.py --duration 30 --latency 0.015 --output results.json
+
+Without --source, a short synthetic recording is written to a temporary directory and replayed
+in a loop.
+
+Classes:
+    SyntheticSPIConsumer: Reads the SPI bytes the way SPIComms does, without the hardware.
+    SyntheticHTTPClient: Reads the MJPEG stream like a video client.
+
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import camera
+import engine
+import metrics
+import mjpeg
+import pipeline
+import postprocessor
+import threaded_engine
+from tracing import tracer
+
+
+class SyntheticSPIConsumer(object):
+    ''' Reads the SPI bytes the way SPIComms does, without the hardware.
+
+    Attributes:
+        source: Postprocessor with a read_bytes() method.
+        interval (float): Pause between transfers in seconds, like the SPIComms poll loop.
+        messages (int): Number of messages read.
+        bytes_read (int): Number of bytes read.
+
+    '''
+
+    def __init__(self,
+                 source,
+                 interval=0.01):
+
+        self.source = source
+        self.interval = interval
+        self.messages = 0
+        self.bytes_read = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._thread, name="SyntheticSPIConsumer",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _thread(self):
+        last_frame_id = None
+        while not self.stopped.is_set():
+            data, trace = self.source.read_bytes()
+            self.messages += 1
+            self.bytes_read += len(data)
+
+            last_frame_id = tracer.count_drops("spi", last_frame_id, trace)
+            tracer.record_output("spi", trace)
+
+            time.sleep(self.interval)
+
+
+class SyntheticHTTPClient(object):
+    ''' Reads the MJPEG stream like a video client.
+
+    Attributes:
+        video_stream: MJPEGBroadcaster to read from.
+        frames (int): Number of chunks received.
+        bytes_read (int): Number of bytes received.
+
+    '''
+
+    def __init__(self,
+                 video_stream,
+                 index=0):
+
+        self.video_stream = video_stream
+        self.frames = 0
+        self.bytes_read = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._thread,
+                                       name="SyntheticHTTPClient-{}".format(index),
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _thread(self):
+        stream = self.video_stream.stream()
+        try:
+            for chunk in stream:
+                self.frames += 1
+                self.bytes_read += len(chunk)
+                if self.stopped.is_set():
+                    break
+        finally:
+            stream.close()
+
+
+def thread_cpu_times():
+    ''' Returns the user plus system CPU seconds used by each thread of this process.
+
+    Returns:
+        Dictionary of thread name to CPU seconds. Threads that share a name are added up.
+
+    '''
+
+    names = {thread.native_id: thread.name for thread in threading.enumerate()}
+    ticks = os.sysconf("SC_CLK_TCK")
+
+    times = {}
+    for task in os.listdir("/proc/self/task"):
+        try:
+            with open("/proc/self/task/{}/stat".format(task)) as stat:
+                # The thread name can contain spaces, so split after its closing parenthesis
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+
+        name = names.get(int(task), "native-{}".format(task))
+        times[name] = times.get(name, 0.0) + (int(fields[11]) + int(fields[12])) / ticks
+
+    return times
+
+
+def write_synthetic_recording(directory, count=30, resolution=(640, 480)):
+    ''' Writes a short recording of moving rectangles as PNG images.
+    '''
+
+    width, height = resolution
+    for i in range(count):
+        frame = np.full((height, width, 3), 32, dtype=np.uint8)
+        x = int(i * (width - 100) / count)
+        cv2.rectangle(frame, (x, height // 3), (x + 100, height // 3 + 100), (0, 200, 255), -1)
+        cv2.imwrite(os.path.join(directory, "{:04d}.png".format(i)), frame)
+
+
+def create_source(path, fps):
+    ''' Creates a looping replay source for a video file or an image directory.
+    '''
+
+    if os.path.isdir(path):
+        return camera.ImageDirectorySource(path, fps=fps, loop=True)
+
+    return camera.VideoFileSource(path, fps=fps, loop=True)
+
+
+def git_commit():
+    ''' Returns the commit of the working tree, if it is a git checkout.
+    '''
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(source,
+                  duration=30.0,
+                  warmup=5.0,
+                  latency=0.015,
+                  jitter=0.0,
+                  distribution="normal",
+                  detections=3,
+                  top_k=15,
+                  output_resolution="640x480",
+                  http_clients=1,
+                  spi_interval=0.01,
+                  seed=0):
+    ''' Runs the pipeline for a fixed time and measures it.
+
+    Args:
+        source: Replay source. It is stopped at the end of the run.
+        duration (float): Length of the measured run in seconds.
+        warmup (float): Time in seconds to run before measuring.
+        latency (float): Mean simulated inference latency in seconds.
+        jitter (float): Standard deviation of the simulated latency in seconds.
+        distribution (str): Latency distribution. See SimulatedEngine.
+        detections (int or tuple[int]): Number of simulated detections per frame.
+        top_k (int): The maximum number of detections.
+        output_resolution (str): Resolution of the video stream.
+        http_clients (int): Number of synthetic video clients.
+        spi_interval (float): Pause between synthetic SPI transfers in seconds. None disables
+            the SPI consumer.
+        seed (int, optional): Seed for the simulated engine.
+
+    Returns:
+        Dictionary with the configuration and results of the run.
+
+    '''
+
+    simulated_engine = engine.SimulatedEngine(latency=latency,
+                                              jitter=jitter,
+                                              distribution=distribution,
+                                              detections=detections,
+                                              top_k=top_k,
+                                              seed=seed)
+    inference = threaded_engine.ThreadedEngine(source, simulated_engine)
+    detection_postprocessor = postprocessor.DetectionPostProcessor(
+        inference, output_resolution=output_resolution)
+
+    video_stream = mjpeg.MJPEGBroadcaster(detection_postprocessor)
+    benchmark_pipeline = pipeline.Pipeline(source,
+                                           inference,
+                                           detection_postprocessor,
+                                           [video_stream],
+                                           video_stream)
+
+    clients = [SyntheticHTTPClient(video_stream, i) for i in range(http_clients)]
+    consumers = list(clients)
+    spi = None
+    if spi_interval is not None:
+        spi = SyntheticSPIConsumer(detection_postprocessor, spi_interval)
+        consumers.append(spi)
+
+    benchmark_pipeline.start()
+    for consumer in consumers:
+        consumer.start()
+
+    time.sleep(warmup)
+
+    # Measure only the steady state
+    tracer.reset()
+    start_captured = source.frames_captured.value
+    start_inferences = inference.inferences.value
+    start_http = sum(client.frames for client in clients)
+    start_spi = spi.messages if spi else 0
+    start_cpu = thread_cpu_times()
+    start_rss = metrics.resident_memory()
+    rss_samples = [start_rss]
+
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        time.sleep(min(1.0, duration))
+        rss_samples.append(metrics.resident_memory())
+    elapsed = time.monotonic() - start
+
+    end_cpu = thread_cpu_times()
+    captured = source.frames_captured.value - start_captured
+    inferences = inference.inferences.value - start_inferences
+    http_frames = sum(client.frames for client in clients) - start_http
+    spi_messages = spi.messages - start_spi if spi else None
+    stats = tracer.summary()
+
+    for consumer in consumers:
+        consumer.stop()
+    source.stop()
+    source.finished.wait(timeout=2)
+
+    results = {
+        "commit": git_commit(),
+        "config": {
+            "duration": duration,
+            "warmup": warmup,
+            "latency": latency,
+            "jitter": jitter,
+            "distribution": distribution,
+            "detections": detections,
+            "top_k": top_k,
+            "source_fps": source.fps,
+            "resolution": list(source.get_resolution()),
+            "output_resolution": output_resolution,
+            "http_clients": http_clients,
+            "spi_interval": spi_interval
+        },
+        "fps": {
+            "capture": captured / elapsed,
+            "inference": inferences / elapsed,
+            "http": http_frames / elapsed / max(http_clients, 1),
+            "spi": spi_messages / elapsed if spi else None
+        },
+        "latency": stats["latency"],
+        "dropped": stats["dropped"],
+        "cpu": {
+            "threads": {name: (seconds - start_cpu.get(name, 0.0)) / elapsed
+                        for name, seconds in sorted(end_cpu.items())},
+            "total": (sum(end_cpu.values()) - sum(start_cpu.values())) / elapsed
+        },
+        "memory": {
+            "rss_start_bytes": start_rss,
+            "rss_end_bytes": rss_samples[-1],
+            "rss_max_bytes": max(rss_samples),
+            "rss_growth_bytes": rss_samples[-1] - start_rss
+        }
+    }
+
+    return results
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--source',
+                        help='Video file or image directory to replay. Defaults to a synthetic ' +
+                        'recording')
+    parser.add_argument('--fps', type=float,
+                        help='Replay rate of the source. Defaults to as fast as possible')
+    parser.add_argument('-d', '--duration', type=float, default=30.0,
+                        help='Length of the measured run in seconds')
+    parser.add_argument('-w', '--warmup', type=float, default=5.0,
+                        help='Time to run before measuring in seconds')
+    parser.add_argument('-l', '--latency', type=float, default=0.015,
+                        help='Mean simulated inference latency in seconds')
+    parser.add_argument('-j', '--jitter', type=float, default=0.0,
+                        help='Standard deviation of the simulated latency in seconds')
+    parser.add_argument('--distribution', default="normal",
+                        choices=engine.SimulatedEngine.DISTRIBUTIONS,
+                        help='Simulated latency distribution')
+    parser.add_argument('--detections', type=int, nargs='+', default=[3],
+                        help='Detections per frame, or the smallest and largest number')
+    parser.add_argument('--http-clients', type=int, default=1,
+                        help='Number of synthetic video clients')
+    parser.add_argument('--no-spi', action='store_true',
+                        help='Run without the synthetic SPI consumer')
+    parser.add_argument('-o', '--output', help='Path of the JSON results. Defaults to stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.source
+        if path is None:
+            write_synthetic_recording(directory)
+            path = directory
+
+        detections = args.detections[0]
+        if len(args.detections) > 1:
+            detections = tuple(args.detections[:2])
+
+        results = run_benchmark(create_source(path, args.fps),
+                                duration=args.duration,
+                                warmup=args.warmup,
+                                latency=args.latency,
+                                jitter=args.jitter,
+                                distribution=args.distribution,
+                                detections=detections,
+                                http_clients=args.http_clients,
+                                spi_interval=None if args.no_spi else 0.01)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
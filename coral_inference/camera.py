@@ -8,33 +8,58 @@ OpenCVCamera class only has to implement the code to read an image using OpenCV.
 Classes:
     BaseCamera: Base class that handles threading, starting/stopping, and getting frames.
     OpenCVCamera: Streams video using OpenCV.
+    ReplaySource: Base class for sources that replay recorded frames.
+    VideoFileSource: Replays a video file.
+    ImageDirectorySource: Replays the images in a directory.
 
 '''
 
 import os
 import cv2
 from abc import abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import itertools
 import numpy as np
+import threading
 import time
 
+import metrics
+from frame_pool import FramePool
 from thread_manager import ThreadManager
+from tracing import FrameTrace, tracer
 
 
 class BaseCamera(object):
     ''' Base class for streaming video in a background thread.
 
-    This class continuously pulls new images in a thread. When a separate thread calls the 
-    get() function to retrieve a frame, the ThreadManager blocks until a new frame comes in
-    and then returns a frame to all listeners. This ensures that no duplicate frames are retreived.
+    This class continuously pulls new images in a thread. Every frame is published to the
+    ThreadManager's ring buffer. When a separate thread calls the get() function to retrieve a
+    frame, the ThreadManager blocks until there is a frame newer than the last one that thread
+    received. This ensures that no duplicate frames are retreived.
+
+    The streaming thread owns the frames it publishes. A published frame stays valid until HOLD
+    newer frames were published. Then it is handed back with release(), and sources that decode
+    into a FramePool decode into it again. Listeners that keep a frame longer, for example to
+    compare it with later frames, have to copy it. Callers that iterate over frames() directly
+    own the frames they get.
 
     Attributes:
         source (str): The file path of the video source.
             For example, this could be "/dev/video0". Run v4l2-ctl --list-devices to find your device.
         resolution (tuple[int]): Stores the camera resolution.
         frame (array[int]): Stores the current frame.
+        frame_id (int): ID of the next frame. Every frame is published with a FrameTrace that
+            holds its ID and capture time.
         thread_manager: A separate class that handles incoming requests for frames. 
+        frames_captured: Metrics counter of the frames read from the camera.
+        published (deque): Published frames that are still valid, oldest first.
 
     '''
+
+    # Frames in the ring buffer, plus a few that listeners still work on after they left it
+    HOLD = 8
+
     def __init__(self,
                  source,
                  resolution):
@@ -49,9 +74,19 @@ class BaseCamera(object):
         self.source = source
         self.resolution = resolution
         self.frame = None  # current frame is stored here by background thread
+        self.frame_id = 0
+        self.published = deque()
 
         self.thread_manager = ThreadManager(self)
 
+        # Each camera has its own counter, so every counter has a single writer
+        labels = {"source": str(source)}
+        self.frames_captured = metrics.registry.counter("frames_captured_total",
+                                                        "Frames captured by the camera.",
+                                                        labels=labels)
+        metrics.registry.rate("camera_fps", "Frames captured per second.", self.frames_captured,
+                              labels=labels)
+
     def __iter__(self):
         ''' Returns itself as an iterator.
 
@@ -78,7 +113,7 @@ class BaseCamera(object):
         ''' Continuously pulls new frames from the camera.
 
         An infinite generator is used to pull new frames. Once a new frame is pulled,
-        the thread manager is set, notifying all listeners and handing them the new frame.
+        it is published to the thread manager, which hands it to any listener asking for it.
         If there have been no listeners for 10 seconds, then the thread stops.
 
         '''
@@ -87,8 +122,19 @@ class BaseCamera(object):
         for frame in frames_iterator:
             self.frame = frame
 
-            # Send signal to listeners
-            self.thread_manager.set()
+            # Stamp the capture time as early as possible
+            trace = FrameTrace(self.frame_id)
+            self.frame_id += 1
+            self.frames_captured.inc()
+            tracer.record_capture(trace)
+
+            # Publish the frame to listeners
+            self.thread_manager.set((frame, trace))
+
+            # The oldest frame is no longer valid, so its buffer can be decoded into again
+            self.published.append(frame)
+            if len(self.published) > self.HOLD:
+                self.release(self.published.popleft())
 
             # if there haven't been any listeners asking for frames in
             # the last 10 seconds then stop the thread
@@ -109,8 +155,39 @@ class BaseCamera(object):
         ''' Waits for a new frame and returns it.
         '''
 
-        self.thread_manager.wait()
-        return self.frame
+        return self.read()[0]
+
+    def read(self, timeout=None):
+        ''' Waits for a new frame and returns it with its trace.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait.
+
+        Returns:
+            Tuple of (frame, FrameTrace), or None if the timeout expired.
+
+        '''
+
+        return self.thread_manager.wait(timeout)
+
+    def request(self):
+        ''' Tells the source that a frame will be read soon, without waiting for it.
+
+        Sources that produce every frame anyway ignore it.
+
+        '''
+
+        pass
+
+    def release(self, frame):
+        ''' Hands back a frame that nothing reads anymore.
+
+        Called by the streaming thread for every frame that is older than HOLD frames. Sources
+        that decode into a FramePool reuse its buffer. The others ignore it.
+
+        '''
+
+        pass
 
     def get_resolution(self):
         ''' Returns the camera resolution.
@@ -132,42 +209,212 @@ class BaseCamera(object):
         pass
 
 
-# TODO: Add a way to change the input camera resolution. This will reduce processing time.
 class OpenCVCamera(BaseCamera):
     ''' Streams video from a camera using OpenCV.
 
+    The capture thread grabs every frame, so the driver queue never holds old frames, but only
+    decodes (retrieves) a frame once a listener asks for a new one. Frames nobody asks for are
+    never decoded or copied, which saves most of the capture CPU when inference runs slower
+    than the camera. The frames are decoded into buffers from a FramePool, and the buffers of
+    frames older than HOLD frames are decoded into again. Grabbed frames that were not retrieved
+    still get a frame ID, so they show up as drops of the consumers.
+
+    The capture resolution, frame rate and pixel format can be requested from the driver with
+    negotiate(). The driver picks the closest mode it supports, so the granted settings are
+    read back and used from then on. While the capture thread runs, request_resolution()
+    changes the resolution between two grabs.
+
     Attributes:
         camera: The camera source object.
+        frame_pool: FramePool the frames are decoded into.
+        requested: Event set when a listener asks for a new frame.
+        pending_resolution (tuple[int]): Resolution the capture thread switches to before its
+            next grab, None if there is no change.
+        fps (float): Frame rate granted by the driver. 0 if the driver doesn't report it.
+        pixel_format (str): Pixel format granted by the driver, like "MJPG" or "YUYV".
 
     '''
 
+    PIXEL_FORMATS = ("MJPG", "YUYV")
+
     def __init__(self,
-                 source="/dev/video0"):
+                 source="/dev/video0",
+                 pool_size=4,
+                 resolution=None,
+                 fps=None,
+                 pixel_format=None):
         ''' Creates the camera source.
 
         Args:
             source (str): The file path of the video source. Defaults to the first video source 
                 (usually a laptop camera or the first usb webcam plugged in).
+            pool_size (int): Number of frame buffers kept for reuse.
+            resolution (tuple[int], optional): Capture (width, height). Defaults to the
+                driver's choice.
+            fps (float, optional): Capture frame rate. Defaults to the driver's choice.
+            pixel_format (str, optional): Pixel format, see PIXEL_FORMATS. MJPG allows higher
+                resolutions and frame rates over USB, YUYV needs no decoding.
+
+        Raises:
+            ValueError: The pixel format is not supported.
+
         '''
 
         self.camera = self.set_camera(source)
-
-        resolution = (self.camera.get(3), self.camera.get(4))
+        self.frame_pool = FramePool(pool_size)
+        self.requested = threading.Event()
+        self.pending_resolution = None
 
         super(OpenCVCamera, self).__init__(source,
-                                           resolution)
+                                           None)
+
+        self.negotiate(resolution, fps, pixel_format)
+
+    def negotiate(self, resolution=None, fps=None, pixel_format=None):
+        ''' Requests capture settings from the driver and reads back what it granted.
+
+        Must be called before the capture thread starts, use request_resolution() once it
+        runs. Settings that are None are left to the driver. A warning is printed for every
+        setting the driver did not grant.
+
+        Args:
+            resolution (tuple[int], optional): Capture (width, height).
+            fps (float, optional): Capture frame rate.
+            pixel_format (str, optional): Pixel format, see PIXEL_FORMATS.
+
+        Returns:
+            Dictionary of the granted "resolution", "fps" and "pixel_format".
+
+        Raises:
+            ValueError: The pixel format is not supported.
+
+        '''
+
+        if pixel_format is not None and pixel_format.upper() not in self.PIXEL_FORMATS:
+            raise ValueError("Pixel format not supported: {}".format(pixel_format))
+
+        # V4L2 picks the frame sizes of the pixel format, and the frame rates of the size
+        if pixel_format is not None:
+            self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*pixel_format.upper()))
+        if resolution is not None:
+            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        if fps is not None:
+            self.camera.set(cv2.CAP_PROP_FPS, fps)
+
+        self.resolution = (int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.fps = self.camera.get(cv2.CAP_PROP_FPS)
+        fourcc = int(self.camera.get(cv2.CAP_PROP_FOURCC))
+        self.pixel_format = "".join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4))
+
+        granted = {"resolution": self.resolution,
+                   "fps": self.fps,
+                   "pixel_format": self.pixel_format}
+        requested = {"resolution": tuple(resolution) if resolution is not None else None,
+                     "fps": fps,
+                     "pixel_format": pixel_format.upper() if pixel_format is not None else None}
+        for name, value in requested.items():
+            if value is not None and value != granted[name]:
+                print("Camera {} granted {} {} instead of {}".format(self.source, name,
+                                                                     granted[name], value))
+
+        return granted
+
+    def request_resolution(self, resolution):
+        ''' Changes the capture resolution while the capture thread runs.
+
+        The capture thread negotiates the resolution before its next grab, so the frames keep
+        coming from a single thread. Before the thread starts, the resolution is negotiated
+        right away.
+
+        Args:
+            resolution (tuple[int]): Capture (width, height).
+
+        '''
+
+        if self.thread_manager.thread is None or not self.thread_manager.thread.is_alive():
+            self.negotiate(resolution=resolution)
+        else:
+            self.pending_resolution = tuple(resolution)
+
+    def read(self, timeout=None):
+        ''' Asks the capture thread for a new frame and waits for it.
+
+        A read with a timeout of 0 only checks for a frame that is already there. It doesn't ask
+        for a new one, see request().
+
+        '''
+
+        if timeout != 0:
+            self.requested.set()
+
+        return super(OpenCVCamera, self).read(timeout)
+
+    def request(self):
+        ''' Asks the capture thread to decode its next frame.
+        '''
+
+        self.requested.set()
+
+    def release(self, frame):
+        self.frame_pool.release(frame)
 
     def frames(self):
-        ''' Continuously yields new frames.
+        ''' Grabs frames continuously and yields the ones listeners asked for.
+
+        Callers that iterate over frames() directly, instead of the streaming thread, get every
+        grabbed frame.
+
         '''
 
-        while True:
+        width, height = self.resolution
+        shape = (int(height), int(width), 3)
+        streaming = threading.current_thread() is self.thread_manager.thread
 
-            # read current frame
-            _, frame = self.camera.read()
+        while True:
+            if self.pending_resolution is not None:
+                resolution, self.pending_resolution = self.pending_resolution, None
+                width, height = self.negotiate(resolution=resolution)["resolution"]
+                shape = (int(height), int(width), 3)
+
+            if not self.camera.grab():
+                # The camera is not delivering frames, don't spin on it
+                time.sleep(0.01)
+                continue
+
+            if streaming and not self.requested.is_set():
+                self.skip_frame()
+
+                # Nobody asks for frames, so the inactivity check of _thread can't run
+                if self.thread_manager.time_lapsed() > 10:
+                    print('Stopping camera thread due to inactivity.')
+                    return
+                continue
+
+            self.requested.clear()
+
+            # Decode into a free pool buffer. OpenCV allocates a new frame if the size changed.
+            buffer = self.frame_pool.acquire(shape)
+            retrieved, frame = self.camera.retrieve(buffer)
+            if not retrieved or frame is not buffer:
+                self.frame_pool.release(buffer)
+            if not retrieved:
+                self.requested.set()
+                continue
+            shape = frame.shape
 
             yield frame
 
+    def skip_frame(self):
+        ''' Counts a grabbed frame that is not retrieved.
+        '''
+
+        trace = FrameTrace(self.frame_id)
+        self.frame_id += 1
+        self.frames_captured.inc()
+        tracer.record_capture(trace)
+
     def set_camera(self, source):
         ''' Sets the OpenCV video source.
 
@@ -196,4 +443,343 @@ class OpenCVCamera(BaseCamera):
         if not camera.isOpened():
             raise RuntimeError('Could not start camera.')
 
-        return camera
\ No newline at end of file
+        # Keep a single frame in the driver, so a grab always gets the newest one
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        return camera
+
+
+class ReplaySource(BaseCamera):
+    ''' Base class for sources that replay recorded frames.
+
+    Frames are decoded ahead of time by a small thread pool into buffers from a FramePool, so
+    decoding overlaps with the rest of the pipeline. Buffers handed back with release() are
+    decoded into again instead of allocating new arrays. Frames are replayed either as fast as
+    possible or at a fixed rate. Every frame is published in order and its frame ID is its
+    position in the recording (counted across loops).
+
+    Child classes implement tasks() and decode().
+
+    Attributes:
+        fps (float): Replay rate in frames per second. None replays as fast as possible.
+        loop (bool): Starts over after the last frame instead of stopping.
+        lockstep (bool): Publishes the next frame only after a listener has read the previous
+            one, so the first pipeline stage sees every frame exactly once.
+        workers (int): Number of decoding threads.
+        prefetch (int): Number of frames decoded ahead.
+        frame_pool: FramePool the frames are decoded into.
+        consumed: Event set whenever a listener reads a frame.
+        stopped: Event set by stop() to end the replay early.
+        finished: Event set once the replay is over, either after the last frame or after
+            stop().
+
+    '''
+
+    def __init__(self,
+                 source,
+                 resolution,
+                 fps=None,
+                 loop=False,
+                 lockstep=False,
+                 workers=1,
+                 prefetch=4,
+                 pool_size=16):
+        ''' Sets the replay options.
+
+        Args:
+            source (str): Path of the recording.
+            resolution (tuple[int]): Resolution of the frames.
+            fps (float, optional): Replay rate. Defaults to as fast as possible.
+            loop (bool): Starts over after the last frame.
+            lockstep (bool): Waits for a listener to read each frame before publishing the next.
+            workers (int): Number of decoding threads.
+            prefetch (int): Number of frames decoded ahead.
+            pool_size (int): Number of frame buffers kept for reuse.
+
+        Raises:
+            ValueError: fps is not positive.
+
+        '''
+
+        if fps is not None and fps <= 0:
+            raise ValueError("fps must be positive. Use None to replay as fast as possible.")
+
+        self.fps = fps
+        self.loop = loop
+        self.lockstep = lockstep
+        self.workers = workers
+        self.prefetch = max(prefetch, workers)
+        self.frame_pool = FramePool(pool_size)
+
+        self.consumed = threading.Event()
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+
+        super(ReplaySource, self).__init__(source,
+                                           resolution)
+
+    def read(self, timeout=None):
+        ''' Waits for a new frame and returns it with its trace.
+        '''
+
+        data = super(ReplaySource, self).read(timeout)
+        if data is not None:
+            self.consumed.set()
+
+        return data
+
+    def release(self, frame):
+        self.frame_pool.release(frame)
+
+    def stop(self):
+        ''' Ends the replay after the current frame.
+        '''
+
+        self.stopped.set()
+
+        # Release the streaming thread if it is waiting in lockstep
+        self.consumed.set()
+
+    def frames(self):
+        ''' Yields the frames of the recording at the replay rate.
+        '''
+
+        interval = 1.0 / self.fps if self.fps else 0
+        next_time = time.monotonic()
+
+        # Only hold frames back for listeners of the streaming thread. Callers that iterate over
+        # frames() directly already pull at their own pace.
+        streaming = threading.current_thread() is self.thread_manager.thread
+        self.consumed.set()
+
+        frames = self.prefetched()
+        for frame in frames:
+            if self.stopped.is_set():
+                break
+
+            if interval:
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Behind schedule, don't burst to catch up
+                    next_time = time.monotonic()
+                next_time += interval
+
+            if self.lockstep and streaming:
+                self.consumed.wait()
+                self.consumed.clear()
+
+            if self.stopped.is_set():
+                break
+
+            yield frame
+
+        # Wait for the workers before reporting that the replay is over
+        frames.close()
+        self.finished.set()
+
+    def prefetched(self):
+        ''' Yields the decoded frames in order while the workers decode the next ones.
+        '''
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="ReplayDecoder") as executor:
+            pending = deque()
+            tasks = iter(self.tasks())
+
+            while True:
+                while len(pending) < self.prefetch:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    pending.append(executor.submit(self.decode, task))
+
+                if not pending:
+                    if not self.loop:
+                        return
+                    tasks = iter(self.tasks())
+                    continue
+
+                try:
+                    frame = pending.popleft().result()
+                except EOFError:
+                    # The rest of this pass is past the end of the recording too
+                    for future in pending:
+                        future.cancel()
+                    wait(pending)
+                    for future in pending:
+                        if not future.cancelled() and future.exception() is None:
+                            self.frame_pool.release(future.result())
+                    pending.clear()
+                    tasks = iter(())
+                    continue
+
+                if frame is not None:
+                    yield frame
+
+    @abstractmethod
+    def tasks(self):
+        ''' Returns the decode tasks of one pass through the recording, in order.
+
+        Called again at the start of every loop, after all tasks of the previous pass are done.
+
+        '''
+
+        pass
+
+    @abstractmethod
+    def decode(self, task):
+        ''' Decodes the frame of one task into a buffer from the frame pool.
+
+        Returns:
+            The frame, or None to skip the task.
+
+        Raises:
+            EOFError: The task is past the end of the recording.
+
+        '''
+
+        pass
+
+
+class VideoFileSource(ReplaySource):
+    ''' Replays a video file.
+
+    Video decoding is sequential, so a single worker decodes ahead of the pipeline.
+
+    Attributes:
+        capture: The OpenCV video capture.
+        file_fps (float): Frame rate stored in the file. 0 if unknown.
+
+    '''
+
+    def __init__(self,
+                 source,
+                 fps=None,
+                 loop=False,
+                 lockstep=False,
+                 prefetch=4,
+                 pool_size=16):
+        ''' Opens the video file.
+
+        Args:
+            source (str): Path of the video file.
+            fps (float, optional): Replay rate. Defaults to as fast as possible.
+            loop (bool): Starts over after the last frame.
+            lockstep (bool): Waits for a listener to read each frame before publishing the next.
+            prefetch (int): Number of frames decoded ahead.
+            pool_size (int): Number of frame buffers kept for reuse.
+
+        Raises:
+            RuntimeError: Cannot open the video file.
+
+        '''
+
+        self.capture = cv2.VideoCapture(source)
+
+        if not self.capture.isOpened():
+            raise RuntimeError("Could not open video file {}.".format(source))
+
+        self.file_fps = self.capture.get(cv2.CAP_PROP_FPS)
+        resolution = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                      int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+        super(VideoFileSource, self).__init__(source,
+                                              resolution,
+                                              fps=fps,
+                                              loop=loop,
+                                              lockstep=lockstep,
+                                              workers=1,
+                                              prefetch=prefetch,
+                                              pool_size=pool_size)
+
+    def tasks(self):
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+        # The frame count stored in a file is only an estimate, so read until the end instead
+        return itertools.count()
+
+    def decode(self, task):
+        width, height = self.resolution
+        buffer = self.frame_pool.acquire((height, width, 3))
+
+        ok, frame = self.capture.read(buffer)
+        if not ok or frame is not buffer:
+            self.frame_pool.release(buffer)
+        if not ok:
+            raise EOFError()
+
+        return frame
+
+
+class ImageDirectorySource(ReplaySource):
+    ''' Replays the images in a directory in file name order.
+
+    OpenCV can't decode into an existing array, so each image is copied into a pooled buffer and
+    the decoded array is freed right away. Images are decoded by several workers in parallel.
+
+    Attributes:
+        paths (list[str]): Paths of the images.
+
+    '''
+
+    EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+    def __init__(self,
+                 source,
+                 fps=None,
+                 loop=False,
+                 lockstep=False,
+                 workers=2,
+                 prefetch=4,
+                 pool_size=16):
+        ''' Lists the images in the directory.
+
+        Args:
+            source (str): Path of the image directory.
+            fps (float, optional): Replay rate. Defaults to as fast as possible.
+            loop (bool): Starts over after the last image.
+            lockstep (bool): Waits for a listener to read each frame before publishing the next.
+            workers (int): Number of decoding threads.
+            prefetch (int): Number of frames decoded ahead.
+            pool_size (int): Number of frame buffers kept for reuse.
+
+        Raises:
+            RuntimeError: The directory has no images.
+
+        '''
+
+        self.paths = sorted(os.path.join(source, name) for name in os.listdir(source)
+                            if name.lower().endswith(self.EXTENSIONS))
+
+        if not self.paths:
+            raise RuntimeError("No images found in {}.".format(source))
+
+        first = cv2.imread(self.paths[0])
+        if first is None:
+            raise RuntimeError("Could not read image {}.".format(self.paths[0]))
+
+        resolution = (first.shape[1], first.shape[0])
+
+        super(ImageDirectorySource, self).__init__(source,
+                                                   resolution,
+                                                   fps=fps,
+                                                   loop=loop,
+                                                   lockstep=lockstep,
+                                                   workers=workers,
+                                                   prefetch=prefetch,
+                                                   pool_size=pool_size)
+
+    def tasks(self):
+        return self.paths
+
+    def decode(self, path):
+        image = cv2.imread(path)
+        if image is None:
+            print("Skipping unreadable image {}.".format(path))
+            return None
+
+        frame = self.frame_pool.acquire(image.shape)
+        np.copyto(frame, image)
+
+        return frame
@@ -0,0 +1,348 @@
+''' Runs several cameras through one shared engine.
+
+The CameraScheduler reads the newest frame of every camera and runs one frame at a time through
+a single engine, so the cameras share the Edge TPU instead of competing for it. When more frames
+are waiting than the engine can run, the scheduling mode picks the next one:
+
+    fair_share: Each camera gets a share of the inferences in proportion to its weight. A camera
+        with weight 2 is run twice as often as a camera with weight 1 while both have frames
+        waiting. A camera that was idle does not build up credit, so it can't take over the
+        engine when it comes back.
+    deadline: Each camera has a deadline, the longest time in seconds its frames should wait
+        after capture. The frame with the earliest deadline runs first.
+
+Only the newest frame of every camera is kept, so an overloaded engine lowers the inference rate
+of every camera in proportion to its weight and no camera is starved. Frames that are replaced
+before they run are counted as drops of the "engine_<source id>" consumer.
+
+With max_batch_size above 1, the frames waiting when the engine becomes free are run together
+with the engine's invoke_batch(), up to max_batch_size of them in scheduling order. A batch that
+isn't full waits up to max_wait seconds for frames of the other cameras. max_wait is 0 by
+default, so a batch costs no latency over running its first frame alone.
+
+The results of every camera are published to their own CameraOutput, tagged with the source ID.
+A CameraOutput has the same interface as a ThreadedEngine, so every camera gets its own
+postprocessor and streams.
+
+Classes:
+    CameraOutput: The results of one camera, with the interface of a ThreadedEngine.
+    CameraScheduler: Schedules the frames of several cameras on one engine.
+
+'''
+
+import time
+
+import metrics
+from thread_manager import ThreadManager
+from tracing import tracer
+
+
+class CameraOutput(object):
+    ''' The results of one camera, with the interface of a ThreadedEngine.
+
+    Results are published by the scheduler thread, so the output has no thread of its own.
+
+    Attributes:
+        source_id (str): ID of the camera.
+        engine: The shared inference engine.
+        thread_manager: Hands the newest (prediction, frame, trace) to the listeners.
+        inferences: Metrics counter of the frames of the camera run through the engine.
+
+    '''
+
+    def __init__(self,
+                 source_id,
+                 engine):
+
+        self.source_id = source_id
+        self.engine = engine
+        self.thread_manager = ThreadManager(self)
+        self.pred = None
+
+        self.inferences = metrics.registry.counter("inferences_total",
+                                                   "Frames run through the inference engine.",
+                                                   labels={"source": source_id})
+        metrics.registry.rate("inference_fps", "Inferences per second.", self.inferences,
+                              labels={"source": source_id})
+
+    def __next__(self):
+        return self.get_prediction()
+
+    def _thread(self):
+        ''' Never started. The scheduler thread publishes the results.
+        '''
+
+        pass
+
+    def publish(self, pred, frame, trace):
+        ''' Publishes the result of a frame of the camera.
+        '''
+
+        self.pred = pred
+        self.inferences.inc()
+        self.thread_manager.set((pred, frame, trace))
+
+    def get_prediction(self):
+        return self.thread_manager.wait()
+
+    def get_max_length(self):
+        return self.engine.get_max_length()
+
+    def label(self, label_id):
+        return self.engine.label(label_id)
+
+    def start(self):
+        ''' Does nothing. The results come from the scheduler thread.
+        '''
+
+        pass
+
+
+class CameraScheduler(object):
+    ''' Schedules the frames of several cameras on one engine.
+
+    The first camera is the primary camera. Iterating over the scheduler yields the primary
+    camera's results, like a ThreadedEngine does.
+
+    Attributes:
+        sources (dict): Image source of each camera, in camera order.
+        engine: The shared inference engine.
+        outputs (dict): CameraOutput of each camera.
+        mode (str): Scheduling mode. See MODES.
+        weights (dict): Share of the inferences of each camera, for the "fair_share" mode.
+        deadlines (dict): Longest wait in seconds of the frames of each camera, for the
+            "deadline" mode.
+        pending (dict): Newest frame and trace of each camera that is waiting to run.
+        max_batch_size (int): Most frames run through the engine in one call.
+        max_wait (float): Longest time in seconds a batch that isn't full waits for more frames.
+        thread_manager: Manages the scheduling thread.
+
+    '''
+
+    MODES = ("fair_share", "deadline")
+
+    def __init__(self,
+                 sources,
+                 engine,
+                 mode="fair_share",
+                 weights=None,
+                 deadlines=None,
+                 poll_interval=0.005,
+                 max_batch_size=1,
+                 max_wait=0.0):
+        ''' Creates an output for every camera.
+
+        Args:
+            sources (dict): Image source of each camera ID. The first is the primary.
+            engine: The shared inference engine.
+            mode (str): Scheduling mode. See MODES.
+            weights (dict, optional): Weight of each camera. Defaults to 1.
+            deadlines (dict, optional): Deadline of each camera in seconds. Defaults to 0.1.
+            poll_interval (float): Longest time in seconds to wait on one camera while no
+                camera has a new frame.
+            max_batch_size (int): Most frames run through the engine in one call. The engine
+                must implement invoke_batch() when it is above 1.
+            max_wait (float): Longest time in seconds a batch that isn't full waits for frames
+                of the other cameras after its first frame.
+
+        Raises:
+            ValueError: The mode or its settings are not valid.
+
+        '''
+
+        if mode not in self.MODES:
+            raise ValueError("Camera scheduler mode not supported: {}".format(mode))
+
+        if not sources:
+            raise ValueError("The camera scheduler needs at least one source.")
+
+        self.sources = dict(sources)
+        self.engine = engine
+        self.ids = list(self.sources)
+        self.outputs = {source_id: CameraOutput(source_id, engine) for source_id in self.ids}
+        self.mode = mode
+        self.weights = {source_id: (weights or {}).get(source_id, 1.0) for source_id in self.ids}
+        self.deadlines = {source_id: (deadlines or {}).get(source_id, 0.1)
+                          for source_id in self.ids}
+        self.poll_interval = poll_interval
+
+        if any(weight <= 0 for weight in self.weights.values()):
+            raise ValueError("Camera weights must be greater than 0.")
+
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.max_batch_size = max_batch_size
+
+        if max_wait < 0:
+            raise ValueError("max_wait must not be negative.")
+        self.max_wait = max_wait
+
+        self.pending = {}
+        self.last_frame_ids = {source_id: None for source_id in self.ids}
+
+        # Virtual time of every camera. The camera with the lowest virtual time runs next and
+        # its virtual time grows by 1 / weight every time it runs. The system time is the
+        # virtual time of the last camera that ran.
+        self.virtual_time = {source_id: 0.0 for source_id in self.ids}
+        self.system_time = 0.0
+        self.turn = 0
+
+        self.thread_manager = ThreadManager(self)
+
+    def __next__(self):
+        return self.get_prediction()
+
+    def primary(self):
+        return self.outputs[self.ids[0]]
+
+    def _thread(self):
+        while True:
+            batch = self.next_batch()
+            for _, _, trace in batch:
+                trace.stamp("engine_queue")
+
+            if len(batch) == 1:
+                preds = [self.engine.invoke(batch[0][1])]
+            else:
+                preds = self.engine.invoke_batch([frame for _, frame, _ in batch])
+
+            for (source_id, frame, trace), pred in zip(batch, preds):
+                trace.stamp("inference")
+                self.outputs[source_id].publish(pred, frame, trace)
+
+    def poll(self, timeout=0, exclude=()):
+        ''' Collects the new frames of every camera.
+
+        If no camera outside exclude has a frame waiting, waits up to timeout seconds on those
+        cameras in turn. Only cameras without a waiting frame are asked for a new one, so
+        cameras that skip the frames nobody asked for don't decode frames that would be replaced
+        before they run.
+
+        '''
+
+        for source_id, source in self.sources.items():
+            if source_id not in self.pending:
+                request = getattr(source, "request", None)
+                if request is not None:
+                    request()
+
+            data = source.read(timeout=0)
+            if data is not None:
+                self.add(source_id, *data)
+
+        if self.pick(exclude) is not None or not timeout:
+            return
+
+        waiting = [source_id for source_id in self.ids if source_id not in exclude]
+        source_id = waiting[self.turn % len(waiting)]
+        self.turn += 1
+
+        data = self.sources[source_id].read(timeout=timeout)
+        if data is not None:
+            self.add(source_id, *data)
+
+    def add(self, source_id, frame, trace):
+        ''' Makes a frame the newest waiting frame of its camera.
+
+        A camera that had nothing waiting catches up to the virtual time of the last frame that
+        ran, so idle time doesn't turn into credit.
+
+        '''
+
+        if source_id not in self.pending:
+            self.virtual_time[source_id] = max(self.virtual_time[source_id], self.system_time)
+
+        trace.source_id = source_id
+        self.pending[source_id] = (frame, trace)
+
+    def pick(self, exclude=()):
+        ''' Returns the ID of the waiting camera that runs next, or None if no camera outside
+        exclude has a frame waiting.
+        '''
+
+        waiting = [source_id for source_id in self.pending if source_id not in exclude]
+        if not waiting:
+            return None
+
+        if self.mode == "fair_share":
+            return min(waiting, key=lambda source_id: (self.virtual_time[source_id],
+                                                       self.ids.index(source_id)))
+
+        return min(waiting, key=lambda source_id: (self.pending[source_id][1].times[0] +
+                                                   self.deadlines[source_id]))
+
+    def next_frame(self):
+        ''' Waits for the next frame to run.
+
+        Returns:
+            Tuple of (source ID, frame, FrameTrace).
+
+        '''
+
+        self.poll()
+        while not self.pending:
+            self.poll(self.poll_interval)
+
+        return self.take(self.pick())
+
+    def next_batch(self):
+        ''' Waits for the next frame to run and adds the other waiting frames, in scheduling
+        order, up to max_batch_size frames.
+
+        If the batch isn't full, waits up to max_wait seconds for frames of the cameras that
+        are not in the batch yet. Every camera has at most one frame in a batch.
+
+        Returns:
+            List of (source ID, frame, FrameTrace).
+
+        '''
+
+        batch = [self.next_frame()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            batched = [source_id for source_id, _, _ in batch]
+            source_id = self.pick(exclude=batched)
+            if source_id is not None:
+                batch.append(self.take(source_id))
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or len(batched) == len(self.ids):
+                break
+            self.poll(min(remaining, self.poll_interval), exclude=batched)
+
+        return batch
+
+    def take(self, source_id):
+        ''' Removes the waiting frame of a camera and charges the camera for running it.
+
+        Returns:
+            Tuple of (source ID, frame, FrameTrace).
+
+        '''
+
+        frame, trace = self.pending.pop(source_id)
+
+        self.system_time = self.virtual_time[source_id]
+        self.virtual_time[source_id] += 1.0 / self.weights[source_id]
+        self.last_frame_ids[source_id] = tracer.count_drops("engine_{}".format(source_id),
+                                                            self.last_frame_ids[source_id],
+                                                            trace)
+
+        return source_id, frame, trace
+
+    def get_prediction(self):
+        ''' Returns the newest (prediction, frame, trace) of the primary camera.
+        '''
+
+        return self.primary().get_prediction()
+
+    def get_max_length(self):
+        return self.engine.get_max_length()
+
+    def label(self, label_id):
+        return self.engine.label(label_id)
+
+    def start(self):
+        self.thread_manager.start()
@@ -0,0 +1,188 @@
+''' Fixed-capacity detection results stored in a NumPy structured array.
+
+Detections are produced once by the engine and then used unchanged by every later stage. Label
+filtering is done with a precomputed boolean class mask, boxes are scaled with one broadcast
+multiply, and the SPI payload is the raw bytes of the array.
+
+Every field is a float32, so the records can also be viewed as a (capacity, 6) float32 array.
+Slots past the detection count are always zero.
+
+Track IDs are kept in a separate array next to the records, so the record layout (and the SPI
+payload) stays the same whether or not a tracker is used.
+
+Classes:
+    Detections: Fixed-capacity array of detection records plus a count.
+
+'''
+
+import numpy as np
+
+
+DETECTION_DTYPE = np.dtype([("label_id", np.float32),
+                            ("score", np.float32),
+                            ("x0", np.float32),
+                            ("y0", np.float32),
+                            ("x1", np.float32),
+                            ("y1", np.float32)])
+
+# Number of float32 values per detection record
+FIELDS = len(DETECTION_DTYPE.names)
+
+
+def make_class_mask(labels):
+    ''' Creates a boolean mask that is True for every label ID in the labels.
+
+    Args:
+        labels (dict, optional): Mapping between label IDs and labels.
+
+    Returns:
+        Boolean array indexed by label ID, or None if there are no labels.
+
+    '''
+
+    if not labels:
+        return None
+
+    mask = np.zeros(max(labels) + 1, dtype=bool)
+    mask[list(labels)] = True
+
+    return mask
+
+
+class Detections(object):
+    ''' Fixed-capacity array of detection records plus a count.
+
+    Attributes:
+        records: Structured array of DETECTION_DTYPE with one slot per possible detection.
+        count (int): Number of valid detections at the start of records.
+        track_ids (array[int]): Track ID of each record. -1 if the record is not tracked.
+
+    '''
+
+    def __init__(self,
+                 capacity):
+        ''' Allocates the records.
+
+        Args:
+            capacity (int): The maximum number of detections.
+
+        '''
+
+        self.records = np.zeros(capacity, dtype=DETECTION_DTYPE)
+        self.count = 0
+        self.track_ids = np.full(capacity, -1, dtype=np.int32)
+
+    @classmethod
+    def from_ssd(cls, capacity, boxes, classes, scores, count, threshold=0.0, class_mask=None):
+        ''' Creates detections from the outputs of an SSD detection postprocess op.
+
+        Args:
+            capacity (int): The maximum number of detections to keep.
+            boxes (array[float]): (N, 4) boxes as (ymin, xmin, ymax, xmax) from 0-1.
+            classes (array[float]): (N,) label IDs.
+            scores (array[float]): (N,) confidence scores, sorted from high to low.
+            count (int): Number of valid outputs.
+            threshold (float): The minimum confidence score to keep.
+            class_mask (array[bool], optional): Only keep label IDs that are True in the mask.
+
+        Returns:
+            Detections with the best candidates that pass the threshold and mask.
+
+        '''
+
+        count = int(count)
+        boxes = boxes[:count]
+        classes = classes[:count]
+        scores = scores[:count]
+
+        keep = scores >= threshold
+        if class_mask is not None:
+            ids = classes.astype(np.intp)
+            in_range = (ids >= 0) & (ids < len(class_mask))
+            keep &= in_range & class_mask[np.where(in_range, ids, 0)]
+
+        index = np.flatnonzero(keep)[:capacity]
+
+        detections = cls(capacity)
+        n = len(index)
+        records = detections.records[:n]
+        records["label_id"] = classes[index]
+        records["score"] = scores[index]
+        records["x0"] = boxes[index, 1]
+        records["y0"] = boxes[index, 0]
+        records["x1"] = boxes[index, 3]
+        records["y1"] = boxes[index, 2]
+        detections.count = n
+
+        np.clip(detections.boxes(), 0.0, 1.0, out=detections.boxes())
+
+        return detections
+
+    def __len__(self):
+        return self.count
+
+    def valid(self):
+        ''' Returns a view of the valid records.
+        '''
+
+        return self.records[:self.count]
+
+    def label_ids(self):
+        ''' Returns the label IDs of the valid records as integers.
+        '''
+
+        return self.records["label_id"][:self.count].astype(int)
+
+    def scores(self):
+        ''' Returns a view of the scores of the valid records.
+        '''
+
+        return self.records["score"][:self.count]
+
+    def boxes(self):
+        ''' Returns a (count, 4) float32 view of the (x0, y0, x1, y1) boxes of the valid records.
+        '''
+
+        return self.records.view(np.float32).reshape(-1, FIELDS)[:self.count, 2:]
+
+    def scaled_boxes(self, resolution):
+        ''' Scales the relative boxes to a resolution with one broadcast multiply.
+
+        Args:
+            resolution (tuple[int]): (width, height) to scale to.
+
+        Returns:
+            (count, 4) integer array of (x0, y0, x1, y1) boxes.
+
+        '''
+
+        width, height = resolution
+        return (self.boxes() * np.array([width, height, width, height],
+                                        dtype=np.float32)).astype(int)
+
+    def keep(self, mask):
+        ''' Keeps only the valid records where mask is True.
+
+        Args:
+            mask (array[bool]): One value per valid record.
+
+        '''
+
+        kept = self.valid()[mask]
+        kept_ids = self.track_ids[:self.count][mask]
+        n = len(kept)
+        self.records[:n] = kept
+        self.records[n:] = 0
+        self.track_ids[:n] = kept_ids
+        self.track_ids[n:] = -1
+        self.count = n
+
+    def tobytes(self):
+        ''' Returns every slot, including the empty ones, as bytes.
+
+        This is a view cast of the records, so the layout is capacity * 6 float32 values in the
+        order of DETECTION_DTYPE.
+
+        '''
+
+        return self.records.tobytes()
@@ -4,19 +4,121 @@ This script contains a set of classes that run inference on an edge device. Each
 tailored for a specific task, such as object detection or image classification. The classes can be 
 easily extended by creating a child class that defines the preprocessing and inference functions.
 
+The TFLite engines run any TFLite model with the TFLite interpreter. They run on the CPU of any
+machine (e.g. x86 gateways or CI) and can optionally use the Edge TPU delegate.
+
 Classes:
     BaseEngine: Abstract base engine that defines the interface for all child engines.
     DetectionEngine: Performs object detection inference with any SSD quantized model.
+    TFLiteEngine: Base engine for models run with the TFLite interpreter.
+    TFLiteDetectionEngine: Performs object detection with an SSD model on the TFLite interpreter.
+    TFLiteClassificationEngine: Performs image classification on the TFLite interpreter.
+    SimulatedEngine: Stands in for a detection engine with a configurable latency.
 
 '''
 
 import os
+import platform
+import time
 import cv2
-from PIL import Image
 from abc import abstractmethod
-from edgetpu.detection.engine import DetectionEngine as EdgeTPUDetectionEngine
+from collections import namedtuple
 import numpy as np
 
+from detections import Detections, make_class_mask
+from preprocess import FusedPreprocessor
+
+try:
+    from edgetpu.detection.engine import DetectionEngine as EdgeTPUDetectionEngine
+except ImportError:
+    EdgeTPUDetectionEngine = None
+
+try:
+    import tflite_runtime.interpreter as tflite
+except ImportError:
+    tflite = None
+
+
+EDGETPU_SHARED_LIB = {
+    'Linux': 'libedgetpu.so.1',
+    'Darwin': 'libedgetpu.1.dylib',
+    'Windows': 'edgetpu.dll'
+}.get(platform.system())
+
+# Classification result.
+Classification = namedtuple("Classification", ["label_id", "score"])
+
+
+def load_labels(label_path):
+    ''' Loads label file into a dictionary.
+
+    See DetectionEngine.load_labels() for the file format.
+
+    Args:
+        label_path (str): Path to the labels file
+
+    Returns:
+        Dictionary of labels if the label_path exists, else None
+
+    '''
+
+    if label_path and os.path.exists(label_path):
+        labels = {}
+        with open(label_path, "r") as file:
+            for line in file.readlines():
+                split = line.split(" ")
+                num = int(split[0])
+                label = line[len(split[0]):].strip(" \n")
+                labels[num] = label
+        return labels
+    else:
+        return None
+
+
+def make_interpreter(model_path,
+                     num_threads=None,
+                     use_xnnpack=True,
+                     use_edgetpu=False):
+    ''' Creates a TFLite interpreter and allocates its tensors.
+
+    Args:
+        model_path (str): Path to the .tflite model.
+        num_threads (int, optional): Number of CPU threads used by the interpreter. Defaults to
+            the interpreter's own choice.
+        use_xnnpack (bool): Apply the XNNPACK delegate to float models. Only has an effect on
+            TFLite versions that can turn off the default delegates.
+        use_edgetpu (bool): Run the model on the Edge TPU. The model must be compiled for it.
+
+    Returns:
+        The TFLite interpreter.
+
+    Raises:
+        RuntimeError: The TFLite runtime is not installed.
+
+    '''
+
+    if tflite is None:
+        raise RuntimeError("The TFLite engines require the tflite_runtime package.")
+
+    kwargs = {"model_path": model_path}
+
+    if num_threads:
+        kwargs["num_threads"] = num_threads
+
+    if use_edgetpu:
+        kwargs["experimental_delegates"] = [tflite.load_delegate(EDGETPU_SHARED_LIB)]
+
+    # Older runtimes always apply the default delegates and have no resolver option
+    resolver_types = getattr(tflite, "OpResolverType", None)
+    if resolver_types is not None and not use_xnnpack:
+        kwargs["experimental_op_resolver_type"] = \
+            resolver_types.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+
+    interpreter = tflite.Interpreter(**kwargs)
+    interpreter.allocate_tensors()
+
+    return interpreter
+
 
 class BaseEngine(object):
     ''' Abstract base engine defining methods for running inference.
@@ -53,6 +155,33 @@ class BaseEngine(object):
 
         return pred
 
+    def invoke_batch(self, frames):
+        ''' Performs inference on a batch of images.
+
+        Running a batch at once lets engines share the fixed cost of a call to the interpreter
+        across several images. Predictions are returned in the same order as the frames.
+
+        Args:
+            frames (list[array[int]]): Images from 0-255. They can come from different sources.
+
+        Returns: List of inference predictions, one per frame.
+
+        '''
+
+        inf_inputs = [self.preprocess(frame) for frame in frames]
+
+        return self.run_inference_batch(inf_inputs)
+
+    def run_inference_batch(self, inf_inputs):
+        ''' Performs inference on a batch of preprocessed inputs.
+
+        The default runs the inputs one at a time. Child classes whose interpreter accepts a
+        batch dimension should override this method.
+
+        '''
+
+        return [self.run_inference(inf_input) for inf_input in inf_inputs]
+
     @abstractmethod
     def preprocess(self, frame):
         ''' Performs preprocessing required to correctly format the image for inference.
@@ -78,25 +207,47 @@ class DetectionEngine(BaseEngine):
             specified, then the user can just retreive the label ID as an integer.
         top_k (int): The maximum number of detection candidates to return.
         threshold (float): The minimum confidence score of candidates to return.
+        class_mask (array[bool], optional): True for every label ID that has a label.
+        preprocessor: Converts camera frames into the model input in one pass.
+        input: Reusable model input buffer.
+        output_offsets (array[int]): Start of each output tensor in the raw engine output.
 
     '''
     def __init__(self,
                  model_path,
                  label_path="",
                  top_k=5,
-                 threshold=0.5):
+                 threshold=0.5,
+                 letterbox=False):
         ''' Loads the engine and labels.
+
+        Args:
+            letterbox (bool): Keep the frame's aspect ratio when resizing to the model input.
+                Defaults to stretching the frame, like the Edge TPU library does.
+
         '''
 
         if not os.path.exists(model_path):
             raise ValueError("Cannot find model file.")
 
+        if EdgeTPUDetectionEngine is None:
+            raise RuntimeError("DetectionEngine requires the edgetpu package. " +
+                               "Use TFLiteDetectionEngine to run on the CPU.")
+
         self.labels = self.load_labels(label_path)
+        self.class_mask = make_class_mask(self.labels)
         self.top_k = top_k
         self.threshold = threshold
 
         super(DetectionEngine, self).__init__(EdgeTPUDetectionEngine(model_path))
 
+        _, height, width, _ = self.engine.get_input_tensor_shape()
+        self.preprocessor = FusedPreprocessor((width, height), letterbox=letterbox)
+        self.input = np.zeros((height, width, 3), dtype=np.uint8)
+
+        # The raw output is the boxes, classes, scores and count tensors concatenated
+        self.output_offsets = np.cumsum(self.engine.get_all_output_tensors_sizes())[:-1]
+
     def load_labels(self, label_path):
         ''' Loads label file into a dictionary.
 
@@ -122,69 +273,358 @@ class DetectionEngine(BaseEngine):
             }
 
         '''
-        if label_path and os.path.exists(label_path):
-            labels = {}
-            with open(label_path, "r") as file:
-                for line in file.readlines():
-                    split = line.split(" ")
-                    num = int(split[0])
-                    label = line[len(split[0]):].strip(" \n")
-                    labels[num] = label
-            return labels
+        return load_labels(label_path)
+
+    def invoke_batch(self, frames):
+        ''' Runs the frames one at a time, since they share the same input buffer.
+        '''
+
+        return [self.invoke(frame) for frame in frames]
+
+    def preprocess(self, frame):
+        ''' Formats the input frame for the detection engine.
+
+        The EdgeTPU engine expects RGB images at the model input size. The BGR frame from
+        OpenCV is resized and color converted into the reusable input buffer in one pass.
+
+        Args:
+            frame: Input frame to the engine.
+
+        Returns:
+            RGB image at the model input size.
+
+        '''
+
+        return self.preprocessor(frame, self.input)
+
+    def run_inference(self, frame):
+        ''' Runs the SSD model and converts its raw output into Detections.
+
+        If labels have been specified, then only predictions with a corresponding label are
+        returned. This allows the user to specify a subset of predictions to return if the model
+        is trained on many objects.
+
+        Args:
+            frame: Preprocessed model input.
+
+        Returns:
+            Detections.
+
+        '''
+
+        _, raw_output = self.engine.run_inference(frame.reshape(-1))
+        boxes, classes, scores, count = np.split(raw_output, self.output_offsets)
+
+        preds = Detections.from_ssd(self.top_k,
+                                    boxes.reshape(-1, 4),
+                                    classes,
+                                    scores,
+                                    count[0],
+                                    threshold=self.threshold,
+                                    class_mask=self.class_mask)
+
+        if self.preprocessor.letterbox:
+            boxes = preds.boxes()
+            boxes[:] = self.preprocessor.unletterbox(boxes)
+
+        return preds
+
+    def get_max_length(self):
+        ''' Returns max number of detection candidates.
+        '''
+
+        return self.top_k
+
+    def label(self, label_id):
+        ''' Returns the label for the label ID if it exists.
+        '''
+        
+        if self.labels:
+            return self.labels[label_id]
         else:
-            return None
+            return ""
+
+
+class TFLiteEngine(BaseEngine):
+    ''' Base engine for models run with the TFLite interpreter.
+
+    The input tensor index, shape, type and quantization are resolved once when the engine is
+    created. Every frame is resized, color converted and scaled directly into the interpreter's
+    input tensor by a FusedPreprocessor, so no intermediate image is allocated per frame.
+
+    Attributes:
+        input_tensor: Function returning a view of the interpreter's input tensor. Only the
+            function is kept, since the interpreter refuses to run while a view is held.
+        input_size (tuple[int]): Model input (width, height).
+        input_dtype: Data type of the input tensor.
+        input_mean (float): Subtracted from float inputs before scaling.
+        input_std (float): Float inputs are divided by this value.
+        preprocessor: Converts camera frames into the input tensor in one pass.
+        num_threads (int): Number of CPU threads used by the interpreter.
+        use_xnnpack (bool): Whether the XNNPACK delegate may be used.
+        batch_size (int): Number of frames the input tensor currently holds.
+        can_batch (bool): False once the interpreter refused a batch dimension, for example
+            for models compiled for the Edge TPU.
+
+    '''
+
+    def __init__(self,
+                 model_path,
+                 num_threads=None,
+                 use_xnnpack=True,
+                 use_edgetpu=False,
+                 input_mean=127.5,
+                 input_std=127.5):
+        ''' Loads the interpreter and resolves the input tensor.
+
+        Args:
+            model_path (str): Path to the .tflite model.
+            num_threads (int, optional): Number of CPU threads used by the interpreter.
+            use_xnnpack (bool): Apply the XNNPACK delegate to float models.
+            use_edgetpu (bool): Run the model on the Edge TPU with the Edge TPU delegate.
+            input_mean (float): Mean used to normalize float model inputs.
+            input_std (float): Standard deviation used to normalize float model inputs.
+
+        Raises:
+            ValueError: The model file does not exist.
+
+        '''
+
+        if not os.path.exists(model_path):
+            raise ValueError("Cannot find model file.")
+
+        self.num_threads = num_threads
+        self.use_xnnpack = use_xnnpack
+        self.input_mean = input_mean
+        self.input_std = input_std
+
+        interpreter = make_interpreter(model_path,
+                                       num_threads=num_threads,
+                                       use_xnnpack=use_xnnpack,
+                                       use_edgetpu=use_edgetpu)
+
+        input_details = interpreter.get_input_details()[0]
+        _, height, width, channels = input_details["shape"]
+        self.input_size = (int(width), int(height))
+        self.input_dtype = input_details["dtype"]
+        self.input_index = input_details["index"]
+        self.input_tensor = interpreter.tensor(self.input_index)
+        self.batch_size = 1
+        self.can_batch = True
+
+        self.preprocessor = FusedPreprocessor(self.input_size,
+                                              channels=int(channels),
+                                              dtype=self.input_dtype,
+                                              **self.input_scaling(input_details))
+
+        self.output_details = interpreter.get_output_details()
+
+        super(TFLiteEngine, self).__init__(interpreter)
 
     def invoke(self, frame):
-        ''' Runs inference.
+        self.resize_batch(1)
+        return super(TFLiteEngine, self).invoke(frame)
 
-        This method runs inference just like the base method. If labels have been
-        specified, then it only returns the inference results if they have a corresponding label.
-        This allows the user to specify a subset of predictions to return if the model is trained
-        on many objects.
+    def preprocess(self, frame, index=0):
+        ''' Resizes, color converts and scales the frame directly into the input tensor.
 
         Args:
-            frame: input frame to the engine.
+            frame: BGR input frame to the engine.
+            index (int): Position of the frame in the batch.
 
         Returns:
-            list of DetectionCandidates (EdgeTPU class).
+            None, the input is already in the interpreter.
 
         '''
-        preds = super().invoke(frame)
 
-        if self.labels:
-            labeled_preds = []
-            for i, pred in enumerate(preds):
-                if pred.label_id in self.labels:
-                    labeled_preds.append(pred)
+        self.preprocessor(frame, self.input_tensor()[index])
 
-            return labeled_preds
+    def input_scaling(self, input_details):
+        ''' Returns the scale and offset that convert pixel values into model input values.
 
-        else:
-            return preds
+        uint8 models take raw pixels. Float models take pixels normalized with input_mean and
+        input_std. int8 models take the normalized pixels quantized with the input tensor's
+        quantization parameters.
 
-    def preprocess(self, frame):
-        ''' Formats the input frame for the detection engine.
+        Args:
+            input_details (dict): Input details from the interpreter.
 
-        The EdgeTPU engine expects RGB images in PIL format. The images are converted from 
-        BGR in OpenCV to PIL.
+        Returns:
+            Dictionary with the scale and offset.
+
+        '''
+
+        if self.input_dtype == np.uint8:
+            return {"scale": 1.0, "offset": 0.0}
+
+        scale = 1.0 / self.input_std
+        offset = -self.input_mean / self.input_std
+
+        quant_scale, zero_point = input_details["quantization"]
+        if quant_scale:
+            scale /= quant_scale
+            offset = offset / quant_scale + zero_point
+
+        return {"scale": scale, "offset": offset}
+
+    def resize_batch(self, batch_size):
+        ''' Resizes the input tensor to hold batch_size frames.
+
+        Reallocating the tensors is slow, so it only happens when the batch size changes.
 
         Args:
-            frame: Input frame to the engine.
+            batch_size (int): Number of frames.
 
         Returns:
-            RGB PIL image.
+            True if the input tensor holds batch_size frames, False if the interpreter can't
+            run batches.
 
         '''
 
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        image = Image.fromarray(rgb_frame)
+        if batch_size == self.batch_size:
+            return True
+        if batch_size > 1 and not self.can_batch:
+            return False
 
-        return image
+        shape = [batch_size] + [int(size) for size in
+                                self.engine.get_input_details()[0]["shape"][1:]]
+        try:
+            self.engine.resize_tensor_input(self.input_index, shape)
+            self.engine.allocate_tensors()
+        except (RuntimeError, ValueError) as e:
+            if batch_size == 1:
+                raise
+            print("Model can't run batches, running frames one at a time: {}".format(e))
+            self.can_batch = False
+            self.resize_batch(1)
+            return False
 
-    def run_inference(self, frame):
-        return self.engine.detect_with_image(frame,
-                                             threshold=self.threshold,
-                                             top_k=self.top_k)
+        self.batch_size = batch_size
+        self.output_details = self.engine.get_output_details()
+
+        return True
+
+    def invoke_batch(self, frames):
+        ''' Runs the frames in one call to the interpreter, with a batch dimension on the input.
+
+        Falls back to one frame at a time if the interpreter can't resize the input.
+
+        '''
+
+        if len(frames) < 2 or not self.resize_batch(len(frames)):
+            return [self.invoke(frame) for frame in frames]
+
+        for index, frame in enumerate(frames):
+            self.preprocess(frame, index)
+        self.engine.invoke()
+
+        return [self.read_outputs(index) for index in range(len(frames))]
+
+    def run_inference(self, inf_input):
+        self.engine.invoke()
+        return self.read_outputs()
+
+    @abstractmethod
+    def read_outputs(self, index=0):
+        ''' Reads the output tensors of a frame of the batch into predictions. Specific to the
+        inference task.
+        '''
+        pass
+
+    def output(self, i, index=0):
+        ''' Returns output tensor i of a frame of the batch, dequantized if the model output is
+        quantized.
+        '''
+
+        details = self.output_details[i]
+        output = self.engine.get_tensor(details["index"])[index]
+
+        scale, zero_point = details["quantization"]
+        if scale:
+            output = scale * (output.astype(np.float32) - zero_point)
+
+        return output
+
+
+class TFLiteDetectionEngine(TFLiteEngine):
+    ''' Performs object detection with an SSD model on the TFLite interpreter.
+
+    The model must end with the TFLite detection postprocess op, like the models used by
+    DetectionEngine. Results are Detections, just like DetectionEngine, so this engine can
+    replace DetectionEngine anywhere in the pipeline.
+
+    Attributes:
+        labels (dict, optional): Stores the mapping between prediction IDs and labels.
+        top_k (int): The maximum number of detection candidates to return.
+        threshold (float): The minimum confidence score of candidates to return.
+        class_mask (array[bool], optional): True for every label ID that has a label.
+
+    '''
+
+    def __init__(self,
+                 model_path,
+                 label_path="",
+                 top_k=5,
+                 threshold=0.5,
+                 **kwargs):
+        ''' Loads the interpreter and labels.
+
+        Args:
+            model_path (str): Path to the .tflite model.
+            label_path (str): Path to the labels file. See DetectionEngine.load_labels().
+            top_k (int): The maximum number of detection candidates to return.
+            threshold (float): The minimum confidence score of candidates to return.
+            kwargs: Interpreter options passed to TFLiteEngine.
+
+        '''
+
+        self.labels = load_labels(label_path)
+        self.class_mask = make_class_mask(self.labels)
+        self.top_k = top_k
+        self.threshold = threshold
+
+        super(TFLiteDetectionEngine, self).__init__(model_path, **kwargs)
+
+        self.boxes, self.classes, self.scores, self.count = self.resolve_outputs()
+
+    def resolve_outputs(self):
+        ''' Finds the boxes, classes, scores and count outputs of the postprocess op.
+
+        The order of the outputs depends on the TensorFlow version the model was converted
+        with. Boxes and count can be told apart by shape. Classes and scores are told apart by
+        name when possible, else the TF1 order is assumed.
+
+        Returns:
+            Output indices of (boxes, classes, scores, count).
+
+        '''
+
+        boxes = count = None
+        others = []
+        for i, details in enumerate(self.output_details):
+            if len(details["shape"]) == 3:
+                boxes = i
+            elif len(details["shape"]) == 1:
+                count = i
+            else:
+                others.append(i)
+
+        if boxes is None or count is None or len(others) != 2:
+            raise ValueError("Model does not end with a detection postprocess op.")
+
+        if "score" in self.output_details[others[0]]["name"].lower():
+            others.reverse()
+
+        return boxes, others[0], others[1], count
+
+    def read_outputs(self, index=0):
+        return Detections.from_ssd(self.top_k,
+                                   self.output(self.boxes, index),
+                                   self.output(self.classes, index),
+                                   self.output(self.scores, index),
+                                   self.output(self.count, index),
+                                   threshold=self.threshold,
+                                   class_mask=self.class_mask)
 
     def get_max_length(self):
         ''' Returns max number of detection candidates.
@@ -192,11 +632,200 @@ class DetectionEngine(BaseEngine):
 
         return self.top_k
 
-    def label(self, pred):
-        ''' Returns the label for the prediction if it exists.
+    def label(self, label_id):
+        ''' Returns the label for the label ID if it exists.
         '''
-        
+
         if self.labels:
-            return self.labels[pred.label_id]
+            return self.labels[label_id]
         else:
             return ""
+
+
+class TFLiteClassificationEngine(TFLiteEngine):
+    ''' Performs image classification on the TFLite interpreter.
+
+    Attributes:
+        labels (dict, optional): Stores the mapping between class IDs and labels.
+        top_k (int): The maximum number of classes to return.
+        threshold (float): The minimum score of classes to return.
+
+    '''
+
+    def __init__(self,
+                 model_path,
+                 label_path="",
+                 top_k=1,
+                 threshold=0.0,
+                 **kwargs):
+        ''' Loads the interpreter and labels.
+
+        Args:
+            model_path (str): Path to the .tflite model.
+            label_path (str): Path to the labels file. See DetectionEngine.load_labels().
+            top_k (int): The maximum number of classes to return.
+            threshold (float): The minimum score of classes to return.
+            kwargs: Interpreter options passed to TFLiteEngine.
+
+        '''
+
+        self.labels = load_labels(label_path)
+        self.top_k = top_k
+        self.threshold = threshold
+
+        super(TFLiteClassificationEngine, self).__init__(model_path, **kwargs)
+
+    def read_outputs(self, index=0):
+        scores = self.output(0, index)
+
+        top = np.argsort(scores)[::-1][:self.top_k]
+        return [Classification(int(i), float(scores[i])) for i in top
+                if scores[i] >= self.threshold]
+
+    def get_max_length(self):
+        ''' Returns max number of classes.
+        '''
+
+        return self.top_k
+
+    def label(self, label_id):
+        ''' Returns the label for the label ID if it exists.
+        '''
+
+        if self.labels:
+            return self.labels[label_id]
+        else:
+            return ""
+
+
+class SimulatedEngine(BaseEngine):
+    ''' Stands in for a detection engine with a configurable latency.
+
+    Frames are preprocessed like they are for a real model, then the engine sleeps for a latency
+    drawn from a distribution and returns random Detections. Sleeping releases the GIL just like
+    waiting on the Edge TPU does, so the pipeline can be benchmarked on any machine.
+
+    Attributes:
+        latency (float): Mean inference latency in seconds.
+        jitter (float): Standard deviation of the latency in seconds.
+        distribution (str): "constant", "normal", "lognormal" or "uniform".
+        detections (tuple[int]): Smallest and largest number of detections per frame.
+        top_k (int): The maximum number of detection candidates to return.
+        labels (dict): Mapping between label IDs and labels.
+        rng: Random number generator for the latencies and detections.
+
+    '''
+
+    DISTRIBUTIONS = ("constant", "normal", "lognormal", "uniform")
+
+    def __init__(self,
+                 input_size=(300, 300),
+                 latency=0.015,
+                 jitter=0.0,
+                 distribution="normal",
+                 detections=3,
+                 top_k=15,
+                 num_labels=90,
+                 seed=None):
+        ''' Creates the preprocessing buffers and the random number generator.
+
+        Args:
+            input_size (tuple[int]): (width, height) of the simulated model input.
+            latency (float): Mean inference latency in seconds.
+            jitter (float): Standard deviation of the latency in seconds. For "uniform", the
+                latency is drawn from latency +- jitter.
+            distribution (str): Latency distribution. See DISTRIBUTIONS.
+            detections (int or tuple[int]): Number of detections per frame, or the smallest and
+                largest number.
+            top_k (int): The maximum number of detection candidates to return.
+            num_labels (int): Number of simulated labels.
+            seed (int, optional): Seed for reproducible runs.
+
+        Raises:
+            ValueError: The distribution is not supported.
+
+        '''
+
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError("Latency distribution not supported: {}".format(distribution))
+
+        if isinstance(detections, int):
+            detections = (detections, detections)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.detections = (min(detections[0], top_k), min(detections[1], top_k))
+        self.top_k = top_k
+        self.labels = {i: "object {}".format(i) for i in range(num_labels)}
+        self.rng = np.random.default_rng(seed)
+
+        super(SimulatedEngine, self).__init__(None)
+
+        width, height = input_size
+        self.preprocessor = FusedPreprocessor(input_size)
+        self.input = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def sample_latency(self):
+        ''' Draws one inference latency in seconds from the distribution.
+        '''
+
+        if self.distribution == "constant" or not self.jitter:
+            return self.latency
+        elif self.distribution == "normal":
+            latency = self.rng.normal(self.latency, self.jitter)
+        elif self.distribution == "lognormal":
+            # Parameters of the underlying normal for the requested mean and deviation
+            sigma = np.sqrt(np.log(1 + (self.jitter / self.latency) ** 2))
+            latency = self.rng.lognormal(np.log(self.latency) - sigma ** 2 / 2, sigma)
+        else:
+            latency = self.rng.uniform(self.latency - self.jitter, self.latency + self.jitter)
+
+        return max(float(latency), 0.0)
+
+    def preprocess(self, frame):
+        return self.preprocessor(frame, self.input)
+
+    def run_inference(self, frame):
+        ''' Waits for the simulated latency and returns random Detections.
+        '''
+
+        time.sleep(self.sample_latency())
+
+        return self.random_detections()
+
+    def run_inference_batch(self, inf_inputs):
+        ''' Waits for the simulated latency once for the whole batch, like an accelerator that
+        runs the batch in one pass, and returns random Detections for every input.
+        '''
+
+        time.sleep(self.sample_latency())
+
+        return [self.random_detections() for _ in inf_inputs]
+
+    def random_detections(self):
+        ''' Returns between detections[0] and detections[1] random Detections.
+        '''
+
+        count = self.rng.integers(self.detections[0], self.detections[1] + 1)
+
+        # Sorting two random (y, x) corners gives (ymin, xmin, ymax, xmax) boxes
+        corners = self.rng.random((count, 2, 2), dtype=np.float32)
+        corners.sort(axis=1)
+        boxes = corners.reshape(count, 4)
+        scores = np.sort(self.rng.uniform(0.5, 1.0, count).astype(np.float32))[::-1]
+        classes = self.rng.integers(0, len(self.labels), count).astype(np.float32)
+
+        return Detections.from_ssd(self.top_k, boxes, classes, scores, count)
+
+    def get_max_length(self):
+        ''' Returns max number of detection candidates.
+        '''
+
+        return self.top_k
+
+    def label(self, label_id):
+        ''' Returns the label for the label ID.
+        '''
+
+        return self.labels[label_id]
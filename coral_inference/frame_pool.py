@@ -0,0 +1,90 @@
+''' Reusable pool of preallocated frame buffers.
+
+Sources that decode frames can decode into a buffer from the pool instead of allocating a new
+array for every frame. The pool only keeps buffers that were handed back with release(), so a
+buffer is never handed out again while it may still be in use. Whoever releases a frame
+promises that nothing, including views of it (crops, reshapes), reads it anymore.
+
+A frame that is never released is freed like any other array once the last reference to it is
+gone. The streaming thread of a camera releases the frames it published once they are older
+than the number of frames it promises to keep valid, see BaseCamera.
+
+Classes:
+    FramePool: Hands out frame buffers and takes back the released ones for reuse.
+
+'''
+
+import threading
+
+import numpy as np
+
+
+class FramePool(object):
+    ''' Hands out frame buffers and takes back the released ones for reuse.
+
+    Attributes:
+        max_size (int): Largest number of released buffers kept in the pool. Buffers released
+            into a full pool are dropped.
+        dtype: Data type of the buffers.
+        frames (list[array]): The released buffers, ready to be handed out again.
+
+    '''
+
+    def __init__(self,
+                 max_size=16,
+                 dtype=np.uint8):
+
+        self.max_size = max_size
+        self.dtype = dtype
+        self.frames = []
+        self.lock = threading.Lock()
+
+    def acquire(self, shape):
+        ''' Returns a buffer of the given shape that nobody else is using.
+
+        The caller owns the buffer until it passes it to release().
+
+        Args:
+            shape (tuple[int]): Shape of the buffer.
+
+        Returns:
+            An array of the shape. Its contents are undefined.
+
+        '''
+
+        shape = tuple(shape)
+
+        with self.lock:
+            for i in range(len(self.frames)):
+                if self.frames[i].shape == shape:
+                    return self.frames.pop(i)
+
+        return np.empty(shape, dtype=self.dtype)
+
+    def release(self, frame):
+        ''' Hands a buffer back to the pool for reuse.
+
+        Only whole buffers are taken back, views and arrays of another data type are ignored.
+        If the pool is full, the buffer of another shape that was released first makes room,
+        so the pool follows resolution changes.
+
+        Args:
+            frame (array): A buffer from acquire() that nothing reads anymore.
+
+        '''
+
+        if frame is None or frame.base is not None or frame.dtype != self.dtype:
+            return
+
+        with self.lock:
+            if any(buffer is frame for buffer in self.frames):
+                return
+
+            if len(self.frames) >= self.max_size:
+                stale = next((i for i in range(len(self.frames))
+                              if self.frames[i].shape != frame.shape), None)
+                if stale is None:
+                    return
+                del self.frames[stale]
+
+            self.frames.append(frame)
@@ -0,0 +1,236 @@
+''' Runtime metrics in the Prometheus text format.
+
+Collection is cheap enough to leave on in production. Every counter is only ever updated by one
+thread (the stage that owns it), so the hot loops just add to a number without taking a lock.
+Everything else, such as rates, latency percentiles, queue depths and process CPU/RSS, is only
+computed when the metrics are scraped.
+
+Stages register their counters and gauges with the module-level registry. The latency
+histograms, dropped frame counters and how far each consumer is behind the camera come from the
+tracer (see tracing.py).
+
+Classes:
+    Counter: Monotonically increasing value owned by a single thread.
+    MetricsRegistry: Holds the metrics and renders them in the Prometheus text format.
+
+'''
+
+import os
+import resource
+import threading
+import time
+
+import tracing
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def resident_memory():
+    ''' Returns the resident memory of this process in bytes.
+
+    Reads the current RSS from /proc, falling back to the peak RSS elsewhere.
+
+    '''
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Counter(object):
+    ''' Monotonically increasing value owned by a single thread.
+
+    Attributes:
+        value (float): The current count.
+
+    '''
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(key, value)
+                          for key, value in sorted(labels.items())) + "}"
+
+
+class MetricsRegistry(object):
+    ''' Holds the metrics and renders them in the Prometheus text format.
+
+    Attributes:
+        prefix (str): Prefix of every metric name.
+        counters (dict): Counter for each (name, labels) pair.
+        gauges (dict): Function returning the gauge value for each (name, labels) pair.
+        rates (dict): Counter whose per-second rate is reported for each (name, labels) pair.
+        help (dict): Help text and type of each metric name.
+
+    '''
+
+    def __init__(self,
+                 prefix="coral_"):
+
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.rates = {}
+        self.help = {}
+
+        # Counter values at the previous scrape, used to compute the rates
+        self.previous = {}
+        self.lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def counter(self, name, help, labels=None):
+        ''' Returns the counter with the name and labels, creating it on first use.
+
+        Args:
+            name (str): Metric name without the prefix. Should end with "_total".
+            help (str): Description of the metric.
+            labels (dict, optional): Prometheus labels.
+
+        '''
+
+        key = self._key(name, labels)
+        with self.lock:
+            self.help[name] = (help, "counter")
+            return self.counters.setdefault(key, Counter())
+
+    def gauge(self, name, help, function, labels=None):
+        ''' Registers a gauge whose value is computed by a function at scrape time.
+
+        Registering a gauge again with the same name and labels replaces the function.
+
+        '''
+
+        with self.lock:
+            self.help[name] = (help, "gauge")
+            self.gauges[self._key(name, labels)] = function
+
+    def rate(self, name, help, counter, labels=None):
+        ''' Registers a gauge reporting the per-second rate of a counter between scrapes.
+
+        The first scrape reports the rate since the gauge was registered.
+
+        '''
+
+        with self.lock:
+            self.help[name] = (help, "gauge")
+            key = self._key(name, labels)
+            self.rates[key] = counter
+            self.previous[key] = (counter.value, time.monotonic())
+
+    def _compute_rate(self, key, counter, now):
+        previous_value, previous_time = self.previous.get(key, (0, None))
+        self.previous[key] = (counter.value, now)
+
+        if previous_time is None or now <= previous_time:
+            return 0.0
+
+        return (counter.value - previous_value) / (now - previous_time)
+
+    def render(self, tracer=None):
+        ''' Renders every metric in the Prometheus text format.
+
+        Args:
+            tracer (optional): Tracer with the latency histograms and dropped frame counters.
+                Defaults to the shared tracer.
+
+        Returns:
+            The metrics as a string.
+
+        '''
+
+        tracer = tracer or tracing.tracer
+        now = time.monotonic()
+        samples = {}
+
+        with self.lock:
+            for (name, labels), counter in self.counters.items():
+                samples.setdefault(name, []).append((dict(labels), counter.value))
+
+            for (name, labels), counter in self.rates.items():
+                samples.setdefault(name, []).append(
+                    (dict(labels), self._compute_rate((name, labels), counter, now)))
+
+            gauges = list(self.gauges.items())
+            help = dict(self.help)
+
+        for (name, labels), function in gauges:
+            try:
+                value = function()
+            except Exception:
+                # A stage that is not running must not break the scrape
+                continue
+            samples.setdefault(name, []).append((dict(labels), value))
+
+        lines = []
+        for name in sorted(samples):
+            text, metric_type = help[name]
+            lines.append("# HELP {}{} {}".format(self.prefix, name, text))
+            lines.append("# TYPE {}{} {}".format(self.prefix, name, metric_type))
+            for labels, value in samples[name]:
+                lines.append("{}{}{} {}".format(self.prefix, name, _format_labels(labels), value))
+
+        lines.extend(self._render_tracer(tracer))
+        lines.extend(self._render_process())
+
+        return "\n".join(lines) + "\n"
+
+    def _render_tracer(self, tracer):
+        name = self.prefix + "stage_latency_seconds"
+        lines = ["# HELP {} Time each frame spent in each pipeline stage.".format(name),
+                 "# TYPE {} summary".format(name)]
+
+        for stage, histogram in sorted(tracer.histograms.items()):
+            for percentile, value in histogram.percentiles().items():
+                labels = {"stage": stage, "quantile": int(percentile[1:]) / 100}
+                lines.append("{}{} {}".format(name, _format_labels(labels), value))
+
+            labels = _format_labels({"stage": stage})
+            lines.append("{}_sum{} {}".format(name, labels, histogram.total))
+            lines.append("{}_count{} {}".format(name, labels, histogram.count))
+
+        name = self.prefix + "frames_dropped_total"
+        lines.append("# HELP {} Captured frames each consumer never received.".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        for consumer, count in sorted(tracer.dropped.items()):
+            lines.append("{}{} {}".format(name, _format_labels({"consumer": consumer}), count))
+
+        name = self.prefix + "frames_behind"
+        lines.append("# HELP {} Frames between the newest capture and the last frame each consumer "
+                     "received.".format(name))
+        lines.append("# TYPE {} gauge".format(name))
+        for consumer, count in sorted(tracer.frames_behind().items()):
+            lines.append("{}{} {}".format(name, _format_labels({"consumer": consumer}), count))
+
+        return lines
+
+    def _render_process(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        rss = resident_memory()
+
+        return ["# HELP {}process_cpu_seconds_total Total user and system CPU time."
+                .format(self.prefix),
+                "# TYPE {}process_cpu_seconds_total counter".format(self.prefix),
+                "{}process_cpu_seconds_total {}".format(self.prefix,
+                                                       usage.ru_utime + usage.ru_stime),
+                "# HELP {}process_resident_memory_bytes Resident memory size.".format(self.prefix),
+                "# TYPE {}process_resident_memory_bytes gauge".format(self.prefix),
+                "{}process_resident_memory_bytes {}".format(self.prefix, rss)]
+
+
+# Registry shared by every stage in this process
+registry = MetricsRegistry()
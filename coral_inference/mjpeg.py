@@ -0,0 +1,104 @@
+''' Encode-once MJPEG stream for any number of video clients.
+
+Every video client used to render and JPEG encode its own copy of each frame. The
+MJPEGBroadcaster renders and encodes each new frame exactly once in a single thread, builds the
+multipart chunk once, and publishes it to a ring buffer. Every client reads the newest chunk from
+the ring buffer, so a slow client skips frames instead of holding up the others.
+
+Classes:
+    MJPEGBroadcaster: Encodes frames once and fans the same bytes out to every client.
+
+'''
+
+import threading
+
+import metrics
+from thread_manager import ThreadManager
+from tracing import tracer
+
+
+class MJPEGBroadcaster(object):
+    ''' Encodes frames once and fans the same bytes out to every client.
+
+    The encoder thread only runs while at least one client is subscribed.
+
+    Attributes:
+        source: Postprocessor with a read_frame_bytes() method that returns the newest JPEG
+            and its FrameTrace.
+        subscribers (int): Number of connected clients.
+        thread_manager: Hands the newest multipart chunk to the clients.
+
+    '''
+
+    BOUNDARY = b'frame'
+    MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+
+    def __init__(self,
+                 source):
+
+        self.source = source
+        self.subscribers = 0
+        self.subscribers_changed = threading.Condition()
+
+        self.header = b'--' + self.BOUNDARY + b'\r\nContent-Type: image/jpeg\r\n\r\n'
+
+        self.thread_manager = ThreadManager(self, capacity=2)
+
+        metrics.registry.gauge("http_clients", "Connected video clients.",
+                               lambda: self.subscribers)
+
+    def start(self):
+        ''' Starts the encoder thread.
+        '''
+
+        self.thread_manager.start()
+
+    def _thread(self):
+        while True:
+            # Don't encode frames that nobody is watching
+            with self.subscribers_changed:
+                self.subscribers_changed.wait_for(lambda: self.subscribers > 0)
+
+            jpeg, trace = self.source.read_frame_bytes()
+
+            # Build the chunk once for every client
+            self.thread_manager.set((b''.join((self.header, jpeg, b'\r\n')), trace))
+
+    def subscribe(self):
+        ''' Registers a new client and wakes up the encoder thread.
+        '''
+
+        with self.subscribers_changed:
+            self.subscribers += 1
+            self.subscribers_changed.notify_all()
+
+    def unsubscribe(self):
+        ''' Removes a client. The encoder thread pauses once the last client is gone.
+        '''
+
+        with self.subscribers_changed:
+            self.subscribers -= 1
+
+    def stream(self):
+        ''' Generator that yields multipart chunks for one client.
+
+        The client always receives the newest chunk. Chunks published while the client was
+        still sending the previous one are skipped.
+
+        Yields: The newest multipart JPEG chunk.
+
+        '''
+
+        self.subscribe()
+        try:
+            seq = -1
+            last_frame_id = None
+            while True:
+                seq, (chunk, trace) = self.thread_manager.buffer.get_latest(seq)
+                last_frame_id = tracer.count_drops("http", last_frame_id, trace)
+                yield chunk
+
+                # The client has received the chunk once the generator is resumed
+                tracer.record_output("http", trace)
+        finally:
+            self.unsubscribe()
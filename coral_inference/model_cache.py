@@ -0,0 +1,325 @@
+''' Keeps loaded inference engines around, keyed by the content of their model files.
+
+Loading a model and running its first inference is slow, so engines that are no longer used are
+kept loaded instead of being thrown away. An engine is found again by the SHA-256 hash of its
+model and label files and the engine params, so a model that is copied to a new path or deployed
+again with the same content is still found. The idle engines are kept in least recently used
+order within a memory budget, estimated from the model file sizes.
+
+The most recently used models are written to a state file. At app start, prewarm() loads them in
+the background, so switching back to a known model after a restart also takes milliseconds.
+
+Classes:
+    ModelCache: Hands out loaded and warmed up inference engines.
+
+'''
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser("~"), ".coral_inference", "models.json")
+
+# Engine params that wrap the engine instead of changing it
+WRAPPER_PARAMS = ("batch", "tracker", "motion_gate")
+
+
+def file_hash(path, chunk_size=1 << 20):
+    ''' Returns the SHA-256 hex digest of a file.
+    '''
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class ModelCache(object):
+    ''' Hands out loaded and warmed up inference engines.
+
+    An engine is used by one pipeline stage at a time. acquire() returns an idle engine with the
+    same key, or loads a new one. release() makes the engine idle again. Idle engines are
+    closed in least recently used order once the loaded models go over the memory budget.
+
+    Attributes:
+        memory_budget (int): Largest total size in bytes of the loaded model files.
+        state_path (str): JSON file with the most recently used models, None to not keep one.
+            The app uses DEFAULT_STATE_PATH.
+        warmup_frames (int): Inferences run on a new engine before it is handed out.
+        idle (OrderedDict): Idle engines of each key, least recently used first.
+        sizes (dict): Estimated size in bytes of the engines of each key.
+        recent (OrderedDict): Engine params of the most recently used keys, newest last.
+
+    '''
+
+    def __init__(self,
+                 memory_budget=256 * 1024 * 1024,
+                 state_path=None,
+                 warmup_frames=1):
+
+        self.memory_budget = memory_budget
+        self.state_path = state_path
+        self.warmup_frames = warmup_frames
+
+        self.idle = OrderedDict()
+        self.sizes = {}
+        self.keys = {}
+        # Keyed by the engine itself, an id() can be reused by an engine created later
+        self.in_use = {}
+        self.recent = OrderedDict()
+
+        # Hashes are only computed again when a file changes
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+        self.hits = metrics.registry.counter("model_cache_hits_total",
+                                             "Engines handed out without loading the model.")
+        self.misses = metrics.registry.counter("model_cache_misses_total",
+                                               "Engines that had to be loaded.")
+        metrics.registry.gauge("model_cache_bytes", "Estimated size of the loaded models.",
+                               self.loaded_bytes)
+
+        self.load_state()
+
+    def __getstate__(self):
+        # A copy in another process starts empty, the engines can't be shared
+        return {"memory_budget": self.memory_budget,
+                "state_path": self.state_path,
+                "warmup_frames": self.warmup_frames}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def key(self, params):
+        ''' Returns the cache key of engine params.
+
+        The model and label paths are replaced by the hashes of their contents.
+
+        '''
+
+        params = {name: value for name, value in params.items() if name not in WRAPPER_PARAMS}
+        for name in ("model_path", "label_path"):
+            if params.get(name) and os.path.exists(params[name]):
+                params[name] = self.content_hash(params[name])
+
+        return json.dumps(params, sort_keys=True)
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+        if file_id not in self.hashes:
+            self.hashes[file_id] = file_hash(path)
+
+        return self.hashes[file_id]
+
+    def acquire(self, params, load):
+        ''' Returns an engine for the params, loading it if no idle engine has the same key.
+
+        Args:
+            params: Dictionary of engine parameters.
+            load: Function that creates an engine from the params.
+
+        Returns:
+            The engine. Pass it to release() once it is no longer used.
+
+        '''
+
+        key = self.key(params)
+
+        with self.lock:
+            self.touch(key, params)
+
+            engines = self.idle.get(key)
+            if engines:
+                engine = engines.pop()
+                if not engines:
+                    del self.idle[key]
+                self.in_use[engine] = key
+                self.hits.inc()
+                return engine
+
+        # Load outside the lock, so other models can be handed out meanwhile
+        engine = self.load(params, load)
+        self.misses.inc()
+
+        with self.lock:
+            self.sizes[key] = self.estimate_size(params)
+            self.keys[key] = self.keys.get(key, 0) + 1
+            self.in_use[engine] = key
+            self.evict()
+
+        return engine
+
+    def release(self, engine):
+        ''' Makes an engine from acquire() idle, so it can be handed out again.
+
+        Engines that did not come from the cache are ignored.
+
+        '''
+
+        with self.lock:
+            key = self.in_use.pop(engine, None)
+            if key is None:
+                return
+
+            self.idle.setdefault(key, []).append(engine)
+            self.idle.move_to_end(key)
+            self.evict()
+
+    def prewarm(self, load, count=2):
+        ''' Loads the most recently used models of the state file into the idle engines.
+
+        Models whose files are gone are skipped. Stops once the memory budget is full.
+
+        Args:
+            load: Function that creates an engine from engine params.
+            count (int): Number of models to load.
+
+        Returns:
+            Number of models loaded.
+
+        '''
+
+        loaded = 0
+        for params in reversed(list(self.recent.values())):
+            if loaded >= count:
+                break
+
+            model_path = params.get("model_path")
+            if model_path and not os.path.exists(model_path):
+                continue
+
+            key = self.key(params)
+            size = self.estimate_size(params)
+            with self.lock:
+                if key in self.idle:
+                    continue
+                if self.loaded_bytes() + size > self.memory_budget:
+                    break
+
+            try:
+                engine = self.load(params, load)
+            except Exception as e:
+                print("Could not prewarm model {}: {}".format(model_path, e))
+                continue
+
+            with self.lock:
+                self.sizes[key] = size
+                self.keys[key] = self.keys.get(key, 0) + 1
+                self.idle[key] = self.idle.get(key, []) + [engine]
+                self.idle.move_to_end(key, last=False)
+
+                # Engines acquired while this one loaded may have filled the budget
+                self.evict()
+
+            loaded += 1
+
+        return loaded
+
+    def prewarm_async(self, load, count=2):
+        ''' Runs prewarm() in a background thread and returns the thread.
+        '''
+
+        thread = threading.Thread(target=self.prewarm, args=(load, count), name="ModelCache",
+                                  daemon=True)
+        thread.start()
+
+        return thread
+
+    def load(self, params, load):
+        ''' Loads an engine and runs its first inferences, which are the slow ones.
+        '''
+
+        engine = load(params)
+
+        frame = np.zeros((480, 640, 3), np.uint8)
+        for _ in range(self.warmup_frames):
+            engine.invoke(frame)
+
+        return engine
+
+    def evict(self):
+        ''' Closes the least recently used idle engines until the models fit the budget.
+
+        Called with the lock held.
+
+        '''
+
+        while self.idle and self.loaded_bytes() > self.memory_budget:
+            key, engines = next(iter(self.idle.items()))
+            engine = engines.pop(0)
+            if not engines:
+                del self.idle[key]
+
+            self.keys[key] -= 1
+            if not self.keys[key]:
+                del self.keys[key]
+
+            close = getattr(engine, "close", None)
+            if close is not None:
+                close()
+
+    def loaded_bytes(self):
+        ''' Returns the estimated size of the loaded engines, idle or in use.
+        '''
+
+        return sum(self.sizes[key] * count for key, count in list(self.keys.items()))
+
+    def estimate_size(self, params):
+        ''' Estimates the memory of an engine from the size of its model file.
+        '''
+
+        model_path = params.get("model_path")
+        if model_path and os.path.exists(model_path):
+            return os.path.getsize(model_path)
+
+        return 0
+
+    def touch(self, key, params):
+        ''' Makes the key the most recently used one and writes the state file.
+
+        Called with the lock held.
+
+        '''
+
+        self.recent.pop(key, None)
+        self.recent[key] = params
+        while len(self.recent) > 16:
+            self.recent.popitem(last=False)
+
+        self.save_state()
+
+    def load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path, "r") as file:
+                recent = json.load(file)
+        except (OSError, ValueError) as e:
+            print("Could not read the model cache state: {}".format(e))
+            return
+
+        for params in recent:
+            self.recent[self.key(params)] = params
+
+    def save_state(self):
+        if not self.state_path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, "w") as file:
+                json.dump(list(self.recent.values()), file)
+        except OSError as e:
+            print("Could not write the model cache state: {}".format(e))
@@ -0,0 +1,262 @@
+''' Runs several models on one device from a single camera.
+
+The EngineMultiplexer holds several loaded engines and runs them one after another in a single
+thread, so the models never compete for the Edge TPU. Each camera frame is handed to the models
+picked by the scheduling mode:
+
+    round_robin: Each frame goes to the next model in turn.
+    rates: Each model runs at its own target rate, for example detection at 15 fps and
+        classification at 2 fps. Models without a rate run on every frame.
+    cascade: A cheap gate model runs on every frame. An expensive model only runs on the frames
+        where the gate found something.
+
+The results of every model are published to their own ModelOutput. A ModelOutput has the same
+interface as a ThreadedEngine, so every model gets its own postprocessor and streams.
+
+Classes:
+    ModelOutput: The results of one model, with the interface of a ThreadedEngine.
+    EngineMultiplexer: Schedules camera frames across several engines.
+
+'''
+
+import time
+
+import metrics
+from thread_manager import ThreadManager
+from tracing import tracer
+
+
+class ModelOutput(object):
+    ''' The results of one model, with the interface of a ThreadedEngine.
+
+    Results are published by the multiplexer thread, so the output has no thread of its own.
+
+    Attributes:
+        name (str): Name of the model.
+        engine: The inference engine of the model.
+        thread_manager: Hands the newest (prediction, frame, trace) to the listeners.
+        inferences: Metrics counter of the frames run through the model.
+
+    '''
+
+    def __init__(self,
+                 name,
+                 engine):
+
+        self.name = name
+        self.engine = engine
+        self.thread_manager = ThreadManager(self)
+        self.pred = None
+
+        self.inferences = metrics.registry.counter("inferences_total",
+                                                   "Frames run through the inference engine.",
+                                                   labels={"model": name})
+
+    def __next__(self):
+        return self.get_prediction()
+
+    def _thread(self):
+        ''' Never started. The multiplexer thread publishes the results.
+        '''
+
+        pass
+
+    def invoke(self, frame, trace):
+        ''' Runs the model on a frame and publishes the result.
+
+        Args:
+            frame (array[int]): An image from 0-255.
+            trace: FrameTrace of the frame. A copy is published with the result.
+
+        Returns:
+            The prediction.
+
+        '''
+
+        trace = trace.copy()
+        self.pred = self.engine.invoke(frame)
+        trace.stamp("inference_" + self.name)
+        self.inferences.inc()
+
+        self.thread_manager.set((self.pred, frame, trace))
+
+        return self.pred
+
+    def get_prediction(self):
+        return self.thread_manager.wait()
+
+    def get_max_length(self):
+        return self.engine.get_max_length()
+
+    def label(self, label_id):
+        return self.engine.label(label_id)
+
+    def start(self):
+        ''' Does nothing. The results come from the multiplexer thread.
+        '''
+
+        pass
+
+
+class EngineMultiplexer(object):
+    ''' Schedules camera frames across several engines.
+
+    The first model is the primary model. Iterating over the multiplexer yields the primary
+    model's results, like a ThreadedEngine does.
+
+    Attributes:
+        source: The image source.
+        outputs (dict): ModelOutput of each model, in model order.
+        mode (str): Scheduling mode. See MODES.
+        rates (dict): Target rate in frames per second of each model, for the "rates" mode.
+        cascade (dict): The "gate" and "model" names plus the optional "labels" and
+            "min_score" the gate needs to find, for the "cascade" mode.
+        thread_manager: Manages the scheduling thread.
+
+    '''
+
+    MODES = ("round_robin", "rates", "cascade")
+
+    def __init__(self,
+                 source,
+                 engines,
+                 mode="round_robin",
+                 rates=None,
+                 cascade=None):
+        ''' Creates an output for every engine.
+
+        Args:
+            source: The image source.
+            engines (dict): Inference engine of each model name. The first is the primary.
+            mode (str): Scheduling mode. See MODES.
+            rates (dict, optional): Target rate of each model in frames per second.
+            cascade (dict, optional): Cascade settings. Needs the "gate" and "model" names.
+
+        Raises:
+            ValueError: The mode or its settings are not valid.
+
+        '''
+
+        if mode not in self.MODES:
+            raise ValueError("Multiplexer mode not supported: {}".format(mode))
+
+        if not engines:
+            raise ValueError("The multiplexer needs at least one engine.")
+
+        self.source = source
+        self.outputs = {name: ModelOutput(name, engine) for name, engine in engines.items()}
+        self.names = list(self.outputs)
+        self.mode = mode
+        self.rates = rates or {}
+        self.cascade = cascade or {}
+
+        if mode == "cascade" and not (self.cascade.get("gate") in self.outputs and
+                                      self.cascade.get("model") in self.outputs):
+            raise ValueError("The cascade needs the names of a gate model and a model.")
+
+        # Time each rated model is due to run next
+        self.due = {name: 0.0 for name in self.rates}
+        self.turn = 0
+
+        self.thread_manager = ThreadManager(self)
+
+    def __next__(self):
+        return self.get_prediction()
+
+    def primary(self):
+        return self.outputs[self.names[0]]
+
+    def _thread(self):
+        last_frame_id = None
+        while True:
+            frame, trace = self.source.read()
+            last_frame_id = tracer.count_drops("engine", last_frame_id, trace)
+            trace.stamp("engine_queue")
+
+            self.run(frame, trace)
+
+    def run(self, frame, trace):
+        ''' Runs the models picked by the scheduling mode on one frame.
+
+        Returns:
+            List of the names of the models that ran.
+
+        '''
+
+        if self.mode == "round_robin":
+            name = self.names[self.turn % len(self.names)]
+            self.turn += 1
+            self.outputs[name].invoke(frame, trace)
+            return [name]
+
+        if self.mode == "rates":
+            names = self.due_models()
+            for name in names:
+                self.outputs[name].invoke(frame, trace)
+            return names
+
+        # Cascade: the gate runs on every frame, the model only when the gate found something
+        gate, model = self.cascade["gate"], self.cascade["model"]
+        ran = []
+        for name in self.names:
+            if name == model:
+                continue
+
+            pred = self.outputs[name].invoke(frame, trace)
+            ran.append(name)
+
+            if name == gate and self.gate_passed(pred):
+                self.outputs[model].invoke(frame, trace)
+                ran.append(model)
+
+        return ran
+
+    def due_models(self):
+        ''' Returns the models that are due to run, most overdue first, and schedules their next
+        run.
+        '''
+
+        now = time.monotonic()
+
+        rated = sorted((due, name) for name, due in self.due.items() if due <= now)
+        for due, name in rated:
+            interval = 1.0 / self.rates[name]
+
+            # Don't run a burst of frames to catch up after a slow frame (or the first run)
+            self.due[name] = due + interval if due + interval > now else now + interval
+
+        return ([name for _, name in rated] +
+                [name for name in self.names if name not in self.rates])
+
+    def gate_passed(self, pred):
+        ''' Checks whether the gate prediction has a result with a wanted label and score.
+
+        Works with both Detections and lists of Classifications.
+
+        '''
+
+        labels = self.cascade.get("labels")
+        min_score = self.cascade.get("min_score", 0.0)
+
+        if hasattr(pred, "label_ids"):
+            results = zip(pred.label_ids(), pred.scores())
+        else:
+            results = pred
+
+        return any((labels is None or int(label_id) in labels) and score >= min_score
+                   for label_id, score in results)
+
+    def get_prediction(self):
+        ''' Returns the newest (prediction, frame, trace) of the primary model.
+        '''
+
+        return self.primary().get_prediction()
+
+    def get_max_length(self):
+        return self.primary().get_max_length()
+
+    def label(self, label_id):
+        return self.primary().label(label_id)
+
+    def start(self):
+        self.thread_manager.start()
@@ -4,6 +4,9 @@ Each step of the pipeline must follow the base class interface defined in the ot
 
 '''
 
+import tracing
+
+
 # TODO: Add the ability to add a stream or display while running inference
 class Pipeline(object):
     '''Runs end-to-end inference.
@@ -13,26 +16,44 @@ class Pipeline(object):
         engine: The inference engine.
         postprocessor: Processes the inference predictions for streaming.
         streams: One or multiple streams for the data.
+        video_stream: MJPEGBroadcaster for video clients, if the video stream is enabled.
+        postprocessors (dict): Postprocessor of each model when several models are run.
+        video_streams (dict): MJPEGBroadcaster of each model or camera when several models or
+            cameras are run.
+        sources (dict): Image source of each camera when several cameras are run.
+        quality_controller: QualityController that adjusts the quality to the load, if enabled.
     '''
 
     def __init__(self,
                  source,
                  engine,
                  postprocessor,
-                 streams = []):
+                 streams = [],
+                 video_stream=None,
+                 postprocessors=None,
+                 video_streams=None,
+                 sources=None,
+                 quality_controller=None):
         
         self.source = source
         self.engine = engine
         self.postprocessor = postprocessor
         self.streams = streams
+        self.video_stream = video_stream
+        self.postprocessors = postprocessors or {"postprocessor": postprocessor}
+        self.video_streams = video_streams or {}
+        self.sources = sources or {"source": source}
+        self.quality_controller = quality_controller
 
     def start(self):
         ''' Start all the pipeline stages.
         '''
 
-        self.source.start()
+        for source in self.sources.values():
+            source.start()
         self.engine.start()
-        self.postprocessor.start()
+        for postprocessor in self.postprocessors.values():
+            postprocessor.start()
 
         if isinstance(self.streams, list):
             for stream in self.streams:
@@ -40,6 +61,9 @@ class Pipeline(object):
         elif self.streams:
             self.streams.start()
 
+        if self.quality_controller is not None:
+            self.quality_controller.start()
+
     def get_source_frame(self):
         ''' Return the original image.
         '''
@@ -57,3 +81,9 @@ class Pipeline(object):
         '''
         
         return self.postprocessor.frame_tobytes()
+
+    def get_stats(self):
+        ''' Return the per-stage latency percentiles and dropped frame counters.
+        '''
+
+        return tracing.tracer.summary()
@@ -5,6 +5,7 @@ tasks. The class heirarchy can be extended by creating a child class that define
 creating a source, engine, postprocessor, and stream(s).
 
 Classes:
+    RestartRequiredError: New params that the running pipeline can't apply.
     PipelineFactory: Abstract factory defining the interface for all child classes.
     DetectionPipelineFactory: Creates a pipeline for performing object detection.
 
@@ -13,19 +14,31 @@ Classes:
 from abc import abstractmethod
 
 import camera
+import camera_scheduler
 import engine
 import threaded_engine
+import motion_gate
+import multiplexer
+import tracker
 import postprocessor
+import spi_codec
 import stream_spi
 import pipeline
+import process_pipeline
+import mjpeg
+import model_cache
+import quality_controller
 
 instance = None # Only one factory allowed per program.
 
 def get_instance(task):
     ''' Create or return the instance of the factory.
 
-    The factory must be a singleton so that only one pipeline can be made. Currently, there is no 
-    way to run inference with multiple models on the same edge TPU.
+    The factory must be a singleton so that only one pipeline can be made. To run several models
+    on the same Edge TPU, configure them under "models" in the pipeline params. The pipeline then
+    uses an EngineMultiplexer that schedules the frames across the models in a single thread. To
+    run several cameras through one engine, configure them under "sources". The pipeline then uses
+    a CameraScheduler that picks the next frame across the cameras.
 
     Args:
         task (str): The inference task to be performed. Currently only supports "detection"
@@ -44,6 +57,21 @@ def get_instance(task):
     return instance
 
 
+class RestartRequiredError(RuntimeError):
+    ''' New params that the running pipeline can't apply. The app has to restart for them.
+
+    Attributes:
+        keys (list[str]): The params that changed.
+
+    '''
+
+    def __init__(self, keys):
+        self.keys = keys
+
+        super(RestartRequiredError, self).__init__(
+            "Changing {} needs a restart of the app.".format(", ".join(keys)))
+
+
 class PipelineFactory(object):
     ''' Abstract base class for pipeline factories.
 
@@ -53,6 +81,7 @@ class PipelineFactory(object):
 
     def __init__(self):
         self.pipeline = None
+        self.params = None
 
     @abstractmethod
     def create_pipeline(self, params):
@@ -63,6 +92,7 @@ class PipelineFactory(object):
 
         {
             "app_params" : {
+                "mode" : "threaded",
                 "source" : {
                     "param_1" : "val_1",
                     "param_2" : "val_2"
@@ -78,6 +108,37 @@ class PipelineFactory(object):
             }
         }
 
+        The optional "mode" selects how the stages run: "threaded" (default) runs every stage
+        as a thread in this process, "multiprocess" runs the source, engine, and postprocessor
+        in separate processes that share frames through shared memory. The optional
+        "multiprocess" dictionary sets "frame_slots" and "max_resolution" for that mode. It runs
+        a single source and model, so it can't be combined with "models" or "sources".
+
+        To run several models, replace "engine" with a "models" dictionary of engine params per
+        model name. Each model gets its own postprocessor and video stream. The optional
+        "multiplexer" dictionary sets the scheduling "mode" ("round_robin", "rates" or
+        "cascade"), the "rates" of the models, the "cascade" settings and the "spi_model" whose
+        results are sent over SPI (the first model by default). See EngineMultiplexer.
+
+        To run several cameras through one engine, replace "source" with a "sources" dictionary
+        of source params per camera ID. Each camera gets its own postprocessor and video stream.
+        The optional "scheduler" dictionary sets the scheduling "mode" ("fair_share" or
+        "deadline"), the "weights" and "deadlines" of the cameras and the "spi_source" whose
+        results are sent over SPI (the first camera by default). The optional engine "batch"
+        dictionary sets the "max_batch_size" of the frames of several cameras run together and
+        the "max_wait" in seconds of a batch that isn't full. See CameraScheduler.
+
+        The optional "spi" dictionary sets the "keyframe_interval" and "delta_tolerance" of the
+        SPI stream when the postprocessor "spi_format" is "delta". See spi_codec.
+
+        The optional "model_cache" dictionary sets the "memory_budget_mb" of the models that are
+        kept loaded for switching back to them (256 by default). See ModelCache.
+
+        The optional "quality" dictionary turns on the QualityController of the threaded
+        single-camera, single-model pipeline. It lowers the quality when the pipeline misses
+        its "target_latency" (seconds, 0.2 by default) or "target_fps" (none by default), and
+        raises it again once there is headroom. See create_quality_controller().
+
         Refer to app_param_options.json for all possible params and their values.
 
         Args:
@@ -108,25 +169,40 @@ class PipelineFactory(object):
         pass
 
     @abstractmethod
-    def create_postprocessor(self, source, params):
+    def create_inference_engine(self, params):
+        ''' Creates the bare inference engine without a thread around it.
+
+        Args:
+            params: Dictionary of parameters to be set.
+
+        '''
+        pass
+
+    @abstractmethod
+    def create_postprocessor(self, source, params, name="postprocessor", task="detection"):
         ''' Creates the postprocessor.
 
         Args:
             source: inference engine source.
             params: Dictionary of parameters to be set.
+            name (str): Name of the postprocessor in the latency traces and drop counters.
+            task (str): Inference task of the source, "detection" or "classification".
 
         '''
         pass
 
     @abstractmethod
-    def create_streams(self, use_spi, use_flask):
+    def create_streams(self, use_spi, use_flask, spi_params=None):
         ''' Creates the data streams.
 
-        Currently only supports either Arduino SPI or flask video stream.
+        Currently only supports either Arduino SPI or flask video stream. The flask video stream
+        is an MJPEGBroadcaster that is also stored as the video_stream of the factory.
 
         Args:
             use_spi (bool): True for Arduino data stream.
             use_flask (bool): True for Flask data stream.
+            spi_params (dict, optional): Options of the SPI stream, the "keyframe_interval" and
+                "delta_tolerance" of the delta data type.
         
         '''
         pass
@@ -140,6 +216,9 @@ class DetectionPipelineFactory(PipelineFactory):
 
         super(DetectionPipelineFactory, self).__init__()
 
+        # Engines are reused by content, see create_inference_engine()
+        self.model_cache = model_cache.ModelCache()
+
     def get_pipeline(self):
         return self.pipeline
 
@@ -148,47 +227,633 @@ class DetectionPipelineFactory(PipelineFactory):
         if self.pipeline:
             return self.pipeline
 
+        self.params = params
+
+        if "model_cache" in params:
+            self.model_cache.memory_budget = int(
+                params["model_cache"].get("memory_budget_mb", 256) * 1024 * 1024)
+
+        if params.get("mode", "threaded") == "multiprocess":
+            # The process pipeline runs one source and one model
+            if "models" in params or "sources" in params:
+                raise ValueError("The multiprocess mode doesn't support \"models\" or "
+                                 "\"sources\". Use the threaded mode.")
+            return self.create_process_pipeline(params)
+
+        if "models" in params:
+            return self.create_multiplexed_pipeline(params)
+
+        if "sources" in params:
+            return self.create_multi_source_pipeline(params)
+
         # Create source
         self.source = self.create_source(params["source"])
 
         # Create engine
         self.engine = self.create_engine(self.source, params["engine"])
+        self.fit_capture_size(self.source, params["source"], self.engine, params)
 
         # Create postprocessor
         self.postprocessor = self.create_postprocessor(self.engine, params["postprocessor"])
 
         # Create streams
-        self.streams = self.create_streams(params["stream_spi"], params["stream_flask"])
+        self.streams = self.create_streams(params["stream_spi"], params["stream_flask"],
+                                           params.get("spi"))
+
+        # Optionally adjust the quality to the load
+        controller = None
+        if "quality" in params:
+            controller = self.create_quality_controller(params["quality"], params)
 
         # Create inference pipeline
         self.pipeline = pipeline.Pipeline(self.source,
                                           self.engine,
                                           self.postprocessor,
-                                          self.streams)
+                                          self.streams,
+                                          self.video_stream,
+                                          quality_controller=controller)
+
+        return self.pipeline
+
+    def update_pipeline(self, params):
+        ''' Applies new params to the running pipeline, or creates the pipeline.
+
+        The whole config is compared with the running one. A change of the "engine" params
+        alone is applied with a hot model swap, so the camera and the streams keep running. Any
+        other change, and any change of a pipeline with several models, cameras or processes,
+        needs a restart of the app and is rejected without touching the pipeline. The new params
+        are only kept once the swap succeeded, so a failed swap leaves the pipeline and its
+        params as they were.
+
+        Args:
+            params: A dictionary of parameters for the pipeline.
+
+        Returns:
+            Tuple of (pipeline, True if the model was swapped).
+
+        Raises:
+            RestartRequiredError: The changed params can't be applied to the running pipeline.
+            ValueError: The new model can't be loaded or can't replace the running one.
+            TimeoutError: The engine thread didn't switch to the new model in time.
+
+        '''
+
+        if not self.pipeline:
+            return self.create_pipeline(params), False
+
+        changed = sorted(key for key in set(params) | set(self.params)
+                         if params.get(key) != self.params.get(key))
+        if not changed:
+            return self.pipeline, False
+
+        swappable = isinstance(getattr(self, "engine", None), threaded_engine.ThreadedEngine)
+        if changed != ["engine"] or not swappable:
+            raise RestartRequiredError(changed)
+
+        self.swap_engine(params["engine"])
+        self.params = dict(self.params, engine=params["engine"])
+
+        return self.pipeline, True
+
+    def swap_engine(self, params, warmup_frames=3, timeout=10.0):
+        ''' Loads a new model and swaps it into the running pipeline.
+
+        The old model keeps running the frames while the new one is loaded and warmed up. Blocks
+        until the engine thread switched, so errors reach the caller. See
+        ThreadedEngine.swap_engine().
+
+        Args:
+            params: Dictionary of engine parameters. top_k defaults to the running model's.
+            warmup_frames (int): Number of inferences run before the switch.
+            timeout (float): Longest time in seconds to wait for the engine thread to switch.
+
+        Returns:
+            The new engine.
+
+        Raises:
+            ValueError: The pipeline can't swap models, or the new model can't be loaded or has
+                a different top_k.
+            TimeoutError: The engine thread didn't switch in time. The old model keeps running.
+
+        '''
+
+        threaded = getattr(self, "engine", None)
+        if not isinstance(threaded, threaded_engine.ThreadedEngine):
+            raise ValueError("Hot model swaps need the threaded single-model pipeline.")
+
+        params = dict(params)
+        params.setdefault("top_k", threaded.get_max_length())
+        if params["top_k"] != threaded.get_max_length():
+            raise ValueError("The new model must keep top_k at {}.".format(
+                threaded.get_max_length()))
+
+        try:
+            new_engine = self.create_engine_stack(params)
+        except KeyError as e:
+            raise ValueError("The engine params are missing {}.".format(e))
+        except RuntimeError as e:
+            raise ValueError("Cannot load the new model: {}".format(e))
+
+        try:
+            old_engine = threaded.swap_engine(new_engine, warmup_frames, timeout=timeout)
+        except Exception:
+            # Keep the new model loaded in case the swap is retried
+            self.model_cache.release(self.inference_engine(new_engine))
+            raise
+
+        # The cache owns the old model from now on. It stays loaded in case the config switches
+        # back to it, and is closed once it is evicted.
+        self.model_cache.release(self.inference_engine(old_engine))
+
+        print("Swapped to model {}".format(params.get("model_path", params.get("type"))))
+
+        return new_engine
+
+    def inference_engine(self, engine):
+        ''' Returns the inference engine inside the tracking around it.
+        '''
+
+        while isinstance(engine, tracker.TrackingDetector):
+            engine = engine.engine
+
+        return engine
+
+    def create_process_pipeline(self, params):
+        ''' Creates a pipeline that runs the source, engine, and postprocessor in separate
+        processes.
+
+        The stages are created inside their own processes by calling the same factory methods
+        that the threaded pipeline uses.
+
+        Args:
+            params: A dictionary of parameters for creating the pipeline.
+
+        '''
+
+        process_params = params.get("multiprocess", {})
+        output_resolution = postprocessor.parse_resolution(
+            params["postprocessor"]["output_resolution"])
+        max_resolution = postprocessor.parse_resolution(
+            process_params.get("max_resolution", "1920x1080"))
+        flatten_length = params["engine"]["top_k"] * postprocessor.DetectionPostProcessor.ELEMENTS
+        data_format = spi_codec.parse_format(params["postprocessor"].get("spi_format",
+                                                                         "float32"))
+        codec = spi_codec.create_codec(data_format,
+                                       postprocessor.DetectionPostProcessor.COMPACT_DTYPE)
+        format_message = spi_codec.format_message(data_format,
+                                                  params["engine"]["top_k"],
+                                                  postprocessor.DetectionPostProcessor.ELEMENTS,
+                                                  codec.record_size if codec else 0)
+
+        self.pipeline = process_pipeline.ProcessPipeline(self,
+                                                         params,
+                                                         flatten_length,
+                                                         format_message=format_message,
+                                                         codec=codec,
+                                                         frame_slots=process_params.get(
+                                                             "frame_slots", 4),
+                                                         max_resolution=max_resolution,
+                                                         output_resolution=output_resolution)
+        self.postprocessor = self.pipeline.postprocessor
+
+        # Create streams
+        self.pipeline.streams = self.create_streams(params["stream_spi"], params["stream_flask"],
+                                                    params.get("spi"))
+        self.pipeline.video_stream = self.video_stream
+
+        return self.pipeline
+
+    def create_multiplexed_pipeline(self, params):
+        ''' Creates a pipeline that runs several models on the frames of one source.
+
+        Args:
+            params: A dictionary of parameters for creating the pipeline.
+
+        '''
+
+        multiplexer_params = params.get("multiplexer", {})
+
+        self.source = self.create_source(params["source"])
+
+        engines = {name: self.create_inference_engine(model_params)
+                   for name, model_params in params["models"].items()}
+        self.engine = multiplexer.EngineMultiplexer(self.source,
+                                                    engines,
+                                                    mode=multiplexer_params.get("mode",
+                                                                                "round_robin"),
+                                                    rates=multiplexer_params.get("rates"),
+                                                    cascade=multiplexer_params.get("cascade"))
+
+        postprocessors = {}
+        video_streams = {}
+        streams = []
+        for name, output in self.engine.outputs.items():
+            postprocessors[name] = self.create_postprocessor(output,
+                                                             params["postprocessor"],
+                                                             name=name,
+                                                             task=params["models"][name].get(
+                                                                 "task", "detection"))
+            if params["stream_flask"]:
+                video_streams[name] = mjpeg.MJPEGBroadcaster(postprocessors[name])
+                streams.append(video_streams[name])
+
+        # Only one model can use the SPI bus
+        self.postprocessor = postprocessors[multiplexer_params.get("spi_model",
+                                                                   self.engine.names[0])]
+        if params["stream_spi"]:
+            streams.append(stream_spi.SPIComms(self.postprocessor, **params.get("spi", {})))
+
+        self.video_stream = video_streams.get(self.engine.names[0])
+        self.streams = streams
+
+        self.pipeline = pipeline.Pipeline(self.source,
+                                          self.engine,
+                                          self.postprocessor,
+                                          self.streams,
+                                          self.video_stream,
+                                          postprocessors=postprocessors,
+                                          video_streams=video_streams)
+
+        return self.pipeline
+
+    def create_multi_source_pipeline(self, params):
+        ''' Creates a pipeline that runs the frames of several sources through one engine.
+
+        The engine is shared by every camera, so tracking and the motion gate are not used.
+
+        Args:
+            params: A dictionary of parameters for creating the pipeline.
+
+        '''
+
+        scheduler_params = params.get("scheduler", {})
+        batch_params = params["engine"].get("batch", {})
+
+        self.sources = {source_id: self.create_source(source_params)
+                        for source_id, source_params in params["sources"].items()}
+        self.engine = camera_scheduler.CameraScheduler(
+            self.sources,
+            self.create_inference_engine(params["engine"]),
+            mode=scheduler_params.get("mode", "fair_share"),
+            weights=scheduler_params.get("weights"),
+            deadlines=scheduler_params.get("deadlines"),
+            max_batch_size=batch_params.get("max_batch_size", 1),
+            max_wait=batch_params.get("max_wait", 0.0))
+        self.source = self.sources[self.engine.ids[0]]
+        for source_id, source in self.sources.items():
+            self.fit_capture_size(source, params["sources"][source_id], self.engine.engine,
+                                  params)
+
+        postprocessors = {}
+        video_streams = {}
+        streams = []
+        for source_id, output in self.engine.outputs.items():
+            postprocessors[source_id] = self.create_postprocessor(
+                output,
+                params["postprocessor"],
+                name="postprocessor_{}".format(source_id),
+                task=params["engine"].get("task", "detection"))
+            if params["stream_flask"]:
+                video_streams[source_id] = mjpeg.MJPEGBroadcaster(postprocessors[source_id])
+                streams.append(video_streams[source_id])
+
+        # Only one camera can use the SPI bus
+        self.postprocessor = postprocessors[scheduler_params.get("spi_source",
+                                                                 self.engine.ids[0])]
+        if params["stream_spi"]:
+            streams.append(stream_spi.SPIComms(self.postprocessor, **params.get("spi", {})))
+
+        self.video_stream = video_streams.get(self.engine.ids[0])
+        self.streams = streams
+
+        self.pipeline = pipeline.Pipeline(self.source,
+                                          self.engine,
+                                          self.postprocessor,
+                                          self.streams,
+                                          self.video_stream,
+                                          postprocessors=postprocessors,
+                                          video_streams=video_streams,
+                                          sources=self.sources)
 
         return self.pipeline
 
     def create_source(self, params):
-        return camera.OpenCVCamera(source=params["source"])
+        ''' Creates the image source.
+
+        The optional "type" param selects the source: "camera" (default) streams from a
+        /dev/videoX device, "video" replays a video file and "images" replays the images in a
+        directory. The camera accepts the optional "resolution" ('WIDTHxHEIGHT', or "auto" to
+        fit it to the model and output, see fit_capture_size(); the driver's choice if not set),
+        "fps" and "format" ("MJPG" or "YUYV") params, which are negotiated with the driver. The
+        replay sources accept the optional "fps" (replay rate, as fast as possible if not set),
+        "loop", "lockstep", "prefetch" and "pool_size" params. The "images" source also accepts
+        "workers".
+
+        Args:
+            params: Dictionary of parameters to be set.
+
+        '''
+
+        source_type = params.get("type", "camera")
+
+        if source_type == "camera":
+            resolution = params.get("resolution")
+            return camera.OpenCVCamera(
+                source=params["source"],
+                resolution=(postprocessor.parse_resolution(resolution)
+                            if resolution not in (None, "auto") else None),
+                fps=params.get("fps"),
+                pixel_format=params.get("format"))
+
+        replay_params = {"fps": params.get("fps"),
+                         "loop": params.get("loop", False),
+                         "lockstep": params.get("lockstep", False),
+                         "prefetch": params.get("prefetch", 4),
+                         "pool_size": params.get("pool_size", 16)}
+
+        if source_type == "video":
+            return camera.VideoFileSource(params["source"], **replay_params)
+        elif source_type == "images":
+            return camera.ImageDirectorySource(params["source"],
+                                               workers=params.get("workers", 2),
+                                               **replay_params)
+        else:
+            raise ValueError("Source type not supported: {}".format(source_type))
+
+    def create_inference_engine(self, params):
+        ''' Returns a loaded and warmed up engine from the model cache.
+
+        Models with the same content and params are only loaded once, see ModelCache. The
+        engine is loaded with load_inference_engine() if the cache has no idle one.
+
+        Args:
+            params: Dictionary of parameters to be set.
+
+        '''
+
+        return self.model_cache.acquire(params, self.load_inference_engine)
+
+    def load_inference_engine(self, params):
+        ''' Creates the detection engine.
+
+        The optional "type" param selects the engine: "edgetpu" (default) uses the Edge TPU
+        library, "tflite" uses the TFLite interpreter, which also runs on machines without an
+        Edge TPU. With "task" set to "classification", a TFLiteClassificationEngine is created
+        instead. The TFLite engine accepts the optional "num_threads", "use_xnnpack" and
+        "use_edgetpu" params. "simulated" needs no model and accepts the optional "latency",
+        "jitter", "distribution", "detections" and "seed" params (see SimulatedEngine).
+
+        Args:
+            params: Dictionary of parameters to be set.
+
+        '''
+
+        engine_type = params.get("type", "edgetpu")
+
+        if params.get("task", "detection") == "classification":
+            # Classification always runs on the TFLite interpreter, with the Edge TPU delegate
+            # unless the type is "tflite"
+            return engine.TFLiteClassificationEngine(
+                model_path=params["model_path"],
+                label_path=params.get("label_path", ""),
+                top_k=params.get("top_k", 1),
+                threshold=params.get("threshold", 0.0),
+                num_threads=params.get("num_threads"),
+                use_xnnpack=params.get("use_xnnpack", True),
+                use_edgetpu=params.get("use_edgetpu", engine_type == "edgetpu"))
+
+        if engine_type == "edgetpu":
+            return engine.DetectionEngine(model_path=params["model_path"],
+                                          label_path=params["label_path"],
+                                          top_k=params["top_k"],
+                                          threshold=params["threshold"])
+        elif engine_type == "tflite":
+            return engine.TFLiteDetectionEngine(model_path=params["model_path"],
+                                                label_path=params["label_path"],
+                                                top_k=params["top_k"],
+                                                threshold=params["threshold"],
+                                                num_threads=params.get("num_threads"),
+                                                use_xnnpack=params.get("use_xnnpack", True),
+                                                use_edgetpu=params.get("use_edgetpu", False))
+        elif engine_type == "simulated":
+            return engine.SimulatedEngine(latency=params.get("latency", 0.015),
+                                          jitter=params.get("jitter", 0.0),
+                                          distribution=params.get("distribution", "normal"),
+                                          detections=params.get("detections", 3),
+                                          top_k=params["top_k"],
+                                          seed=params.get("seed"))
+        else:
+            raise ValueError("Engine type not supported: {}".format(engine_type))
 
     def create_engine(self, source, params):
-        detection_engine = engine.DetectionEngine(model_path=params["model_path"],
-                                                  label_path=params["label_path"],
-                                                  top_k=params["top_k"],
-                                                  threshold=params["threshold"])
+        return threaded_engine.ThreadedEngine(source,
+                                              self.create_engine_stack(params),
+                                              motion_gate=self.create_motion_gate(params))
+
+    def create_engine_stack(self, params):
+        ''' Creates the inference engine with the optional tracking around it.
+
+        Args:
+            params: Dictionary of engine parameters.
+
+        Raises:
+            ValueError: The params ask for batching, which needs several sources.
+
+        '''
+
+        # One camera hands the engine one frame at a time, so a batch would never fill up
+        if "batch" in params:
+            raise ValueError("Batching needs several cameras. Use \"sources\" to batch their "
+                             "frames.")
+
+        return self.add_tracking(self.create_inference_engine(params), params)
+
+    def fit_capture_size(self, source, source_params, inference_engine, params):
+        ''' Lowers the camera resolution to what the model and the video stream use.
+
+        Only applies to cameras whose "resolution" param is "auto". The camera keeps the aspect
+        ratio of its default mode and is scaled to the smallest size that covers the model input
+        and, with the video stream on, the output resolution. Pixels beyond that would only be
+        thrown away by the resizes.
+
+        Args:
+            source: The image source.
+            source_params: Dictionary of source parameters.
+            inference_engine: The engine, or anything that wraps it.
+            params: Dictionary of pipeline parameters.
+
+        Returns:
+            The granted resolution, or None if the source was not resized.
+
+        '''
+
+        if (not isinstance(source, camera.OpenCVCamera) or
+                source_params.get("resolution") != "auto"):
+            return None
+
+        # Find the engine that resizes the frames
+        while not hasattr(inference_engine, "preprocessor") and hasattr(inference_engine,
+                                                                         "engine"):
+            inference_engine = inference_engine.engine
+        preprocessor = getattr(inference_engine, "preprocessor", None)
+        if preprocessor is None:
+            return None
+
+        needed = preprocessor.model_size
+        if params.get("stream_flask"):
+            output = postprocessor.parse_resolution(params["postprocessor"]["output_resolution"])
+            needed = (max(needed[0], output[0]), max(needed[1], output[1]))
+
+        width, height = source.get_resolution()
+        scale = min(max(needed[0] / width, needed[1] / height), 1.0)
+        size = (int(-(-width * scale // 2) * 2), int(-(-height * scale // 2) * 2))
+        if size == (width, height):
+            return None
+
+        granted = source.negotiate(resolution=size)["resolution"]
+
+        # The driver may snap to a mode below what the model or the stream need
+        if granted[0] < needed[0] or granted[1] < needed[1]:
+            granted = source.negotiate(resolution=(width, height))["resolution"]
+            print("Camera has no mode between {}x{} and {}x{}, keeping {}x{}".format(
+                needed[0], needed[1], width, height, granted[0], granted[1]))
+            return None
+
+        print("Capturing at {}x{} for model input {}x{}".format(granted[0], granted[1],
+                                                             *preprocessor.model_size))
+
+        return granted
+
+    def create_quality_controller(self, quality_params, params):
+        ''' Creates the QualityController of the threaded single-model pipeline.
+
+        The "knobs" param lists the knobs in the order they are lowered, by default
+        "jpeg_quality", "output_resolution", "stride", "top_k" and "capture_resolution". The
+        video stream knobs are only used with "stream_flask" on, and "capture_resolution" only
+        with a camera. The controller also accepts the optional "target_latency",
+        "target_fps", "interval", "margin", "degrade_after" and "upgrade_after" params.
+
+        Args:
+            quality_params: Dictionary of quality controller parameters.
+            params: Dictionary of pipeline parameters.
+
+        Returns:
+            The QualityController.
+
+        Raises:
+            ValueError: A knob is not supported.
+
+        '''
+
+        knobs = []
+        for name in quality_params.get("knobs", quality_controller.DEFAULT_KNOBS):
+            if name == "jpeg_quality":
+                if params.get("stream_flask"):
+                    knobs.append(quality_controller.jpeg_quality_knob(self.postprocessor))
+            elif name == "output_resolution":
+                if params.get("stream_flask"):
+                    knobs.append(quality_controller.output_resolution_knob(self.postprocessor))
+            elif name == "stride":
+                knobs.append(quality_controller.stride_knob(self.engine))
+            elif name == "top_k":
+                knobs.append(quality_controller.top_k_knob(self.engine))
+            elif name == "capture_resolution":
+                if isinstance(self.source, camera.OpenCVCamera):
+                    knobs.append(quality_controller.capture_resolution_knob(self.source))
+            else:
+                raise ValueError("Quality knob not supported: {}".format(name))
+
+        return quality_controller.QualityController(
+            knobs,
+            target_latency=quality_params.get("target_latency", 0.2),
+            target_fps=quality_params.get("target_fps"),
+            interval=quality_params.get("interval", 1.0),
+            margin=quality_params.get("margin", 0.2),
+            degrade_after=quality_params.get("degrade_after", 2),
+            upgrade_after=quality_params.get("upgrade_after", 5))
+
+    def create_motion_gate(self, params):
+        ''' Creates a MotionGate if the params have a "motion_gate" dictionary.
+
+        The gate skips inference on frames that did not change. It accepts the optional
+        "pixel_threshold" (default 25) and "area_threshold" (default 0.01) sensitivity params
+        and "refresh_interval", the longest time in seconds between inferences (default 5).
+
+        Args:
+            params: Dictionary of engine parameters.
+
+        Returns:
+            The MotionGate, or None if the gate is not configured.
+
+        '''
+
+        if "motion_gate" not in params:
+            return None
+
+        gate_params = params["motion_gate"]
+        return motion_gate.MotionGate(pixel_threshold=gate_params.get("pixel_threshold", 25),
+                                      area_threshold=gate_params.get("area_threshold", 0.01),
+                                      refresh_interval=gate_params.get("refresh_interval", 5.0))
+
+    def add_tracking(self, inference_engine, params):
+        ''' Wraps the engine in a TrackingDetector if the params have a "tracker" dictionary.
+
+        The tracker runs the detector every "detect_every" frames (default 3), or early once a
+        track's confidence drops below "min_confidence" (default 0.3), and tracks the objects in
+        between. It also accepts the optional "iou_threshold", "max_misses" and "decay" params.
+
+        Args:
+            inference_engine: The detection engine.
+            params: Dictionary of engine parameters.
+
+        Returns:
+            The TrackingDetector, or the engine if tracking is not configured.
+
+        '''
+
+        if "tracker" not in params:
+            return inference_engine
+
+        tracker_params = params["tracker"]
+        return tracker.TrackingDetector(
+            inference_engine,
+            detect_every=tracker_params.get("detect_every", 3),
+            min_confidence=tracker_params.get("min_confidence", 0.3),
+            iou_threshold=tracker_params.get("iou_threshold", 0.3),
+            max_misses=tracker_params.get("max_misses", 2),
+            decay=tracker_params.get("decay", 0.9))
+
+    def create_postprocessor(self, source, params, name="postprocessor", task="detection"):
+        ''' Creates the postprocessor.
+
+        The optional "spi_format" param selects the SPI encoding: "float32" (default),
+        "compact" or "delta" (see spi_codec). The optional "jpeg_quality" param sets the
+        quality of the video stream from 0 to 100 (default 95).
+
+        '''
+
+        spi_format = params.get("spi_format", "float32")
+        jpeg_quality = params.get("jpeg_quality", 95)
 
-        return threaded_engine.ThreadedEngine(source, detection_engine)
+        if task == "classification":
+            return postprocessor.ClassificationPostProcessor(
+                source, output_resolution=params["output_resolution"], name=name,
+                spi_format=spi_format, jpeg_quality=jpeg_quality)
 
-    def create_postprocessor(self, source, params):
         return postprocessor.DetectionPostProcessor(source,
-                                                    output_resolution=params["output_resolution"])
+                                                    output_resolution=params["output_resolution"],
+                                                    name=name,
+                                                    spi_format=spi_format,
+                                                    jpeg_quality=jpeg_quality)
 
-    def create_streams(self, use_spi, use_flask):
+    def create_streams(self, use_spi, use_flask, spi_params=None):
         streams = []
+        self.video_stream = None
         if use_spi:
-            spi = stream_spi.SPIComms(self.postprocessor)
+            spi = stream_spi.SPIComms(self.postprocessor, **(spi_params or {}))
             streams.append(spi)
         if use_flask:
-            pass
+            self.video_stream = mjpeg.MJPEGBroadcaster(self.postprocessor)
+            streams.append(self.video_stream)
 
         return streams
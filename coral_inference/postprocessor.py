@@ -7,14 +7,41 @@ visualization.
 Classes:
     PostProcessor: Abstract base class.
     DetectionPostProcessor: Converts detection results into bytes and video streams.
+    ClassificationPostProcessor: Converts classification results into bytes and video streams.
 
 '''
 
 from abc import abstractmethod
+import time
 import cv2
 import numpy as np
 
+import spi_codec
 import thread_manager
+from ring_buffer import TripleBuffer
+from detections import FIELDS
+from tracing import tracer
+
+
+def parse_resolution(resolution):
+    ''' Parses a resolution string of the form 'WIDTHxHEIGHT'.
+
+    Args:
+        resolution (str): Resolution string.
+
+    Returns:
+        Tuple of (width, height).
+
+    Raises:
+        ValueError: Input string is not of the right form.
+
+    '''
+
+    try:
+        res_string = resolution.lower().split("x")
+        return (int(res_string[0]), int(res_string[1]))
+    except (ValueError, IndexError, AttributeError) as e:
+        raise ValueError("Resolution must be a string of the form 'WIDTHxHEIGHT'")
 
 
 class PostProcessor(object):
@@ -55,19 +82,15 @@ class PostProcessor(object):
 
         '''
 
-        try:
-            res_string = output_resolution.lower().split("x")
-            self.output_resolution = (int(res_string[0]), int(res_string[1]))
-        except (ValueError, IndexError, AttributeError) as e:
-            raise ValueError("Resolution must be a string of the form 'WIDTHxHEIGHT'")
+        self.output_resolution = parse_resolution(output_resolution)
 
     @abstractmethod
     def _thread(self):
         ''' Thread function that performs the postprocessing in a background thread.
 
         This function must have a for loop that continuously retrieves predictions from the 
-        results generator (defined below). It must then notify the thread manager that new results
-        have been received.
+        results generator (defined below). It must then publish the new results to the thread
+        manager.
 
         '''
         pass
@@ -87,72 +110,163 @@ class DetectionPostProcessor(PostProcessor):
         frame: Original input frame.
         elements: Number of elements per prediction for the flattened SPI data stream.
         flatten_length: Length of the flattened array that must be sent by the SPI stream.
+        name (str): Name of the postprocessor in the latency traces and drop counters.
+        data_format (int): SPI data type of the config message. See spi_codec.FORMATS.
+        codec: CompactCodec of the compact and delta SPI formats, None for the float32 format.
+        id_pool: IdPool that maps the track IDs to the one byte IDs of the delta format, None
+            for the other formats.
+        payload: TripleBuffer with the newest packed SPI data, None until the SPI stream asks
+            for it.
+        jpeg_quality (int): JPEG quality of the video stream from 0 to 100.
 
     '''
 
+    # Number of elements per prediction in the flattened SPI data stream
+    ELEMENTS = FIELDS
+
+    # Record layout of the compact SPI format
+    COMPACT_DTYPE = spi_codec.COMPACT_DETECTION_DTYPE
+
     def __init__(self,
                  source,
-                 output_resolution='640x480'):
+                 output_resolution='640x480',
+                 name="postprocessor",
+                 spi_format="float32",
+                 jpeg_quality=95):
 
         self.pred = None
         self.frame = None
+        self.name = name
 
-        self.elements = 5
+        self.elements = self.ELEMENTS
         self.flatten_length = source.get_max_length() * self.elements
 
+        self.data_format = spi_codec.parse_format(spi_format)
+        self.codec = spi_codec.create_codec(self.data_format, self.COMPACT_DTYPE)
+        self.id_pool = spi_codec.IdPool() if self.data_format == spi_codec.DELTA else None
+        self.payload = None
+
+        # Fails now instead of in the SPI stream when top_k is too large for the config message
+        self.get_format_message()
+        self.jpeg_quality = jpeg_quality
+
         super(DetectionPostProcessor, self).__init__(source,
                                                      output_resolution)
 
     def _thread(self):
         results = self.results_gen()
-        for pred, frame in results:
+        last_frame_id = None
+        for pred, frame, trace in results:
             self.pred = pred
             self.frame = frame
 
+            last_frame_id = tracer.count_drops(self.name, last_frame_id, trace)
+            trace.stamp("postprocess_queue")
+            tracer.record_trace(trace)
+
             # Set the input resolution if it hasn't been set
             if not self.input_resolution:
                 shape = np.shape(self.frame)
                 self.input_resolution = (shape[0], shape[1])
 
-            # Notify the listeners
-            self.thread_manager.set()
+            self.publish(pred, frame, trace)
+
+    def publish(self, pred, frame, trace):
+        ''' Publishes a result to the listeners and packs it for the SPI stream.
+        '''
+
+        # Packing here keeps the SPI stream from waiting on it
+        if self.payload is not None:
+            self.payload.write(self.pack(pred), trace)
+
+        self.thread_manager.set((pred, frame, trace))
+
+    def get_payload_buffer(self):
+        ''' Returns the TripleBuffer that every result is packed into from now on.
+        '''
+
+        if self.payload is None:
+            self.payload = TripleBuffer()
+
+        return self.payload
 
     def tobytes(self):
         ''' Flatten the detection results into a byte stream.
         
-        This method can be used to sent bytes over SPI. Each prediction result is a
-        DetectionCandidate object. Each object is taken an converted into 5 elements: the
-        label_id and the top-left and bottom-right bounding box coordinates. So, the total flattened
-        length is equal to 5 * the number of DetectionCandidate objects. This array is then 
-        converted to bytes.
+        This method can be used to sent bytes over SPI. Each prediction is a detection record of
+        6 float32 elements: the label_id, the score, and the top-left and bottom-right bounding
+        box coordinates. So, the total flattened length is equal to 6 * the maximum number of
+        detections. Empty slots are 0.
 
         Returns:
             Flattened predictions as bytes.
 
         '''
 
+        return self.read_bytes()[0]
+
+    def read_bytes(self, timeout=None):
+        ''' Waits for the newest prediction and flattens it into bytes.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait for a new prediction.
+
+        Returns:
+            Tuple of (flattened predictions as bytes, FrameTrace of the prediction), or None if
+            the timeout expired.
+
+        '''
+
         # Wait for the newest prediction
-        self.thread_manager.wait()
+        result = self.thread_manager.wait(timeout)
+        if result is None:
+            return None
+
+        pred, _, trace = result
+
+        return self.pack(pred), trace
+
+    def pack(self, pred):
+        ''' Flattens detections into bytes.
+
+        Does the work of tobytes() without waiting on the postprocessor thread, so it can be
+        used on results that were received some other way. The detection records already have
+        the float32 SPI layout, so this is a view cast of the records. The compact format only
+        encodes the valid records.
+
+        Args:
+            pred: Detections.
+
+        Returns:
+            Flattened predictions as bytes.
 
-        flattened_output = np.zeros(shape=(self.flatten_length,),
-                                    dtype=np.float32)
+        '''
 
-        i = 0
-        for pred in self.pred:
-            flattened_output[i * self.elements] = pred.label_id
-            flattened_output[i * self.elements + 1] = pred.bounding_box[0][0]
-            flattened_output[i * self.elements + 2] = pred.bounding_box[0][1]
-            flattened_output[i * self.elements + 3] = pred.bounding_box[1][0]
-            flattened_output[i * self.elements + 4] = pred.bounding_box[1][1]
-            i += 1
+        if self.codec is not None:
+            # Objects are identified by their track ID, or by their slot without a tracker
+            ids = pred.track_ids[:pred.count]
+            if not np.all(ids >= 0):
+                ids = np.arange(pred.count)
+            elif self.id_pool is not None:
+                ids = self.id_pool.assign(ids)
+            return self.codec.encode(pred.valid(), ids)
 
-        return flattened_output.tobytes()
+        return pred.tobytes()
+
+    def get_format_message(self):
+        ''' Return the SPI config message that describes the data layout.
+        '''
+
+        return spi_codec.format_message(self.data_format,
+                                        self.flatten_length // self.elements,
+                                        self.elements,
+                                        self.codec.record_size if self.codec else 0)
 
     def get_flatten_length(self):
         ''' Return the length of the flattened results for the SPI stream.
 
         This is needed since the SPI stream requires a static length. So, if the flatten length 
-        can handle a maximum of 5 detection candidates and only 3 are detected, then the last 10
+        can handle a maximum of 5 detection candidates and only 3 are detected, then the last 12
         elements will just be 0.
 
         '''
@@ -163,40 +277,51 @@ class DetectionPostProcessor(PostProcessor):
         ''' Scales the relative bounding box coordinates for the desired output resolution.
 
         Args:
-            coords (array[float]): The 4 bounding box coordinates from 0-1. Relative coordinates
+            coords (array[float]): (N, 4) bounding box coordinates from 0-1. Relative coordinates
                 allow for the bounding box to be easily scaled to whatever the output resolution is.
 
         Returns:
             Bounding box coordinates as integers scaled to the output resolution.
 
         '''
-        
-        scaled_coordinates = np.zeros(shape=(len(coords)))
-        for i, coord in enumerate(coords):
-            scaled_coordinates[i] = coord * self.output_resolution[i % 2]
 
-        return scaled_coordinates.astype("int")
+        width, height = self.output_resolution
+        return (coords * np.array([width, height, width, height])).astype("int")
 
     def visualize(self):
         ''' Draws bounding boxes and labels on the original image.
         '''
 
         # Wait for the newest prediction
-        self.thread_manager.wait()
+        pred, frame, _ = self.thread_manager.wait()
+
+        return self.render(pred, frame)
+
+    def render(self, pred, frame):
+        ''' Draws bounding boxes and labels on a copy of the given frame.
+
+        Args:
+            pred: Detections.
+            frame: The frame the predictions were made on.
+
+        Returns:
+            The annotated frame at the output resolution.
+
+        '''
 
         # Resize the image to the output resolution
-        output = cv2.resize(self.frame.copy(),
+        output = cv2.resize(frame,
                             self.output_resolution,
                             interpolation=cv2.INTER_AREA)
 
-        for pred in self.pred:
+        # Get the 4 bounding box coordinates of every detection at once
+        # (top-left x, top-left y, bottom-right x, bottom-right y)
+        boxes = self.scale_bounding_box(pred.boxes())
 
-            # Get the 4 bounding box coordinates 
-            # (top-left x, top-left y, bottom-right x, bottom-right y)
-            bb = self.scale_bounding_box(pred.bounding_box.flatten())
+        for label_id, bb in zip(pred.label_ids(), boxes):
 
             # Get the label corresponding to the prediction ID.
-            label = self.source.label(pred)
+            label = self.source.label(label_id)
            
             # Draw the bounding box and label text
             output = cv2.rectangle(output, (bb[0], bb[1]), (bb[2], bb[3]), (255, 255, 0), 2)
@@ -213,4 +338,82 @@ class DetectionPostProcessor(PostProcessor):
         ''' Encode the output frame into bytes.
         '''
         
-        return cv2.imencode('.jpg', self.visualize())[1].tobytes()
+        return self.read_frame_bytes()[0]
+
+    def read_frame_bytes(self):
+        ''' Waits for the newest prediction and encodes the output frame into bytes.
+
+        Returns:
+            Tuple of (encoded output frame, FrameTrace of the prediction).
+
+        '''
+
+        # Wait for the newest prediction
+        pred, frame, trace = self.thread_manager.wait()
+
+        return self.encode(self.render(pred, frame)), trace
+
+    def encode(self, image):
+        ''' Encode an image into JPEG bytes at the jpeg_quality.
+
+        The encode time is recorded in the "jpeg_encode" latency histogram.
+
+        '''
+
+        start = time.monotonic()
+        jpeg = cv2.imencode('.jpg', image,
+                            [cv2.IMWRITE_JPEG_QUALITY, int(self.jpeg_quality)])[1].tobytes()
+        tracer.record("jpeg_encode", time.monotonic() - start)
+
+        return jpeg
+
+
+class ClassificationPostProcessor(DetectionPostProcessor):
+    ''' Creates SPI data streams and visualization streams for classification results.
+
+    Works like DetectionPostProcessor, but each prediction is a list of Classifications. Every
+    class is flattened into 2 float32 elements: the label_id and the score.
+
+    '''
+
+    # Number of elements per class in the flattened SPI data stream
+    ELEMENTS = 2
+
+    COMPACT_DTYPE = spi_codec.COMPACT_CLASSIFICATION_DTYPE
+
+    def pack(self, pred):
+        ''' Flattens classifications into bytes. Empty slots are 0.
+        '''
+
+        if self.codec is not None:
+            records = np.zeros(len(pred), dtype=[("label_id", np.float32),
+                                                 ("score", np.float32)])
+            if pred:
+                records["label_id"], records["score"] = zip(*pred)
+            # Every class is identified by its label ID
+            return self.codec.encode(records, records["label_id"].astype(int))
+
+        data = np.zeros((self.flatten_length // self.elements, self.elements), dtype=np.float32)
+        if pred:
+            data[:len(pred)] = pred[:len(data)]
+
+        return data.tobytes()
+
+    def render(self, pred, frame):
+        ''' Writes the labels and scores of the classes on a copy of the given frame.
+        '''
+
+        output = cv2.resize(frame,
+                            self.output_resolution,
+                            interpolation=cv2.INTER_AREA)
+
+        for i, (label_id, score) in enumerate(pred):
+            text = "{} {:.2f}".format(self.source.label(label_id), score)
+            output = cv2.putText(output,
+                                 text,
+                                 (10, 30 + 30 * i),
+                                 cv2.FONT_HERSHEY_SIMPLEX,
+                                 fontScale=1,
+                                 color=(255, 255, 0),
+                                 thickness=2)
+        return output
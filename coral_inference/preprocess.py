@@ -0,0 +1,178 @@
+''' Fused preprocessing of camera frames into model input tensors.
+
+Converting a camera frame into a model input normally takes a color conversion, a resize and a
+dtype conversion, each of which allocates and copies a new array. The FusedPreprocessor reads
+the camera frame once: a remap with precomputed tables resizes (and optionally letterboxes) the
+frame into a small model-sized buffer, which is then color converted in place and scaled to the
+model's dtype with a 256 entry lookup table. When the model takes raw uint8 RGB pixels, the
+remap writes straight into the model input.
+
+The remap tables are computed once for a fixed camera -> model geometry and only rebuilt if the
+frame size changes.
+
+Classes:
+    FusedPreprocessor: Resizes, color converts and scales frames into a reusable buffer.
+
+'''
+
+import cv2
+import numpy as np
+
+
+class FusedPreprocessor(object):
+    ''' Resizes, color converts and scales frames into a reusable buffer.
+
+    Attributes:
+        model_size (tuple[int]): Model input (width, height).
+        channels (int): Number of model input channels. 3 for RGB, 1 for grayscale.
+        dtype: Data type of the model input.
+        letterbox (bool): Keep the frame's aspect ratio and pad the rest with zeros. If False,
+            the frame is stretched to the model size.
+        frame_size (tuple[int]): Frame (width, height) the remap tables were built for.
+        output: Reusable model input buffer used when no output array is passed in.
+
+    '''
+
+    def __init__(self,
+                 model_size,
+                 channels=3,
+                 dtype=np.uint8,
+                 scale=1.0,
+                 offset=0.0,
+                 letterbox=False):
+        ''' Builds the lookup table and buffers for the model input.
+
+        Every input pixel value p is converted to p * scale + offset in the model dtype.
+
+        Args:
+            model_size (tuple[int]): Model input (width, height).
+            channels (int): Number of model input channels. 3 for RGB, 1 for grayscale.
+            dtype: Data type of the model input (uint8, int8 or float32).
+            scale (float): Multiplies every pixel value.
+            offset (float): Added to every pixel value after scaling.
+            letterbox (bool): Keep the frame's aspect ratio and pad the rest with zeros.
+
+        Raises:
+            ValueError: Unsupported number of channels.
+
+        '''
+
+        if channels not in (1, 3):
+            raise ValueError("Only 1 or 3 channel model inputs are supported.")
+
+        self.model_size = model_size
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.letterbox = letterbox
+        self.frame_size = None
+
+        width, height = model_size
+        self.output_shape = (height, width, channels) if channels == 3 else (height, width)
+        self.output = np.zeros(self.output_shape, dtype=self.dtype)
+
+        # Raw uint8 RGB inputs are written by the remap directly, everything else goes through
+        # a model-sized staging buffer and a lookup table
+        self.direct = channels == 3 and self.dtype == np.uint8 and scale == 1.0 and offset == 0.0
+
+        self.staging = None
+        self.converted = None
+        self.lut = None
+        if not self.direct:
+            self.staging = np.zeros((height, width, 3), dtype=np.uint8)
+            self.converted = np.zeros(self.output_shape, dtype=np.uint8)
+
+            values = np.arange(256, dtype=np.float64) * scale + offset
+            if np.issubdtype(self.dtype, np.integer):
+                info = np.iinfo(self.dtype)
+                values = np.clip(np.round(values), info.min, info.max)
+            self.lut = values.astype(self.dtype)
+
+        self.color_conversion = cv2.COLOR_BGR2RGB if channels == 3 else cv2.COLOR_BGR2GRAY
+
+    def set_frame_size(self, frame_size):
+        ''' Precomputes the remap tables for a frame size.
+
+        Args:
+            frame_size (tuple[int]): Frame (width, height).
+
+        '''
+
+        frame_width, frame_height = frame_size
+        model_width, model_height = self.model_size
+
+        if self.letterbox:
+            ratio = min(model_width / frame_width, model_height / frame_height)
+            scale_x = scale_y = ratio
+        else:
+            scale_x = model_width / frame_width
+            scale_y = model_height / frame_height
+
+        self.pad = ((model_width - frame_width * scale_x) / 2,
+                    (model_height - frame_height * scale_y) / 2)
+        self.content_size = (frame_width * scale_x, frame_height * scale_y)
+
+        # Source pixel for the center of every model pixel
+        x = (np.arange(model_width, dtype=np.float32) + 0.5 - self.pad[0]) / scale_x - 0.5
+        y = (np.arange(model_height, dtype=np.float32) + 0.5 - self.pad[1]) / scale_y - 0.5
+        map_x, map_y = np.meshgrid(x, y)
+
+        # Fixed point maps are faster to remap with than float maps
+        self.map1, self.map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        self.frame_size = frame_size
+
+    def __call__(self, frame, out=None):
+        ''' Preprocesses a BGR frame into the model input.
+
+        Args:
+            frame: BGR frame from the camera.
+            out (array, optional): Model input to write into, for example a view of the
+                interpreter's input tensor. Must have as many elements as the model input.
+                Defaults to the preprocessor's own reusable buffer.
+
+        Returns:
+            The model input array.
+
+        '''
+
+        frame_size = (frame.shape[1], frame.shape[0])
+        if frame_size != self.frame_size:
+            self.set_frame_size(frame_size)
+
+        if out is None:
+            out = self.output
+        target = out.reshape(self.output_shape)
+
+        if self.direct:
+            cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR, dst=target,
+                      borderMode=cv2.BORDER_CONSTANT)
+            cv2.cvtColor(target, self.color_conversion, dst=target)
+        else:
+            cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR, dst=self.staging,
+                      borderMode=cv2.BORDER_CONSTANT)
+            cv2.cvtColor(self.staging, self.color_conversion, dst=self.converted)
+            cv2.LUT(self.converted, self.lut, dst=target)
+
+        return out
+
+    def unletterbox(self, boxes):
+        ''' Converts boxes relative to the model input into boxes relative to the frame.
+
+        Args:
+            boxes (array[float]): Boxes as (x0, y0, x1, y1) rows in coordinates from 0-1
+                relative to the model input.
+
+        Returns:
+            The boxes in coordinates from 0-1 relative to the frame.
+
+        '''
+
+        if not self.letterbox:
+            return boxes
+
+        model_width, model_height = self.model_size
+        scale = np.array([model_width / self.content_size[0],
+                          model_height / self.content_size[1]] * 2)
+        shift = np.array([self.pad[0] / self.content_size[0],
+                          self.pad[1] / self.content_size[1]] * 2)
+
+        return np.clip(boxes * scale - shift, 0.0, 1.0)
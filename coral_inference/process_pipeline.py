@@ -0,0 +1,562 @@
+''' Inference pipeline that runs each stage in its own process.
+
+The threaded Pipeline runs the source, engine, and postprocessor in one interpreter, so JPEG
+encoding, drawing, and detection handling all share the GIL. This pipeline runs the source,
+engine, and postprocessor in separate processes instead. Frames are written once into a
+preallocated pool of shared memory slots. Only slot indices and small detection records are
+sent between processes. Encoded output frames are handed back to the main process through a
+second shared memory pool.
+
+A slot travels source -> engine -> postprocessor and is then returned to the free list. The
+source process only reads a frame once a slot is free. Until then the camera keeps grabbing, so
+the driver never falls behind, but doesn't decode the frames nobody would process.
+
+The main process keeps a ProcessPostProcessor, which has the same interface as a
+DetectionPostProcessor, so the SPI stream and the Flask app work with either pipeline.
+
+Classes:
+    SharedFramePool: Fixed number of equally sized slots in shared memory.
+    ProcessPostProcessor: Main process stand-in for the postprocessor.
+    ProcessPipeline: Runs the source, engine, and postprocessor in separate processes.
+
+'''
+
+import multiprocessing
+import queue
+import cv2
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import metrics
+import tracker
+from ring_buffer import TripleBuffer
+from thread_manager import ThreadManager
+import tracing
+from tracing import tracer
+
+
+class SharedFramePool(object):
+    ''' Fixed number of equally sized slots in shared memory.
+
+    The process that creates the pool owns it and unlinks the memory when it is closed. Other
+    processes attach to the pool by name.
+
+    Attributes:
+        slots (int): Number of slots in the pool.
+        slot_size (int): Size of each slot in bytes.
+        name (str): Name of the shared memory block.
+
+    '''
+
+    def __init__(self,
+                 slots,
+                 slot_size,
+                 name=None):
+        ''' Creates or attaches to the shared memory block.
+
+        Args:
+            slots (int): Number of slots in the pool.
+            slot_size (int): Size of each slot in bytes.
+            name (str, optional): Name of an existing pool to attach to. If not specified, a
+                new pool is created.
+
+        Raises:
+            RuntimeError: Shared memory is not available (requires Python 3.8 or newer).
+
+        '''
+
+        if shared_memory is None:
+            raise RuntimeError("Shared memory pools require Python 3.8 or newer.")
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self.owner = name is None
+
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        self.name = self.memory.name
+
+    def fits(self, shape, dtype=np.uint8):
+        ''' Returns True if an array of the shape and data type fits in a slot.
+        '''
+
+        return int(np.prod(shape)) * np.dtype(dtype).itemsize <= self.slot_size
+
+    def view(self, index, shape, dtype=np.uint8):
+        ''' Returns an array backed by a slot in the pool.
+
+        Args:
+            index (int): Slot index.
+            shape (tuple[int]): Shape of the array.
+            dtype: Data type of the array.
+
+        Raises:
+            ValueError: The array does not fit in a slot.
+
+        '''
+
+        if not self.fits(shape, dtype):
+            raise ValueError("Array of shape {} does not fit in a {} byte slot."
+                             .format(shape, self.slot_size))
+
+        return np.ndarray(shape,
+                          dtype=dtype,
+                          buffer=self.memory.buf,
+                          offset=index * self.slot_size)
+
+    def close(self):
+        ''' Detaches from the pool. The owner also frees the memory.
+        '''
+
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class _EngineInfo(object):
+    ''' Stand-in for the engine inside the postprocessor process.
+
+    The postprocessor only needs the maximum number of detections and the labels from the
+    engine. The real engine lives in the engine process.
+
+    '''
+
+    def __init__(self, max_length, labels):
+        self.max_length = max_length
+        self.labels = labels
+
+    def get_max_length(self):
+        return self.max_length
+
+    def label(self, label_id):
+        if self.labels:
+            return self.labels[label_id]
+        else:
+            return ""
+
+
+def _queue_items(items, stop):
+    ''' Yields items from a multiprocessing queue until the stop event is set.
+    '''
+
+    while not stop.is_set():
+        try:
+            yield items.get(timeout=0.5)
+        except queue.Empty:
+            continue
+
+
+def fit_frame(frame, slot_size):
+    ''' Scales a frame down, keeping its aspect ratio, so that it fits in a slot of slot_size bytes.
+    '''
+
+    scale = (slot_size / frame.nbytes) ** 0.5
+    height, width = frame.shape[:2]
+    size = (max(int(width * scale), 1), max(int(height * scale), 1))
+
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def _source_worker(factory, params, frame_pool, free_frames, frames_out, stop):
+    ''' Reads frames from the source into free slots of the frame pool.
+
+    A frame is only read once a slot is free. Until then the camera keeps grabbing without
+    decoding, and replay sources in lockstep wait.
+
+    '''
+
+    frames = SharedFramePool(*frame_pool)
+    source = factory.create_source(params)
+    source.start()
+
+    warned = False
+    while not stop.is_set():
+        try:
+            slot = free_frames.get(timeout=0.1)
+        except queue.Empty:
+            # Every slot is still being processed downstream
+            continue
+
+        data = source.read(timeout=0.1)
+        if data is None:
+            free_frames.put(slot)
+
+            finished = getattr(source, "finished", None)
+            if finished is not None and finished.is_set() and source.read(timeout=0) is None:
+                break
+            continue
+
+        # The trace carries the source's own frame ID, so frames it skipped count as drops
+        frame, trace = data
+
+        # A source above the max resolution is scaled down instead of overrunning its slot
+        if not frames.fits(frame.shape, frame.dtype):
+            if not warned:
+                print("Frames of {}x{} are larger than the max resolution, scaling them down."
+                      .format(frame.shape[1], frame.shape[0]))
+                warned = True
+            frame = fit_frame(frame, frames.slot_size)
+
+        np.copyto(frames.view(slot, frame.shape), frame)
+        frames_out.put((slot, frame.shape, trace))
+
+
+def _engine_worker(factory, params, frame_pool, frames_in, preds_out, stop):
+    ''' Runs inference on frames in the frame pool.
+    '''
+
+    frames = SharedFramePool(*frame_pool)
+    inference_engine = factory.create_inference_engine(params)
+
+    # The postprocessor needs these before the first prediction
+    preds_out.put((inference_engine.get_max_length(), inference_engine.labels))
+
+    inference_engine = factory.add_tracking(inference_engine, params)
+    tracking = isinstance(inference_engine, tracker.TrackingDetector)
+    motion_gate = factory.create_motion_gate(params)
+
+    pred = None
+    for slot, shape, trace in _queue_items(frames_in, stop):
+        trace.stamp("engine_queue")
+        if (motion_gate is not None and not motion_gate.changed(frames.view(slot, shape)) and
+                pred is not None):
+            # Nothing changed, reuse the last prediction
+            trace.stamp("motion_gate")
+        elif tracking:
+            pred = inference_engine.invoke(frames.view(slot, shape), trace.frame_id)
+            trace.stamp("inference" if inference_engine.detected else "tracking")
+        else:
+            pred = inference_engine.invoke(frames.view(slot, shape))
+            trace.stamp("inference")
+        preds_out.put((slot, shape, pred, trace))
+
+
+def _postprocessor_worker(factory, params, use_flask, frame_pool, output_pool, free_frames,
+                          free_outputs, preds_in, results_out, stop):
+    ''' Packs predictions for SPI and renders and encodes the output frames.
+    '''
+
+    frames = SharedFramePool(*frame_pool)
+    outputs = SharedFramePool(*output_pool)
+
+    max_length, labels = preds_in.get()
+    detection_postprocessor = factory.create_postprocessor(_EngineInfo(max_length, labels),
+                                                           params)
+
+    for slot, shape, pred, trace in _queue_items(preds_in, stop):
+        trace.stamp("postprocess_queue")
+        data = detection_postprocessor.pack(pred)
+
+        image = None
+        if use_flask:
+            image = detection_postprocessor.render(pred, frames.view(slot, shape))
+            trace.stamp("render")
+
+        # The frame is no longer needed, hand the slot back to the source
+        free_frames.put(slot)
+
+        output = None
+        if image is not None:
+            jpeg = np.frombuffer(detection_postprocessor.encode(image), dtype=np.uint8)
+            trace.stamp("jpeg_encode")
+            try:
+                # Drop a frame that doesn't fit instead of failing on it
+                if outputs.fits(jpeg.shape):
+                    output_slot = free_outputs.get_nowait()
+                    np.copyto(outputs.view(output_slot, jpeg.shape), jpeg)
+                    output = (output_slot, len(jpeg))
+            except queue.Empty:
+                # The main process has not picked up the previous frames yet
+                pass
+
+        trace.stamp("postprocess")
+        results_out.put((pred, data, output, trace))
+
+
+def jpeg_slot_size(resolution):
+    ''' Returns the slot size in bytes for the encoded frames of a resolution.
+    '''
+
+    raw = resolution[0] * resolution[1] * 3
+    return raw + raw // 2 + 64 * 1024
+
+
+class ProcessPostProcessor(object):
+    ''' Main process stand-in for the postprocessor.
+
+    Receives results from the postprocessor process in a background thread and hands them to
+    listeners through a ThreadManager, just like DetectionPostProcessor.
+
+    Attributes:
+        results: Queue of results from the postprocessor process.
+        outputs: SharedFramePool with the encoded output frames.
+        free_outputs: Queue of free output slots.
+        flatten_length (int): Length of the flattened results for the SPI stream.
+        format_message (list[int]): SPI config message that describes the data layout.
+        codec: CompactCodec of the compact and delta SPI formats, None for the float32 format.
+        stop_event: Stops receiving results once set.
+        thread_manager: Handles requests for data from listeners.
+        payload: TripleBuffer with the newest SPI data, None until the SPI stream asks for it.
+
+    '''
+
+    def __init__(self,
+                 results,
+                 outputs,
+                 free_outputs,
+                 flatten_length,
+                 format_message,
+                 stop_event,
+                 codec=None):
+
+        self.results = results
+        self.outputs = outputs
+        self.free_outputs = free_outputs
+        self.flatten_length = flatten_length
+        self.format_message = format_message
+        self.codec = codec
+        self.stop_event = stop_event
+        self.payload = None
+
+        self.thread_manager = ThreadManager(self)
+
+        # The source and engine counters live in the other processes, so they are rebuilt here
+        # from the results
+        self.frames_captured = metrics.registry.counter("frames_captured_total",
+                                                        "Frames captured by the camera.")
+        self.inferences = metrics.registry.counter("inferences_total",
+                                                   "Frames run through the inference engine.",
+                                                   labels={"model": "default"})
+        metrics.registry.rate("camera_fps", "Frames captured per second.", self.frames_captured)
+        metrics.registry.rate("inference_fps", "Inferences per second.", self.inferences,
+                              labels={"model": "default"})
+
+    def start(self):
+        ''' Starts receiving results.
+        '''
+
+        self.thread_manager.start()
+
+    def _thread(self):
+        jpeg = b''
+        last_frame_id = None
+        for pred, data, output, trace in _queue_items(self.results, self.stop_event):
+            last_frame_id = tracer.count_drops("postprocessor", last_frame_id, trace)
+            tracer.record_trace(trace)
+
+            self.inferences.inc()
+            self.frames_captured.value = trace.frame_id + 1
+
+            if output is not None:
+                slot, length = output
+                jpeg = self.outputs.view(slot, (length,)).tobytes()
+                self.free_outputs.put(slot)
+
+            if self.payload is not None:
+                self.payload.write(data, trace)
+
+            self.thread_manager.set((pred, data, jpeg, trace))
+
+    def get_payload_buffer(self):
+        ''' Returns the TripleBuffer that the SPI data of every result is written to from now on.
+        '''
+
+        if self.payload is None:
+            self.payload = TripleBuffer()
+
+        return self.payload
+
+    def get_prediction(self):
+        ''' Returns the newest Detections.
+        '''
+
+        return self.thread_manager.wait()[0]
+
+    def tobytes(self):
+        ''' Returns the newest predictions flattened into bytes for the SPI stream.
+        '''
+
+        return self.thread_manager.wait()[1]
+
+    def read_bytes(self, timeout=None):
+        ''' Returns the newest SPI bytes and their FrameTrace, or None if no new bytes arrived
+        within timeout seconds.
+        '''
+
+        result = self.thread_manager.wait(timeout)
+        if result is None:
+            return None
+
+        _, data, _, trace = result
+        return data, trace
+
+    def frame_tobytes(self):
+        ''' Returns the newest encoded output frame.
+        '''
+
+        return self.thread_manager.wait()[2]
+
+    def read_frame_bytes(self):
+        ''' Returns the newest encoded output frame and its FrameTrace.
+        '''
+
+        _, _, jpeg, trace = self.thread_manager.wait()
+        return jpeg, trace
+
+    def get_flatten_length(self):
+        ''' Return the length of the flattened results for the SPI stream.
+        '''
+
+        return self.flatten_length
+
+    def get_format_message(self):
+        ''' Return the SPI config message that describes the data layout.
+        '''
+
+        return self.format_message
+
+
+class ProcessPipeline(object):
+    ''' Runs the source, engine, and postprocessor in separate processes.
+
+    The stages are created inside their processes by the factory, so the same config can build
+    either this pipeline or the threaded one.
+
+    Attributes:
+        processes (list): The stage processes.
+        postprocessor: ProcessPostProcessor that receives the results in the main process.
+        streams: One or multiple streams for the data.
+        video_stream: MJPEGBroadcaster for video clients, if the video stream is enabled.
+
+    '''
+
+    def __init__(self,
+                 factory,
+                 params,
+                 flatten_length,
+                 format_message=None,
+                 codec=None,
+                 frame_slots=4,
+                 max_resolution=(1920, 1080),
+                 output_resolution=(640, 480)):
+        ''' Allocates the shared memory pools and creates the stage processes.
+
+        Args:
+            factory: Pipeline factory used to create each stage inside its process.
+            params (dict): Pipeline parameters. See PipelineFactory.create_pipeline().
+            flatten_length (int): Length of the flattened results for the SPI stream.
+            format_message (list[int], optional): SPI config message that describes the data
+                layout. Defaults to float32 data of flatten_length values.
+            codec (optional): CompactCodec of the compact and delta SPI formats.
+            frame_slots (int): Number of frames that can be in flight at once.
+            max_resolution (tuple[int]): Largest source resolution the frame pool can hold.
+            output_resolution (tuple[int]): Resolution of the encoded output frames.
+
+        '''
+
+        self.streams = []
+        self.video_stream = None
+        self.stop_event = multiprocessing.Event()
+
+        self.frames = SharedFramePool(frame_slots, max_resolution[0] * max_resolution[1] * 3)
+
+        # A JPEG can be larger than its raw image, mostly for small or noisy images, because of
+        # its headers and tables. Frames that still don't fit are dropped.
+        output_slots = 2
+        self.outputs = SharedFramePool(output_slots,
+                                       jpeg_slot_size(output_resolution))
+
+        free_frames = multiprocessing.Queue()
+        for slot in range(frame_slots):
+            free_frames.put(slot)
+
+        free_outputs = multiprocessing.Queue()
+        for slot in range(output_slots):
+            free_outputs.put(slot)
+
+        frames = multiprocessing.Queue()
+        preds = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+
+        for name, items in (("frames", frames), ("predictions", preds), ("results", results)):
+            metrics.registry.gauge("queue_depth", "Items waiting in each inter-stage queue.",
+                                   items.qsize, labels={"queue": name})
+
+        frame_pool = (self.frames.slots, self.frames.slot_size, self.frames.name)
+        output_pool = (self.outputs.slots, self.outputs.slot_size, self.outputs.name)
+
+        self.processes = [
+            multiprocessing.Process(target=_source_worker,
+                                    args=(factory, params["source"], frame_pool, free_frames,
+                                          frames, self.stop_event),
+                                    daemon=True),
+            multiprocessing.Process(target=_engine_worker,
+                                    args=(factory, params["engine"], frame_pool, frames, preds,
+                                          self.stop_event),
+                                    daemon=True),
+            multiprocessing.Process(target=_postprocessor_worker,
+                                    args=(factory, params["postprocessor"],
+                                          params["stream_flask"], frame_pool, output_pool,
+                                          free_frames, free_outputs, preds, results,
+                                          self.stop_event),
+                                    daemon=True)
+        ]
+
+        self.postprocessor = ProcessPostProcessor(results,
+                                                  self.outputs,
+                                                  free_outputs,
+                                                  flatten_length,
+                                                  format_message or [0, flatten_length, 0, 0],
+                                                  self.stop_event,
+                                                  codec=codec)
+
+    def start(self):
+        ''' Start all the pipeline stages.
+        '''
+
+        for process in self.processes:
+            if not process.is_alive():
+                process.start()
+
+        self.postprocessor.start()
+
+        for stream in self.streams:
+            stream.start()
+
+    def stop(self):
+        ''' Stops the stage processes and frees the shared memory.
+        '''
+
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+
+        self.frames.close()
+        self.outputs.close()
+
+    def get_prediction(self):
+        ''' Return the inference prediction.
+        '''
+
+        return self.postprocessor.get_prediction()
+
+    def get_output_frame_bytes(self):
+        ''' Return the postprocessed frame in bytes.
+        '''
+
+        return self.postprocessor.frame_tobytes()
+
+    def get_stats(self):
+        ''' Return the per-stage latency percentiles and dropped frame counters.
+        '''
+
+        return tracing.tracer.summary()
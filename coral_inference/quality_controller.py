@@ -0,0 +1,383 @@
+''' Feedback controller that trades output quality for latency when the device is overloaded.
+
+Without it, nothing in the pipeline reacts to load. When inference or encoding slows down, for
+example because the device throttles or more video clients connect, every stage falls behind
+and the latency keeps growing. The QualityController measures the end-to-end latency and the
+output frame rate once per interval. When they miss their targets, it lowers one quality knob
+(JPEG quality, output resolution, detector stride, top_k, capture resolution) by one step.
+Once the pipeline has headroom again, it raises the knob it lowered last.
+
+Hysteresis keeps it from oscillating. A knob is only lowered after several bad intervals in a
+row and only raised after more good ones, and the latency has to be clearly below the target
+before anything is raised. A raise that has to be undone right away doubles the wait before
+the next raise.
+
+Every adjustment is printed and counted in the metrics.
+
+Classes:
+    Knob: One quality setting and its values, from best quality to cheapest.
+    QualityController: Lowers and raises the knobs to hold a latency and frame rate target.
+
+'''
+
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from tracing import tracer as shared_tracer
+
+
+# Latency histograms of the pipeline and of the outputs, see Tracer
+DEFAULT_STAGES = ("pipeline", "spi_end_to_end", "http_end_to_end")
+
+# Knobs in the order they are lowered. The cheapest loss of quality goes first.
+DEFAULT_KNOBS = ("jpeg_quality", "output_resolution", "stride", "top_k", "capture_resolution")
+
+
+def scale_resolution(resolution, scale):
+    ''' Scales a (width, height) resolution, rounded up to even numbers.
+    '''
+
+    width, height = resolution
+    return (int(-(-width * scale // 2) * 2), int(-(-height * scale // 2) * 2))
+
+
+class Knob(object):
+    ''' One quality setting and its values, from best quality to cheapest.
+
+    Attributes:
+        name (str): Name of the knob in the logs and metrics.
+        values (list): Values of the knob. values[0] is the configured setting.
+        apply: Function that applies a value to the pipeline.
+        index (int): Index of the current value.
+
+    '''
+
+    def __init__(self,
+                 name,
+                 values,
+                 apply):
+
+        self.name = name
+        self.values = list(values)
+        self.apply = apply
+        self.index = 0
+
+    @property
+    def value(self):
+        return self.values[self.index]
+
+    def can_lower(self):
+        return self.index < len(self.values) - 1
+
+    def can_raise(self):
+        return self.index > 0
+
+    def set(self, index):
+        ''' Applies the value at the index.
+        '''
+
+        self.index = index
+        self.apply(self.values[index])
+
+
+def jpeg_quality_knob(postprocessor, values=(80, 65, 50)):
+    ''' Lowers the JPEG quality of the video stream.
+    '''
+
+    def apply(quality):
+        postprocessor.jpeg_quality = quality
+
+    start = postprocessor.jpeg_quality
+    return Knob("jpeg_quality", [start] + [value for value in values if value < start], apply)
+
+
+def output_resolution_knob(postprocessor, scales=(0.75, 0.5)):
+    ''' Lowers the resolution of the video stream. The values are scales of the configured one.
+    '''
+
+    resolution = postprocessor.output_resolution
+
+    def apply(scale):
+        postprocessor.set_output_resolution("{}x{}".format(*scale_resolution(resolution, scale)))
+
+    return Knob("output_resolution", [1.0] + list(scales), apply)
+
+
+def stride_knob(engine, values=(2, 3, 4)):
+    ''' Runs the detector on fewer frames. See ThreadedEngine.set_stride().
+    '''
+
+    return Knob("stride", [1] + list(values), engine.set_stride)
+
+
+def top_k_knob(engine, fractions=(0.5, 0.25)):
+    ''' Keeps fewer detections of each frame. See ThreadedEngine.limit().
+    '''
+
+    top_k = engine.get_max_length()
+
+    def apply(count):
+        engine.max_detections = None if count >= top_k else count
+
+    values = [top_k]
+    for fraction in fractions:
+        count = max(int(top_k * fraction), 1)
+        if count < values[-1]:
+            values.append(count)
+
+    return Knob("top_k", values, apply)
+
+
+def capture_resolution_knob(source, scales=(0.75, 0.5)):
+    ''' Lowers the camera resolution. See OpenCVCamera.request_resolution().
+    '''
+
+    resolution = source.resolution
+
+    def apply(scale):
+        source.request_resolution(scale_resolution(resolution, scale))
+
+    return Knob("capture_resolution", [1.0] + list(scales), apply)
+
+
+class QualityController(object):
+    ''' Lowers and raises the knobs to hold a latency and frame rate target.
+
+    Every interval, the 95th percentile of the latency samples recorded since the last check is
+    taken over the stages (the largest one counts), and the output frame rate is taken from the
+    number of "pipeline" samples. The frame rate target is capped at the camera frame rate,
+    since lowering the quality can't make the camera faster.
+
+    The pipeline is overloaded when the latency is above the target or the frame rate is below
+    the target by more than the margin. It has headroom when the latency is below the target by
+    more than the margin and the frame rate is within half the margin of its target.
+
+    Attributes:
+        knobs (list[Knob]): Knobs in the order they are lowered. They are raised in reverse.
+        target_latency (float): Target 95th percentile latency in seconds.
+        target_fps (float): Target output frame rate, None for no frame rate target.
+        interval (float): Seconds between two checks.
+        margin (float): Fraction of the targets that makes the hysteresis band.
+        degrade_after (int): Overloaded checks in a row before a knob is lowered.
+        upgrade_after (int): Checks with headroom in a row before a knob is raised.
+        upgrade_wait (int): Current wait before a raise. Doubles when a raise is undone.
+        latency (float): Latency measured at the last check, None without samples.
+        fps (float): Output frame rate measured at the last check.
+
+    '''
+
+    def __init__(self,
+                 knobs,
+                 target_latency=0.2,
+                 target_fps=None,
+                 interval=1.0,
+                 margin=0.2,
+                 degrade_after=2,
+                 upgrade_after=5,
+                 max_upgrade_after=60,
+                 stages=DEFAULT_STAGES,
+                 tracer=None):
+
+        self.knobs = list(knobs)
+        self.target_latency = target_latency
+        self.target_fps = target_fps
+        self.interval = interval
+        self.margin = margin
+        self.degrade_after = degrade_after
+        self.upgrade_after = upgrade_after
+        self.max_upgrade_after = max_upgrade_after
+        self.stages = stages
+        self.tracer = tracer or shared_tracer
+
+        self.upgrade_wait = upgrade_after
+        self.overloaded = 0
+        self.headroom = 0
+        self.checks = 0
+        self.raised_at = None
+
+        self.latency = None
+        self.fps = 0.0
+        self.counts = {}
+        self.captured = -1
+        self.last_check = None
+
+        self.thread = None
+        self.stopped = threading.Event()
+
+        self.adjustments = {direction: metrics.registry.counter(
+                                "quality_adjustments_total",
+                                "Quality knobs lowered or raised by the controller.",
+                                labels={"direction": direction})
+                            for direction in ("down", "up")}
+        metrics.registry.gauge("quality_level", "Steps the quality knobs are below the "
+                               "configured settings.", self.level)
+        metrics.registry.gauge("quality_latency_seconds", "Latency the quality controller "
+                               "measured at its last check.", lambda: self.latency or 0.0)
+        for knob in self.knobs:
+            metrics.registry.gauge("quality_knob", "Current value of each quality knob.",
+                                   lambda knob=knob: knob.value, labels={"knob": knob.name})
+
+    def start(self):
+        ''' Starts the control loop in a background thread.
+        '''
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._thread, name="QualityController",
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        ''' Stops the control loop. The knobs keep their current values.
+        '''
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _thread(self):
+        self.measure()
+        while not self.stopped.wait(self.interval):
+            self.update(*self.measure())
+
+    def level(self):
+        ''' Returns the number of steps the knobs are below the configured settings.
+        '''
+
+        return sum(knob.index for knob in self.knobs)
+
+    def measure(self):
+        ''' Measures the pipeline since the last call.
+
+        Returns:
+            Tuple of (95th percentile latency in seconds or None without samples, output frame
+            rate, camera frame rate). The frame rates are None at the first call.
+
+        '''
+
+        now = time.monotonic()
+        elapsed = None if self.last_check is None else now - self.last_check
+        self.last_check = now
+
+        latency = None
+        frames = 0
+        for stage in self.stages:
+            histogram = self.tracer.histograms.get(stage)
+            if histogram is None:
+                continue
+
+            # Stages that show up after the first check are counted from their first sample
+            samples = histogram.since(self.counts.get(stage, histogram.count if elapsed is None
+                                                      else 0))
+            self.counts[stage] = histogram.count
+            if stage == "pipeline":
+                frames = len(samples)
+            if len(samples):
+                latency = max(latency or 0.0, float(np.percentile(samples, 95)))
+
+        captured, self.captured = self.captured, self.tracer.captured
+        if not elapsed:
+            return latency, None, None
+
+        return latency, frames / elapsed, max(self.captured - captured, 0) / elapsed
+
+    def update(self, latency, fps=None, capture_fps=None):
+        ''' Counts one check and lowers or raises a knob once the hysteresis allows it.
+
+        Args:
+            latency (float): 95th percentile latency in seconds, None if no frame came out.
+            fps (float, optional): Output frame rate.
+            capture_fps (float, optional): Camera frame rate, caps the frame rate target.
+
+        Returns:
+            -1 if a knob was lowered, 1 if a knob was raised, 0 otherwise.
+
+        '''
+
+        self.checks += 1
+        self.latency = latency
+        self.fps = fps
+
+        # A stalled or idle pipeline says nothing about the load
+        if latency is None:
+            return 0
+
+        target_fps = self.target_fps
+        if target_fps and capture_fps:
+            target_fps = min(target_fps, capture_fps)
+
+        fps_low = bool(target_fps) and fps is not None and fps < target_fps * (1 - self.margin)
+        fps_ok = not target_fps or fps is None or fps >= target_fps * (1 - self.margin / 2)
+
+        if latency > self.target_latency or fps_low:
+            self.overloaded += 1
+            self.headroom = 0
+        elif latency < self.target_latency * (1 - self.margin) and fps_ok:
+            self.headroom += 1
+            self.overloaded = 0
+        else:
+            self.overloaded = self.headroom = 0
+
+        if self.overloaded >= self.degrade_after:
+            return -1 if self.lower() else 0
+        if self.headroom >= self.upgrade_wait:
+            return 1 if self.raise_quality() else 0
+
+        return 0
+
+    def lower(self):
+        ''' Lowers the first knob that can go lower by one step.
+
+        Returns:
+            The knob, or None if every knob is at its cheapest value.
+
+        '''
+
+        knob = next((knob for knob in self.knobs if knob.can_lower()), None)
+        if knob is None:
+            return None
+
+        # The last raise brought the overload back, so wait longer before the next one
+        if self.raised_at is not None and self.checks - self.raised_at <= self.upgrade_wait:
+            self.upgrade_wait = min(self.upgrade_wait * 2, self.max_upgrade_after)
+        self.raised_at = None
+
+        self.adjust(knob, knob.index + 1, "down")
+
+        return knob
+
+    def raise_quality(self):
+        ''' Raises the last lowered knob by one step.
+
+        Returns:
+            The knob, or None if every knob is at its configured value.
+
+        '''
+
+        knob = next((knob for knob in reversed(self.knobs) if knob.can_raise()), None)
+        if knob is None:
+            self.headroom = 0
+            return None
+
+        # The previous raise held, so the wait can shrink again
+        if self.raised_at is not None:
+            self.upgrade_wait = max(self.upgrade_wait // 2, self.upgrade_after)
+        self.raised_at = self.checks
+
+        self.adjust(knob, knob.index - 1, "up")
+
+        return knob
+
+    def adjust(self, knob, index, direction):
+        old_value = knob.value
+        knob.set(index)
+
+        self.overloaded = self.headroom = 0
+        self.adjustments[direction].inc()
+
+        print("Quality {}: {} {} -> {} (p95 latency {} ms, {} fps)".format(
+            direction, knob.name, old_value, knob.value,
+            "-" if self.latency is None else int(self.latency * 1000),
+            "-" if self.fps is None else round(self.fps, 1)))
@@ -0,0 +1,225 @@
+''' Bounded multi-consumer ring buffer for handing data between pipeline stages.
+
+A single producer thread pushes items into a fixed number of slots. Every item is tagged with a
+monotonically increasing sequence number, so any number of consumers can read from the buffer
+without registering with the producer. Each consumer only has to remember the last sequence
+number it has seen. A consumer that falls behind simply skips over the items that were
+overwritten.
+
+For a single consumer that only needs the newest payload, the TripleBuffer hands payloads over
+without any lock on the data path. The producer never waits for the consumer, and the consumer
+never waits for the producer to finish a payload.
+
+Classes:
+    RingBuffer: Fixed-capacity buffer of sequence-numbered slots.
+    TripleBuffer: Lock-free hand-off of the newest payload to a single consumer.
+
+'''
+
+import threading
+
+
+class RingBuffer(object):
+    ''' Fixed-capacity ring buffer with sequence-numbered slots.
+
+    The producer calls put() for every new item. The amount of work per put() is constant and
+    does not depend on the number of consumers. Consumers call either get_latest() to receive
+    the newest item after a given sequence number, or get_next() to read items in order.
+
+    Attributes:
+        capacity (int): Number of slots in the buffer.
+        seqs (list[int]): Sequence number stored in each slot. -1 means the slot is empty.
+        items (list): Item stored in each slot.
+        latest_seq (int): Sequence number of the newest item. -1 if nothing has been put yet.
+
+    '''
+
+    def __init__(self,
+                 capacity=4):
+        ''' Allocates the slots.
+
+        Args:
+            capacity (int): Number of slots. Readers using get_next() can fall at most this many
+                items behind before they start skipping items.
+
+        Raises:
+            ValueError: Capacity is smaller than 1.
+
+        '''
+
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be at least 1.")
+
+        self.capacity = capacity
+        self.seqs = [-1] * capacity
+        self.items = [None] * capacity
+        self.latest_seq = -1
+
+        self._condition = threading.Condition(threading.Lock())
+
+    def put(self, item):
+        ''' Stores a new item, overwriting the oldest slot, and wakes up waiting consumers.
+
+        Args:
+            item: The data to store.
+
+        Returns:
+            The sequence number assigned to the item.
+
+        '''
+
+        with self._condition:
+            seq = self.latest_seq + 1
+            index = seq % self.capacity
+            self.items[index] = item
+            self.seqs[index] = seq
+            self.latest_seq = seq
+            self._condition.notify_all()
+
+        return seq
+
+    def get_latest(self, after_seq=-1, timeout=None):
+        ''' Returns the newest item with a sequence number greater than after_seq.
+
+        Blocks until such an item exists. Intermediate items are skipped, so this is the right
+        call for consumers that only care about the freshest data (e.g. video streams).
+
+        Args:
+            after_seq (int): The last sequence number seen by the caller. Defaults to -1, which
+                returns the newest item as soon as there is one.
+            timeout (float, optional): Maximum number of seconds to wait.
+
+        Returns:
+            Tuple of (sequence number, item), or (None, None) if the timeout expired.
+
+        '''
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.latest_seq > after_seq, timeout):
+                return None, None
+
+            return self.latest_seq, self.items[self.latest_seq % self.capacity]
+
+    def get_next(self, seq=-1, timeout=None):
+        ''' Returns the item following sequence number seq.
+
+        Blocks until the item is available. If the caller fell so far behind that the item has
+        already been overwritten, the oldest item still in the buffer is returned instead. The
+        caller can compare the returned sequence number with seq + 1 to count skipped items.
+
+        Args:
+            seq (int): The last sequence number seen by the caller.
+            timeout (float, optional): Maximum number of seconds to wait.
+
+        Returns:
+            Tuple of (sequence number, item), or (None, None) if the timeout expired.
+
+        '''
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.latest_seq > seq, timeout):
+                return None, None
+
+            next_seq = max(seq + 1, self.latest_seq - self.capacity + 1)
+            return next_seq, self.items[next_seq % self.capacity]
+
+    def peek(self):
+        ''' Returns the newest item without blocking.
+
+        Returns:
+            Tuple of (sequence number, item). The item is None if nothing has been put yet.
+
+        '''
+
+        with self._condition:
+            if self.latest_seq < 0:
+                return -1, None
+            return self.latest_seq, self.items[self.latest_seq % self.capacity]
+
+
+class TripleBuffer(object):
+    ''' Lock-free hand-off of the newest payload from one producer to one consumer.
+
+    The producer copies every payload into a back buffer that is neither the newest payload nor
+    the buffer the consumer is reading, and then publishes it with a single reference
+    assignment. The consumer marks the buffer it reads and checks that the newest payload did
+    not change while it did so, so the producer never writes into a buffer that is being read.
+    The buffers are reused, so the producer does not allocate once they are large enough.
+
+    Only waking up a consumer that waits for new data takes a lock.
+
+    Attributes:
+        buffers (list[bytearray]): The three payload buffers.
+        latest (tuple): Sequence number, buffer index and item of the newest payload, None
+            before the first payload.
+        reading (int): Index of the buffer the consumer reads. -1 before the first read.
+
+    '''
+
+    def __init__(self):
+        self.buffers = [bytearray() for _ in range(3)]
+        self.latest = None
+        self.reading = -1
+
+        self._published = threading.Event()
+
+    def write(self, data, item=None):
+        ''' Copies a payload into the back buffer and publishes it.
+
+        Called by the producer thread only.
+
+        Args:
+            data: Bytes-like payload.
+            item: Data that goes with the payload, like its FrameTrace.
+
+        Returns:
+            The sequence number of the payload.
+
+        '''
+
+        latest = self.latest
+        seq, newest = (latest[0] + 1, latest[1]) if latest is not None else (0, -1)
+
+        index = next(index for index in range(3) if index not in (newest, self.reading))
+        self.buffers[index][:] = data
+
+        self.latest = (seq, index, item)
+        self._published.set()
+
+        return seq
+
+    def read(self, after_seq=-1, timeout=None):
+        ''' Returns the newest payload with a sequence number greater than after_seq.
+
+        Called by the consumer thread only. The payload buffer stays untouched until the next
+        read() and must not be kept after it.
+
+        Args:
+            after_seq (int): The last sequence number seen by the consumer.
+            timeout (float, optional): Maximum number of seconds to wait for a new payload.
+
+        Returns:
+            Tuple of (sequence number, payload bytearray, item), or (None, None, None) if the
+            timeout expired.
+
+        '''
+
+        if not self._is_newer(after_seq):
+            self._published.clear()
+            if not self._is_newer(after_seq) and not self._published.wait(timeout):
+                return None, None, None
+
+        # Mark the buffer before checking that it is still the newest. The producer only
+        # reuses buffers that are marked neither newest nor read.
+        while True:
+            latest = self.latest
+            self.reading = latest[1]
+            if self.latest is latest:
+                break
+
+        seq, index, item = latest
+        return seq, self.buffers[index], item
+
+    def _is_newer(self, after_seq):
+        latest = self.latest
+        return latest is not None and latest[0] > after_seq
@@ -0,0 +1,646 @@
+''' Compact fixed-point encoding of results for the SPI stream.
+
+The float32 encoding sends 6 float32 values for every one of the top_k slots, even when nothing
+is detected. The compact encoding sends a one byte count followed by that many records, so empty
+slots cost nothing. Each value is stored as a fixed-point integer:
+
+    label_id: uint8
+    score: uint8, the score times 255
+    x0, y0, x1, y1: little-endian uint16, the relative coordinate times 65535
+
+A detection takes 10 bytes instead of 24, and a frame without detections takes a single byte.
+The encoding is picked with byte 0 of the config message (see FORMATS), so a microcontroller
+that only knows the float32 encoding keeps working.
+
+The delta encoding only sends what changed. Every record starts with a one byte object ID (the
+track ID, or the slot when there is no tracker). Track IDs grow without bound, so an IdPool
+hands every live track a byte that no other live track has. Full keyframes are sent every so
+often. In between, delta messages only carry the IDs of removed objects and the records of new
+objects and of objects that moved more than a tolerance. Every message has a sequence number, so
+the receiver can detect a lost message and ask for a keyframe. Frames where nothing changed are
+not sent at all. A message starts with two bytes, the message type and the sequence number:
+
+    keyframe: 0, sequence, count, count records
+    delta: 1, sequence, removed count, removed IDs, changed count, changed records
+
+Run this script to compare the size and speed of the encodings and the size of the deltas:
+
+    python spi_codec.py --top-k 15
+
+Classes:
+    CompactCodec: Encodes and decodes count-prefixed fixed-point records.
+    IdPool: Maps object IDs to one byte IDs that are unique among the live objects.
+    DeltaEncoder: Turns a stream of compact messages into keyframes and deltas.
+    DeltaDecoder: Rebuilds the records from keyframes and deltas, like the receiver does.
+
+'''
+
+import argparse
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from detections import DETECTION_DTYPE
+
+
+# Data types sent in byte 0 of the config message
+FLOAT32 = 0
+COMPACT = 1
+DELTA = 2
+
+FORMATS = {"float32": FLOAT32, "compact": COMPACT, "delta": DELTA}
+
+# Message types of the delta encoding
+KEYFRAME_MESSAGE = 0
+DELTA_MESSAGE = 1
+
+COMPACT_DETECTION_DTYPE = np.dtype([("label_id", np.uint8),
+                                    ("score", np.uint8),
+                                    ("x0", "<u2"),
+                                    ("y0", "<u2"),
+                                    ("x1", "<u2"),
+                                    ("y1", "<u2")])
+
+COMPACT_CLASSIFICATION_DTYPE = np.dtype([("label_id", np.uint8),
+                                         ("score", np.uint8)])
+
+# Fields stored as plain integers. Every other field is a value from 0 to 1.
+INTEGER_FIELDS = ("id", "label_id")
+
+# Value that 1.0 is stored as, for every field that is not an integer
+SCALES = {np.dtype(np.uint8): 255, np.dtype("<u2"): 65535}
+
+# The count prefix is a single byte
+MAX_COUNT = 255
+
+# Every field of the config message is a single byte
+MAX_CONFIG_VALUE = 255
+
+
+def parse_format(spi_format):
+    ''' Returns the config data type of an SPI format name.
+
+    Raises:
+        ValueError: The format is not supported.
+
+    '''
+
+    try:
+        return FORMATS[spi_format]
+    except KeyError:
+        raise ValueError("SPI format not supported: {}".format(spi_format))
+
+
+def create_codec(data_format, dtype):
+    ''' Creates the codec of a data type.
+
+    Args:
+        data_format (int): Data type. See FORMATS.
+        dtype: Structured dtype of a compact record without an ID.
+
+    Returns:
+        CompactCodec, with an ID in front of every record for the delta data type, or None for
+        float32 data.
+
+    '''
+
+    if data_format == COMPACT:
+        return CompactCodec(dtype)
+
+    if data_format == DELTA:
+        return CompactCodec([("id", np.uint8)] + [(name, dtype[name]) for name in dtype.names])
+
+    return None
+
+
+def format_message(data_format, max_records, elements, record_size):
+    ''' Creates the 4 byte config message that tells the microcontroller the data layout.
+
+    Float32 data sends its number of float32 values in byte 1. Compact and delta data send the
+    maximum number of records in byte 1 and the size of a record in byte 2.
+
+    Args:
+        data_format (int): Data type. See FORMATS.
+        max_records (int): Maximum number of results in a message.
+        elements (int): Number of float32 values per result of the float32 format.
+        record_size (int): Number of bytes per record of the compact and delta formats.
+
+    Returns:
+        The config message as a list of 4 bytes.
+
+    Raises:
+        ValueError: The float32 values don't fit in byte 1.
+
+    '''
+
+    if data_format in (COMPACT, DELTA):
+        return [data_format, min(max_records, MAX_COUNT), record_size, 0]
+
+    if max_records * elements > MAX_CONFIG_VALUE:
+        raise ValueError("top_k {} is too large for the float32 SPI format, which sends at most "
+                         "{} values. Use a top_k of at most {} or the compact format.".format(
+                             max_records, MAX_CONFIG_VALUE, MAX_CONFIG_VALUE // elements))
+
+    return [FLOAT32, max_records * elements, 0, 0]
+
+
+class CompactCodec(object):
+    ''' Encodes and decodes count-prefixed fixed-point records.
+
+    Attributes:
+        dtype: Structured dtype of an encoded record.
+        record_size (int): Number of bytes of an encoded record.
+
+    '''
+
+    def __init__(self,
+                 dtype=COMPACT_DETECTION_DTYPE):
+        ''' Sets the record layout.
+
+        Args:
+            dtype: Structured dtype of an encoded record. The "id" and "label_id" fields are
+                integers, the other fields are values from 0 to 1.
+
+        '''
+
+        self.dtype = np.dtype(dtype)
+        self.record_size = self.dtype.itemsize
+
+        self.scales = {name: SCALES[self.dtype[name]]
+                       for name in self.dtype.names if name not in INTEGER_FIELDS}
+
+    def max_length(self, capacity):
+        ''' Returns the number of bytes of a message with capacity records.
+        '''
+
+        return 1 + min(capacity, MAX_COUNT) * self.record_size
+
+    def encode(self, records, ids=None):
+        ''' Encodes records into a count-prefixed message.
+
+        Args:
+            records: Structured array with the field names of the dtype, like the valid
+                Detections records. Only the first 255 records are sent.
+            ids (array[int], optional): ID of every record, if the dtype has an "id" field.
+                Only the lowest byte is sent.
+
+        Returns:
+            The message as bytes.
+
+        '''
+
+        count = min(len(records), MAX_COUNT)
+        message = np.zeros(1 + count * self.record_size, dtype=np.uint8)
+        message[0] = count
+
+        encoded = message[1:].view(self.dtype)
+        if "id" in self.dtype.names:
+            encoded["id"] = np.asarray(ids[:count]) % 256
+        encoded["label_id"] = np.clip(records["label_id"][:count], 0, 255)
+        for name, scale in self.scales.items():
+            values = np.clip(records[name][:count], 0.0, 1.0) * scale
+            encoded[name] = np.rint(values)
+
+        return message.tobytes()
+
+    def decode(self, data):
+        ''' Decodes a message back into float32 records.
+
+        Args:
+            data (bytes): A message made by encode(). Trailing bytes are ignored.
+
+        Returns:
+            Structured float32 array with the field names of the dtype.
+
+        Raises:
+            ValueError: The message is shorter than its count says.
+
+        '''
+
+        encoded = self.parse(data)
+
+        records = np.zeros(len(encoded), dtype=[(name, np.float32) for name in self.dtype.names])
+        for name in self.dtype.names:
+            records[name] = encoded[name]
+        for name, scale in self.scales.items():
+            records[name] /= np.float32(scale)
+
+        return records
+
+    def parse(self, data):
+        ''' Returns the encoded records of a message without converting them.
+
+        Args:
+            data (bytes): A message made by encode(). Trailing bytes are ignored.
+
+        Returns:
+            Read-only structured array of the dtype.
+
+        Raises:
+            ValueError: The message is shorter than its count says.
+
+        '''
+
+        data = np.frombuffer(data, dtype=np.uint8)
+        if not len(data):
+            raise ValueError("The message is empty.")
+
+        count = int(data[0])
+        length = 1 + count * self.record_size
+        if len(data) < length:
+            raise ValueError("The message has {} bytes, but its count needs {}.".format(
+                len(data), length))
+
+        return data[1:length].view(self.dtype)
+
+
+class IdPool(object):
+    ''' Maps object IDs to one byte IDs that are unique among the live objects.
+
+    An object keeps its byte while it is live. Bytes of objects that are gone are handed out
+    again, the longest free one first, so a new object rarely gets the byte of an object the
+    receiver still remembers.
+
+    Attributes:
+        assigned (dict): Byte of every live object ID.
+        free (deque): Bytes nobody has, longest free first.
+
+    '''
+
+    def __init__(self,
+                 size=MAX_COUNT + 1):
+
+        self.assigned = {}
+        self.free = deque(range(size))
+        self.lock = threading.Lock()
+
+    def assign(self, ids):
+        ''' Returns the bytes of the objects of a frame. Objects missing from it are freed.
+
+        Args:
+            ids (array[int]): IDs of the objects of the frame. At most size of them.
+
+        Returns:
+            Array of the bytes, in the same order.
+
+        '''
+
+        ids = [int(object_id) for object_id in ids]
+
+        with self.lock:
+            live = set(ids)
+            for object_id in [object_id for object_id in self.assigned if object_id not in live]:
+                self.free.append(self.assigned.pop(object_id))
+
+            for object_id in ids:
+                if object_id not in self.assigned:
+                    self.assigned[object_id] = self.free.popleft()
+
+            return np.array([self.assigned[object_id] for object_id in ids], dtype=np.int64)
+
+
+class DeltaEncoder(object):
+    ''' Turns a stream of compact messages into keyframes and deltas.
+
+    The encoder keeps the records the receiver has, not the newest records, so small moves that
+    are below the tolerance add up until they are sent.
+
+    Attributes:
+        codec: CompactCodec of the records. Its dtype must have an "id" field.
+        keyframe_interval (float): Longest time in seconds between keyframes.
+        thresholds (dict): Smallest change of each encoded field that is sent.
+        state: Encoded records the receiver has, None before the first keyframe.
+        sequence (int): Sequence number of the next message.
+        keyframe_requested (bool): Whether the next message is a keyframe.
+
+    '''
+
+    def __init__(self,
+                 codec,
+                 keyframe_interval=1.0,
+                 tolerance=0.01,
+                 score_tolerance=0.05):
+        ''' Sets when to send keyframes and which changes to send.
+
+        Args:
+            codec: CompactCodec of the records. Its dtype must have an "id" field.
+            keyframe_interval (float): Longest time in seconds between keyframes.
+            tolerance (float): Smallest move of a box coordinate (0-1) that is sent.
+            score_tolerance (float): Smallest change of a score (0-1) that is sent.
+
+        '''
+
+        self.codec = codec
+        self.keyframe_interval = keyframe_interval
+        self.thresholds = {name: (score_tolerance if codec.dtype[name] == np.uint8 else
+                                  tolerance) * scale
+                           for name, scale in codec.scales.items()}
+
+        self.state = None
+        self.sequence = 0
+        self.last_keyframe = 0.0
+        self.keyframe_requested = True
+
+    def request_keyframe(self):
+        ''' Makes the next message a keyframe, for example after the receiver lost a message.
+        '''
+
+        self.keyframe_requested = True
+
+    def encode(self, message):
+        ''' Encodes the newest records as a keyframe or a delta.
+
+        Args:
+            message (bytes): Compact message made by the codec.
+
+        Returns:
+            The message to send as bytes, or None if nothing changed.
+
+        '''
+
+        records = self.codec.parse(message)
+        now = time.monotonic()
+
+        # Two objects with the same ID can't be told apart in a delta
+        if (self.keyframe_requested or self.state is None or
+                now - self.last_keyframe >= self.keyframe_interval or
+                len(np.unique(records["id"])) != len(records)):
+            return self.keyframe(records, now)
+
+        removed, changed = self.diff(records)
+        if not len(removed) and not len(changed):
+            return None
+
+        delta = np.concatenate([[DELTA_MESSAGE, self.sequence, len(removed)],
+                                removed,
+                                [len(changed)]]).astype(np.uint8).tobytes() + changed.tobytes()
+
+        # A keyframe would be smaller when most objects changed
+        if len(delta) >= 2 + len(message):
+            return self.keyframe(records, now)
+
+        self.state = apply_delta(self.state, removed, changed)
+        self.sequence = (self.sequence + 1) % 256
+
+        return delta
+
+    def keyframe(self, records, now):
+        ''' Encodes the records as a keyframe and makes them the state of the receiver.
+        '''
+
+        self.state = records.copy()
+        self.last_keyframe = now
+        self.keyframe_requested = False
+
+        keyframe = bytes([KEYFRAME_MESSAGE, self.sequence, len(records)]) + records.tobytes()
+        self.sequence = (self.sequence + 1) % 256
+
+        return keyframe
+
+    def diff(self, records):
+        ''' Compares the records with the state of the receiver.
+
+        Returns:
+            Tuple of (IDs of the removed objects, records of the new and moved objects).
+
+        '''
+
+        previous_ids = self.state["id"]
+        ids = records["id"]
+
+        removed = previous_ids[~np.isin(previous_ids, ids)]
+
+        # Look up the previous record of every object that is still there
+        known = np.isin(ids, previous_ids)
+        order = np.argsort(previous_ids)
+        previous = self.state[order[np.searchsorted(previous_ids, ids[known], sorter=order)]]
+        current = records[known]
+
+        moved = previous["label_id"] != current["label_id"]
+        for name, threshold in self.thresholds.items():
+            moved |= np.abs(current[name].astype(np.int32) -
+                            previous[name].astype(np.int32)) > threshold
+
+        changed = ~known
+        changed[known] = moved
+
+        return removed, records[changed]
+
+
+class DeltaDecoder(object):
+    ''' Rebuilds the records from keyframes and deltas, like the receiver does.
+
+    Attributes:
+        codec: CompactCodec of the records.
+        state: Encoded records of the last message, None before the first keyframe.
+        sequence (int): Sequence number of the last message.
+        needs_keyframe (bool): Whether a message was lost and deltas can't be applied.
+        gaps (int): Number of times a lost message was detected.
+
+    '''
+
+    def __init__(self,
+                 codec):
+
+        self.codec = codec
+        self.state = None
+        self.sequence = None
+        self.needs_keyframe = True
+        self.gaps = 0
+
+    def decode(self, message):
+        ''' Applies a keyframe or delta message.
+
+        Args:
+            message (bytes): Message made by a DeltaEncoder.
+
+        Returns:
+            The current encoded records, or None if a keyframe is needed first.
+
+        '''
+
+        message_type, sequence = message[0], message[1]
+
+        if message_type == KEYFRAME_MESSAGE:
+            self.state = self.codec.parse(message[2:]).copy()
+            self.sequence = sequence
+            self.needs_keyframe = False
+            return self.state
+
+        if not self.needs_keyframe and sequence != (self.sequence + 1) % 256:
+            self.needs_keyframe = True
+            self.gaps += 1
+
+        if self.needs_keyframe:
+            return None
+
+        removed_count = message[2]
+        removed = np.frombuffer(message, dtype=np.uint8, count=removed_count, offset=3)
+        changed = self.codec.parse(message[3 + removed_count:])
+
+        self.state = apply_delta(self.state, removed, changed)
+        self.sequence = sequence
+
+        return self.state
+
+
+def apply_delta(state, removed, changed):
+    ''' Removes the removed IDs from the records and adds or replaces the changed records.
+    '''
+
+    keep = ~np.isin(state["id"], removed) & ~np.isin(state["id"], changed["id"])
+
+    return np.concatenate([state[keep], changed])
+
+
+def random_records(count, rng):
+    ''' Creates random detection records with sorted box corners.
+    '''
+
+    records = np.zeros(count, dtype=DETECTION_DTYPE)
+    records["label_id"] = rng.integers(0, 90, count)
+    records["score"] = rng.random(count)
+
+    corners = np.sort(rng.random((count, 2, 2)), axis=1)
+    records["x0"], records["y0"] = corners[:, 0, 0], corners[:, 0, 1]
+    records["x1"], records["y1"] = corners[:, 1, 0], corners[:, 1, 1]
+
+    return records
+
+
+def run_benchmark(top_k=15, counts=(0, 1, 3, 15), iterations=20000, bus_speed=30000, seed=0):
+    ''' Compares the size and encode speed of the float32 and compact encodings.
+
+    Args:
+        top_k (int): Number of slots of the float32 encoding.
+        counts (tuple[int]): Numbers of detections to measure.
+        iterations (int): Number of messages encoded per measurement.
+        bus_speed (int): SPI clock in Hz, used for the bus time of a message.
+        seed (int): Seed of the random detections.
+
+    Returns:
+        List of dictionaries with the results of every detection count.
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    codec = CompactCodec()
+    results = []
+
+    for count in counts:
+        count = min(count, top_k)
+        slots = np.zeros(top_k, dtype=DETECTION_DTYPE)
+        slots[:count] = random_records(count, rng)
+        valid = slots[:count]
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            slots.tobytes()
+        float32_time = (time.perf_counter() - start) / iterations
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            message = codec.encode(valid)
+        compact_time = (time.perf_counter() - start) / iterations
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            codec.decode(message)
+        decode_time = (time.perf_counter() - start) / iterations
+
+        float32_bytes = slots.nbytes
+        compact_bytes = len(message)
+
+        results.append({
+            "detections": count,
+            "float32_bytes": float32_bytes,
+            "compact_bytes": compact_bytes,
+            "ratio": float32_bytes / compact_bytes,
+            "float32_encode_us": float32_time * 1e6,
+            "compact_encode_us": compact_time * 1e6,
+            "compact_decode_us": decode_time * 1e6,
+            # One header byte plus the body, 8 clocks per byte
+            "float32_updates_per_second": bus_speed / (8 * (1 + float32_bytes)),
+            "compact_updates_per_second": bus_speed / (8 * (1 + compact_bytes))
+        })
+
+    return results
+
+
+def run_delta_benchmark(count=5, moving=(0, 1, 5), frames=300, speed=0.02, seed=0):
+    ''' Measures the average size of delta messages for scenes with a number of moving objects.
+
+    The moving objects move speed per frame, the others stay still. No keyframes are forced, so
+    only the first message is a keyframe.
+
+    Args:
+        count (int): Number of objects in the scene.
+        moving (tuple[int]): Numbers of moving objects to measure.
+        frames (int): Number of frames per measurement.
+        speed (float): Relative distance the moving objects move per frame.
+        seed (int): Seed of the random detections.
+
+    Returns:
+        List of dictionaries with the results of every number of moving objects.
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    codec = create_codec(DELTA, COMPACT_DETECTION_DTYPE)
+    ids = np.arange(count)
+    results = []
+
+    for number in moving:
+        number = min(number, count)
+        records = random_records(count, rng)
+        for name in ("x0", "x1"):
+            records[name] *= 0.5
+
+        encoder = DeltaEncoder(codec, keyframe_interval=float("inf"))
+        sizes = []
+        for frame in range(frames):
+            message = encoder.encode(codec.encode(records, ids))
+            sizes.append(0 if message is None else len(message))
+
+            # Bounce the moving objects back and forth
+            step = speed if (frame // 20) % 2 == 0 else -speed
+            for name in ("x0", "x1"):
+                records[name][:number] += step
+
+        results.append({
+            "moving": number,
+            "compact_bytes": len(codec.encode(records, ids)),
+            "delta_bytes": float(np.mean(sizes[1:]))
+        })
+
+    return results
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--top-k', type=int, default=15,
+                        help='Number of detection slots of the float32 encoding')
+    parser.add_argument('-c', '--counts', type=int, nargs='+', default=[0, 1, 3, 15],
+                        help='Numbers of detections to measure')
+    parser.add_argument('-n', '--iterations', type=int, default=20000,
+                        help='Messages encoded per measurement')
+    parser.add_argument('--bus-speed', type=int, default=30000,
+                        help='SPI clock in Hz')
+    args = parser.parse_args()
+
+    print("{:>10} {:>8} {:>8} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+        "detections", "float32", "compact", "ratio", "enc f32", "enc cmp", "f32 upd/s",
+        "cmp upd/s"))
+    for result in run_benchmark(args.top_k, args.counts, args.iterations, args.bus_speed):
+        print("{detections:>10} {float32_bytes:>7}B {compact_bytes:>7}B {ratio:>6.1f} "
+              "{float32_encode_us:>8.1f}us {compact_encode_us:>8.1f}us "
+              "{float32_updates_per_second:>10.1f} {compact_updates_per_second:>10.1f}".format(
+                  **result))
+
+    print()
+    print("{:>10} {:>8} {:>10}".format("moving", "compact", "delta avg"))
+    for result in run_delta_benchmark():
+        print("{moving:>10} {compact_bytes:>7}B {delta_bytes:>9.1f}B".format(**result))
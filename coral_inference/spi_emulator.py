@@ -0,0 +1,555 @@
+''' In-process emulation of the microcontroller side of the SPI protocol.
+
+The LoopbackBus is an SPIBus that answers SPIComms the way the Arduino library does (see
+docs/spicommprotocol.md), so the init handshake, heartbeat, and data transfers can be tested
+and measured without hardware. Every byte goes through the same state machine as the Arduino
+interrupt routine, and the signal pin is raised whenever the emulated sketch asks for data. The
+clock speed, the time the sketch takes between reads, lost messages and resets of the
+microcontroller can all be set.
+
+The Arduino library only supports the float32 data type today. The compact and delta data types
+are emulated as a sketch that implements them would handle them.
+
+Run this script to measure the protocol on a laptop:
+
+    python spi_emulator.py --duration 10 --spi-format compact --reset-interval 3
+
+Classes:
+    LoopbackBus: SPIBus that emulates the microcontroller.
+    SyntheticDetections: Publishes moving detections to a postprocessor at a fixed rate.
+
+'''
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import postprocessor
+import spi_codec
+from detections import Detections
+from stream_spi import SPIBus, SPIComms
+from tracing import FrameTrace
+
+
+# States of the interrupt routine
+INIT = "init"
+WAITING_FOR_HEADER = "waiting_for_header"
+RECEIVING_CONFIG = "receiving_config"
+RECEIVING_MESSAGE = "receiving_message"
+
+HEARTBEAT_HEADER = 0x10
+MESSAGE_HEADER = 0x20
+CONFIG_HEADER = 0x30
+STATUS_HEADER = 0x40
+
+
+class LoopbackBus(SPIBus):
+    ''' SPIBus that emulates the microcontroller.
+
+    The emulated sketch goes through the same steps as the Arduino library
+    (arduino/AnythingSensor): it waits for four 0xFF bytes, acknowledges the empty config
+    message, reads the format config, and then reads data messages in a loop. Like the library,
+    it only answers the 0xFF start bytes in its start state, after power on or after a bad
+    acknowledgement. 0xFF bytes that arrive later are ignored as unknown headers.
+
+    Data messages are decoded with the data type of the config. The library only supports the
+    float32 data type today and refuses the others. The emulator also decodes the compact and
+    delta data types and answers the status header, the way a sketch that implements them
+    would.
+
+    Attributes:
+        clock_speed (int): SPI clock in Hz. Every transfer takes 8 clocks per byte.
+        transfer_overhead (float): Time in seconds every transfer takes on top of the clocks.
+        init_delay (float): Time in seconds the sketch waits after the handshake before it asks
+            for the format config.
+        ready_delay (float): Time in seconds the sketch takes between two reads.
+        drop_rate (float): Probability that a data message is lost.
+        messages (int): Number of data messages received.
+        payload_bytes (int): Number of data message bytes received.
+        dropped (int): Number of data messages lost on purpose.
+        resets (int): Number of resets of the microcontroller.
+        reconnect_times (list[float]): Seconds from every reset to the next data message.
+        data_format (int): Data type of the config, None before the config.
+        records: Newest decoded data.
+
+    '''
+
+    def __init__(self,
+                 clock_speed=30000,
+                 transfer_overhead=0.0001,
+                 init_delay=0.5,
+                 ready_delay=0.0,
+                 drop_rate=0.0,
+                 seed=None):
+        ''' Creates a microcontroller that was just switched on.
+
+        Args:
+            clock_speed (int): SPI clock in Hz.
+            transfer_overhead (float): Time in seconds every transfer takes on top of the clocks.
+            init_delay (float): Time in seconds between the handshake and the format request.
+            ready_delay (float): Time in seconds the sketch takes between two reads.
+            drop_rate (float): Probability that a data message is lost.
+            seed (int, optional): Seed for the lost messages.
+
+        '''
+
+        self.clock_speed = clock_speed
+        self.transfer_overhead = transfer_overhead
+        self.init_delay = init_delay
+        self.ready_delay = ready_delay
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.signal_changed = threading.Condition(self.lock)
+
+        self.messages = 0
+        self.payload_bytes = 0
+        self.dropped = 0
+        self.resets = 0
+        self.reconnect_times = []
+        self.reset_time = None
+
+        self._power_on()
+
+    def _power_on(self):
+        ''' Puts the sketch and the interrupt routine back to their start state.
+        '''
+
+        self.state = INIT
+        self.phase = "handshake"
+        self.buffer = bytearray()
+        self.spdr = 0x00
+        self.heartbeat = 0xFF
+        self.start_bytes = 0
+        self.signal_time = None
+
+        self.data_format = None
+        self.data_length = 0
+        self.record_size = 0
+        self.codec = None
+        self.decoder = None
+        self.records = None
+
+    def open(self):
+        pass
+
+    def reset(self):
+        ''' Resets the microcontroller, like pressing its reset button.
+        '''
+
+        with self.lock:
+            self._power_on()
+            self.resets += 1
+            self.reset_time = time.monotonic()
+            self.signal_changed.notify_all()
+
+    def read_signal(self):
+        with self.lock:
+            return self.signal_time is not None and time.monotonic() >= self.signal_time
+
+    def wait_signal(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.signal_changed:
+            while True:
+                now = time.monotonic()
+                if self.signal_time is not None and now >= self.signal_time:
+                    return True
+                if now >= deadline:
+                    return False
+
+                # Wake up when the signal is due or the sketch changes it
+                wake = deadline if self.signal_time is None else min(deadline, self.signal_time)
+                self.signal_changed.wait(wake - now)
+
+    def transfer(self, data):
+        ''' Clocks the bytes through the emulated interrupt routine.
+        '''
+
+        time.sleep(self.transfer_overhead + 8 * len(data) / self.clock_speed)
+
+        with self.lock:
+            response = [self._receive(byte) for byte in bytes(data)]
+            self.signal_changed.notify_all()
+
+        if isinstance(data, (bytes, bytearray)):
+            return bytes(response)
+
+        return response
+
+    def _receive(self, byte):
+        ''' Handles one byte like the SPI interrupt routine and returns the byte sent back.
+        '''
+
+        reply = self.spdr
+
+        if self.state == INIT:
+            self._receive_start(byte)
+            return reply
+
+        if self.state == WAITING_FOR_HEADER:
+            if byte == MESSAGE_HEADER:
+                self.state = RECEIVING_MESSAGE
+            elif byte == CONFIG_HEADER:
+                self.state = RECEIVING_CONFIG
+        else:
+            self.buffer.append(byte)
+            if len(self.buffer) == self._expected_length():
+                self._received(bytes(self.buffer))
+                self.buffer.clear()
+
+                # A reset of the sketch keeps its INIT state
+                if self.state != INIT:
+                    self.state = WAITING_FOR_HEADER
+
+        # The heartbeat counts every byte
+        self.spdr = self.heartbeat
+        self.heartbeat = (self.heartbeat + 1) % 256
+
+        # The byte after a status header answers with the status
+        if self.state == WAITING_FOR_HEADER and byte == STATUS_HEADER:
+            self.spdr = int(self.decoder is not None and self.decoder.needs_keyframe)
+
+        return reply
+
+    def _receive_start(self, byte):
+        ''' Counts the 0xFF start bytes and answers with 0xFF, 0xFE, 0xFD.
+        '''
+
+        if byte != 0xFF:
+            self.start_bytes = 0
+            self.spdr = 0x00
+            return
+
+        self.start_bytes += 1
+        self.spdr = 0xFF if self.start_bytes == 1 else (self.spdr - 1) % 256
+
+        if self.start_bytes == 4:
+            # Ask for the empty config message that acknowledges the handshake
+            self.state = WAITING_FOR_HEADER
+            self.phase = "acknowledge"
+            self.signal_time = time.monotonic()
+
+    def _expected_length(self):
+        ''' Returns the length of the config or data message being received, or None while the
+        length is not known yet.
+        '''
+
+        if self.state == RECEIVING_CONFIG:
+            return 4
+
+        if self.data_format == spi_codec.FLOAT32:
+            return 4 * self.data_length
+
+        buffer = self.buffer
+        if self.data_format == spi_codec.COMPACT:
+            return 1 + buffer[0] * self.record_size
+
+        # Delta messages start with the message type and the sequence number
+        if len(buffer) < 3:
+            return None
+        if buffer[0] == spi_codec.KEYFRAME_MESSAGE:
+            return 3 + buffer[2] * self.record_size
+
+        changed_index = 3 + buffer[2]
+        if len(buffer) <= changed_index:
+            return None
+        return changed_index + 1 + buffer[changed_index] * self.record_size
+
+    def _received(self, message):
+        ''' Hands a complete message to the emulated sketch.
+        '''
+
+        now = time.monotonic()
+
+        if self.state == RECEIVING_CONFIG and self.phase == "acknowledge":
+            # The sketch goes back to waiting for the start bytes, its heartbeat keeps counting
+            if message != b'\x00\x00\x00\x00':
+                self.state = INIT
+                self.phase = "handshake"
+                self.start_bytes = 0
+                self.signal_time = None
+                return
+
+            # The sketch waits before it asks for the format config
+            self.phase = "format"
+            self.signal_time = now + self.init_delay
+            return
+
+        if self.state == RECEIVING_CONFIG:
+            self._configure(message)
+            self.phase = "read"
+            self.signal_time = now + self.ready_delay
+            return
+
+        if self.random.random() < self.drop_rate:
+            self.dropped += 1
+        else:
+            self._decode(message)
+            self.messages += 1
+            self.payload_bytes += len(message)
+
+            if self.reset_time is not None:
+                self.reconnect_times.append(now - self.reset_time)
+                self.reset_time = None
+
+        self.signal_time = now + self.ready_delay
+
+    def _configure(self, message):
+        ''' Reads the data type and length from the format config.
+        '''
+
+        self.data_format = message[0]
+        self.data_length = message[1]
+        self.record_size = message[2]
+
+        if self.data_format == spi_codec.FLOAT32:
+            return
+
+        # The record size tells detections and classifications apart
+        size = self.record_size - (1 if self.data_format == spi_codec.DELTA else 0)
+        dtype = (spi_codec.COMPACT_DETECTION_DTYPE
+                 if size == spi_codec.COMPACT_DETECTION_DTYPE.itemsize
+                 else spi_codec.COMPACT_CLASSIFICATION_DTYPE)
+        self.codec = spi_codec.create_codec(self.data_format, dtype)
+
+        if self.data_format == spi_codec.DELTA:
+            self.decoder = spi_codec.DeltaDecoder(self.codec)
+
+    def _decode(self, message):
+        if self.data_format == spi_codec.FLOAT32:
+            self.records = np.frombuffer(message, dtype=np.float32)
+        elif self.data_format == spi_codec.COMPACT:
+            self.records = self.codec.decode(message)
+        else:
+            records = self.decoder.decode(message)
+            if records is not None:
+                self.records = records
+
+
+class SyntheticDetections(object):
+    ''' Publishes moving detections to a postprocessor at a fixed rate.
+
+    The postprocessor thread is not started. The detections are published through the
+    postprocessor, so the SPI stream reads them like it reads real results.
+
+    Attributes:
+        postprocessor: DetectionPostProcessor whose listeners get the detections.
+        fps (float): Detections published per second.
+        count (int): Number of objects.
+        moving (int): Number of objects that move.
+
+    '''
+
+    def __init__(self,
+                 postprocessor,
+                 fps=30.0,
+                 count=3,
+                 moving=1,
+                 speed=0.01,
+                 seed=0):
+
+        self.postprocessor = postprocessor
+        self.fps = fps
+        self.count = min(count, postprocessor.get_flatten_length() // postprocessor.elements)
+        self.moving = moving
+        self.speed = speed
+
+        self.records = spi_codec.random_records(self.count, np.random.default_rng(seed))
+        for name in ("x0", "x1"):
+            self.records[name] *= 0.5
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._thread, name="SyntheticDetections",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _thread(self):
+        capacity = self.postprocessor.get_flatten_length() // self.postprocessor.elements
+        frame_id = 0
+        while not self.stopped.is_set():
+            # Bounce the moving objects back and forth
+            step = self.speed if (frame_id // 20) % 2 == 0 else -self.speed
+            for name in ("x0", "x1"):
+                self.records[name][:self.moving] += step
+
+            detections = Detections(capacity)
+            detections.records[:self.count] = self.records
+            detections.count = self.count
+
+            self.postprocessor.publish(detections, None, FrameTrace(frame_id))
+            frame_id += 1
+
+            self.stopped.wait(1.0 / self.fps)
+
+
+class _SyntheticEngine(object):
+    ''' Stands in for the engine the postprocessor reads its capacity and labels from.
+    '''
+
+    def __init__(self, top_k):
+        self.top_k = top_k
+
+    def get_max_length(self):
+        return self.top_k
+
+    def label(self, label_id):
+        return str(label_id)
+
+
+def run_benchmark(duration=10.0,
+                  spi_format="float32",
+                  top_k=15,
+                  detections=3,
+                  moving=1,
+                  fps=1000.0,
+                  clock_speed=30000,
+                  ready_delay=0.0,
+                  init_delay=0.5,
+                  drop_rate=0.0,
+                  reset_interval=None,
+                  seed=0):
+    ''' Runs SPIComms against the emulated microcontroller and measures it.
+
+    Args:
+        duration (float): Length of the measured run in seconds, after the first connection.
+        spi_format (str): SPI data type. See spi_codec.FORMATS.
+        top_k (int): The maximum number of detections.
+        detections (int): Number of detections per message.
+        moving (int): Number of detections that move.
+        fps (float): Rate the detections are published at.
+        clock_speed (int): SPI clock in Hz.
+        ready_delay (float): Time in seconds the sketch takes between two reads.
+        init_delay (float): Time in seconds between the handshake and the format request.
+        drop_rate (float): Probability that a data message is lost.
+        reset_interval (float, optional): Resets the microcontroller this often in seconds.
+        seed (int): Seed for the detections and the lost messages.
+
+    Returns:
+        Dictionary with the configuration and results of the run.
+
+    '''
+
+    detection_postprocessor = postprocessor.DetectionPostProcessor(_SyntheticEngine(top_k),
+                                                                   spi_format=spi_format)
+    bus = LoopbackBus(clock_speed=clock_speed,
+                      init_delay=init_delay,
+                      ready_delay=ready_delay,
+                      drop_rate=drop_rate,
+                      seed=seed)
+    producer = SyntheticDetections(detection_postprocessor, fps=fps, count=detections,
+                                   moving=moving, seed=seed)
+    comms = SPIComms(detection_postprocessor, bus=bus)
+
+    # SPIComms prints every transfer
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        producer.start()
+
+        start = time.monotonic()
+        comms.start()
+        while bus.messages == 0 and time.monotonic() - start < 30.0:
+            time.sleep(0.001)
+        connect_time = time.monotonic() - start
+
+        start_messages = bus.messages
+        start_bytes = bus.payload_bytes
+        start_sent = comms.bytes_sent.value
+        start_unchanged = comms.unchanged.value
+
+        start = time.monotonic()
+        next_reset = start + reset_interval if reset_interval else None
+        while time.monotonic() - start < duration:
+            time.sleep(0.01)
+            if next_reset is not None and time.monotonic() >= next_reset:
+                bus.reset()
+                next_reset += reset_interval
+        elapsed = time.monotonic() - start
+
+        messages = bus.messages - start_messages
+        payload_bytes = bus.payload_bytes - start_bytes
+        unchanged = comms.unchanged.value - start_unchanged
+        sent = comms.bytes_sent.value - start_sent
+
+        comms.stopped.set()
+        producer.stop()
+        comms.stop()
+
+    return {
+        "config": {
+            "duration": duration,
+            "spi_format": spi_format,
+            "top_k": top_k,
+            "detections": detections,
+            "moving": moving,
+            "fps": fps,
+            "clock_speed": clock_speed,
+            "ready_delay": ready_delay,
+            "init_delay": init_delay,
+            "drop_rate": drop_rate,
+            "reset_interval": reset_interval
+        },
+        "connect_seconds": connect_time,
+        "messages_per_second": messages / elapsed,
+        "payload_bytes_per_second": payload_bytes / elapsed,
+        "bytes_per_message": payload_bytes / messages if messages else None,
+        "bytes_sent": sent,
+        "unchanged_skipped": unchanged,
+        "dropped": bus.dropped,
+        "resets": bus.resets,
+        "reconnect_seconds": bus.reconnect_times
+    }
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='Length of the measured run in seconds')
+    parser.add_argument('-f', '--spi-format', default="float32",
+                        choices=list(spi_codec.FORMATS),
+                        help='SPI data type')
+    parser.add_argument('-k', '--top-k', type=int, default=15,
+                        help='Maximum number of detections')
+    parser.add_argument('--detections', type=int, default=3,
+                        help='Detections per message')
+    parser.add_argument('--moving', type=int, default=1,
+                        help='Detections that move')
+    parser.add_argument('--fps', type=float, default=1000.0,
+                        help='Rate the detections are published at')
+    parser.add_argument('--clock-speed', type=int, default=30000,
+                        help='SPI clock in Hz')
+    parser.add_argument('--ready-delay', type=float, default=0.0,
+                        help='Time the sketch takes between reads in seconds')
+    parser.add_argument('--init-delay', type=float, default=0.5,
+                        help='Time between the handshake and the format request in seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='Probability that a data message is lost')
+    parser.add_argument('--reset-interval', type=float,
+                        help='Resets the microcontroller this often in seconds')
+    args = parser.parse_args()
+
+    results = run_benchmark(duration=args.duration,
+                            spi_format=args.spi_format,
+                            top_k=args.top_k,
+                            detections=args.detections,
+                            moving=args.moving,
+                            fps=args.fps,
+                            clock_speed=args.clock_speed,
+                            ready_delay=args.ready_delay,
+                            init_delay=args.init_delay,
+                            drop_rate=args.drop_rate,
+                            reset_interval=args.reset_interval)
+
+    print(json.dumps(results, indent=2))
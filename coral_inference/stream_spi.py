@@ -1,19 +1,136 @@
-from periphery import SPI, GPIO
+from abc import abstractmethod
 import time
 
 import threading
 
 import numpy as np
 
+import metrics
+import spi_codec
+from tracing import tracer
+
+try:
+    from periphery import SPI, GPIO
+except ImportError:
+    SPI = GPIO = None
+
+
+class SPIBus(object):
+    ''' Abstract base class for the bus that SPIComms talks to the microcontroller over.
+
+    The bus is the SPI device plus the signal pin the microcontroller raises when it is ready.
+    PeripheryBus uses the hardware, spi_emulator.LoopbackBus emulates the microcontroller.
+
+    '''
+
+    @abstractmethod
+    def open(self):
+        ''' Opens the bus. Called once when the comms start.
+        '''
+        pass
+
+    @abstractmethod
+    def transfer(self, data):
+        ''' Sends data and returns the bytes received at the same time.
+
+        Args:
+            data (bytes or list[int]): Data to send.
+
+        Returns:
+            The received bytes, as bytes if data is bytes and as a list otherwise.
+
+        '''
+        pass
+
+    @abstractmethod
+    def read_signal(self):
+        ''' Returns True while the signal pin is high.
+        '''
+        pass
+
+    @abstractmethod
+    def wait_signal(self, timeout):
+        ''' Waits for the signal pin to be high without polling it.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            True if the signal pin is high, False if the timeout expired.
+
+        '''
+        pass
+
+
+class PeripheryBus(SPIBus):
+    ''' The SPI device and signal pin of the Coral, through python-periphery.
+
+    Attributes:
+        device (str): Path of the SPI device.
+        speed (int): SPI clock in Hz.
+        signal_pin (int): GPIO line of the signal pin.
+
+    '''
+
+    def __init__(self,
+                 device="/dev/spidev0.0",
+                 speed=30000,
+                 signal_pin=6):
+
+        self.device = device
+        self.speed = speed
+        self.signal_pin = signal_pin
+
+        self.spi = None
+        self.gpio = None
+
+    def open(self):
+        if SPI is None:
+            raise RuntimeError("The SPI stream requires the python-periphery package.")
+
+        # Open the SPI device with mode 0
+        if(self.spi is None):
+            self.spi = SPI(self.device, 0, self.speed) #, bit_order= "lsb")
+
+        # Open GPIO pin connection
+        # The kernel wakes wait_signal() on the rising edge
+        if(self.gpio is None):
+            self.gpio = GPIO(self.signal_pin, "in")
+            self.gpio.edge = "rising"
+
+    def transfer(self, data):
+        return self.spi.transfer(data)
+
+    def read_signal(self):
+        return self.gpio.read()
+
+    def wait_signal(self, timeout):
+        if self.gpio.read():
+            return True
+
+        self.gpio.poll(timeout)
+
+        return self.gpio.read()
+
+
 class SPIComms(object):
     # Message headers defined for this communication protocl
     HEADERS = {
         "heartbeat" : b'\x10',
         "message" : b'\x20',
-        "config" : b'\x30'
+        "config" : b'\x30',
+        "status" : b'\x40'
     }
 
-    def __init__(self, source):
+    # Status byte of the microcontroller when it lost a delta message
+    KEYFRAME_REQUEST = 0x01
+
+    def __init__(self,
+                 source,
+                 keyframe_interval=1.0,
+                 delta_tolerance=0.01,
+                 bus=None,
+                 heartbeat_interval=0.01):
         self.source = source
         self.data_length = self.source.get_flatten_length()
 
@@ -21,65 +138,138 @@ class SPIComms(object):
         # Used to make sure that microcontroller is still available
         self.prev_heartbeat_count = 0
         self.heartbeat_count = 0
+        self.heartbeat_interval = heartbeat_interval
 
         # Create the data format message
         # Message is 4 bytes long
         # Defined in communication doc
-        self.data_format_message = [0, self.data_length, 0, 0]
-
-        self.spi = None
-        self.signal_pin = None
+        # The postprocessor picks the data type, so it also builds the message
+        self.data_format_message = self.source.get_format_message()
+
+        # With the delta data type only changes are sent, between periodic keyframes
+        self.encoder = None
+        if self.data_format_message[0] == spi_codec.DELTA:
+            self.encoder = spi_codec.DeltaEncoder(self.source.codec,
+                                                  keyframe_interval=keyframe_interval,
+                                                  tolerance=delta_tolerance)
+
+        # Bus to the microcontroller, the Coral hardware unless another bus is passed
+        self.bus = bus if bus is not None else PeripheryBus()
         self.comm_thread = None
+        self.stopped = threading.Event()
 
         self.max_error_count = 50
-
-        self.data_lock = threading.Lock()
-        self.data = np.zeros(shape = (self.data_length,), dtype = np.float32)
+        self.error_count = 0
+
+        # The postprocessor packs every result into the payload buffer, so the comms thread
+        # sends the newest complete data without waiting on inference or packing
+        self.payload = self.source.get_payload_buffer()
+        self.last_seq = -1
+        self.data = None
+
+        # Metrics, only updated by the comms thread
+        self.transfers = metrics.registry.counter("spi_transfers_total",
+                                                  "Data messages sent to the microcontroller.")
+        self.bytes_sent = metrics.registry.counter("spi_bytes_total",
+                                                   "Data bytes sent to the microcontroller.")
+        self.errors = metrics.registry.counter("spi_errors_total",
+                                               "Heartbeats that did not increase.")
+        self.resets = metrics.registry.counter("spi_resets_total",
+                                               "Times the comms were initialized again.")
+        metrics.registry.rate("spi_transfers_per_second", "Data messages sent per second.",
+                              self.transfers)
+        self.unchanged = metrics.registry.counter("spi_unchanged_total",
+                                                  "Data messages skipped because nothing "
+                                                  "changed.")
+        self.keyframe_requests = metrics.registry.counter("spi_keyframe_requests_total",
+                                                          "Keyframes requested by the "
+                                                          "microcontroller.")
 
     def start(self):
-        # Open spidev0.0 device with mode 0 and max speed 100 kHz
-        if(self.spi is None):
-            self.spi = SPI("/dev/spidev0.0", 0, 30000) #, bit_order= "lsb")
-
-        # Open GPIO pin connection
-        if(self.signal_pin is None):
-            self.signal_pin = GPIO(6, "in")
+        self.bus.open()
 
         if(self.comm_thread is None):
             print("starting comms thread")
-            self.comm_thread = threading.Thread(target=self._comm_thread_fn, daemon = True)
+            self.comm_thread = threading.Thread(target=self._comm_thread_fn, name="SPIComms",
+                                                daemon = True)
             self.comm_thread.start()
 
+    def stop(self):
+        # The comms thread exits at its next check
+        self.stopped.set()
+        if(self.comm_thread is not None):
+            self.comm_thread.join()
+
     def set_data(self, data):
-        with self.data_lock:
-            np.copyto(self.data, data)
+        # Publishes float32 data for sources without a postprocessor thread
+        self.payload.write(np.asarray(data, dtype=np.float32).tobytes())
 
     def _comm_thread_fn(self):
-        while True:
+        while not self.stopped.is_set():
             # Initialize the communications with the microcontoller
-            self._comm_init()
-            error_count = 0
-            while error_count < self.max_error_count:
-                
-
-                # heartbeat header
-                self.prev_heartbeat_count = self.heartbeat_count
-                self.heartbeat_count = int.from_bytes(self.spi.transfer(self.HEADERS["heartbeat"]), "little")
-
-                if(self.heartbeat_count <= self.prev_heartbeat_count):
-                    print("ERROR")
-                    error_count += 1
-                else:
-                    error_count = 0
-
-                if(self.signal_pin.read()):
+            if not self._comm_init():
+                break
+            self.resets.inc()
+            if self.encoder is not None:
+                self.encoder.request_keyframe()
+            self.error_count = 0
+            last_frame_id = None
+            next_heartbeat = time.monotonic()
+            while self.error_count < self.max_error_count and not self.stopped.is_set():
+                # The heartbeat runs on its own timer, every wait below ends in time for it
+                now = time.monotonic()
+                if now >= next_heartbeat:
+                    self._check_heartbeat()
+                    next_heartbeat = now + self.heartbeat_interval
+                    continue
+
+                # Sleep until the microcontroller asks for data, then until there is new data
+                if not self.bus.wait_signal(next_heartbeat - now):
+                    continue
+
+                timeout = max(0.0, next_heartbeat - time.monotonic())
+                seq, self.data, trace = self.payload.read(self.last_seq, timeout)
+                if seq is None:
+                    continue
+                self.last_seq = seq
+
+                if self.encoder is not None:
+                    self._poll_status()
+                    self.data = self.encoder.encode(self.data)
+
+                if self.data is not None:
                     print("Transferring data")
-                    self.spi.transfer(self.HEADERS['message'])
-                    with self.data_lock:
-                        self.data = self.source.tobytes()
-                        self.spi.transfer(self.data)
+                    self.bus.transfer(self.HEADERS['message'])
+                    self.bus.transfer(self.data)
 
-                time.sleep(0.01)
+                last_frame_id = tracer.count_drops("spi", last_frame_id, trace)
+                if self.data is None:
+                    self.unchanged.inc()
+                else:
+                    self.transfers.inc()
+                    self.bytes_sent.inc(len(self.data))
+                    tracer.record_output("spi", trace)
+
+    def _check_heartbeat(self):
+        # The microcontroller counts every byte, so the heartbeat has to be higher than the last
+        self.prev_heartbeat_count = self.heartbeat_count
+        self.heartbeat_count = int.from_bytes(self.bus.transfer(self.HEADERS["heartbeat"]), "little")
+
+        if(self.heartbeat_count <= self.prev_heartbeat_count):
+            print("ERROR")
+            self.error_count += 1
+            self.errors.inc()
+        else:
+            self.error_count = 0
+
+    def _poll_status(self):
+        # The microcontroller answers the byte after the status header with its status
+        self.bus.transfer(self.HEADERS["status"])
+        status = self.bus.transfer(b'\x00')[0]
+
+        if status == self.KEYFRAME_REQUEST:
+            self.encoder.request_keyframe()
+            self.keyframe_requests.inc()
 
     def _comm_init(self):
         # Flags to store where in the comm init program is
@@ -92,22 +282,23 @@ class SPIComms(object):
 
         # Loop init process
         while not init_signal_received:
+            if self.stopped.is_set():
+                return False
+
             # Pop the first response and append the last response
             responses.pop(0)
-            responses.append(self.spi.transfer(b'\xFF'))
-
-            startTime = time.time()
+            responses.append(self.bus.transfer(b'\xFF'))
 
-            # Read pin for 100 ms to check for correct response
+            # Wait up to 100 ms for the correct response
             # Correct response is high on the signal pin and 0xFF, 0xFE, 0xFD heartbeat sequence
-            while time.time() - startTime < 0.1:
-                if(self.signal_pin.read() and responses == [b'\xff', b'\xfe', b'\xfd']):
-                    init_signal_received = True
-                    break
+            if(responses == [b'\xff', b'\xfe', b'\xfd']):
+                init_signal_received = self.bus.wait_signal(0.1)
+            else:
+                self.stopped.wait(0.1)
 
         print("Received signal, waiting for heartbeat")
-        self.spi.transfer(self.HEADERS["config"])
-        responses = self.spi.transfer(b'\x00\x00\x00\x00')
+        self.bus.transfer(self.HEADERS["config"])
+        responses = self.bus.transfer(b'\x00\x00\x00\x00')
 
         # Store the last two heartbeats
         self.prev_heartbeat_count = responses[2]
@@ -115,16 +306,19 @@ class SPIComms(object):
         print("Heartbeat received, successful init!")
 
         # Wait until we receive request for data
-        while (not self.signal_pin.read()):
-            time.sleep(0.1)
+        while (not self.bus.wait_signal(0.1)):
+            if self.stopped.is_set():
+                return False
 
         print("Received high on pin")
         print("Transmitting format message")
         # Transferring data format message
-        self.spi.transfer(self.HEADERS["config"])
+        self.bus.transfer(self.HEADERS["config"])
         time.sleep(1)
 
-        self.spi.transfer(self.data_format_message)
+        self.bus.transfer(self.data_format_message)
+
+        return True
 
 
 
@@ -1,13 +1,12 @@
 ''' Manages data requests for a generic threaded function.
 
 This function will handle starting, stopping, and data requests for any given thread. 
-The wait() function should be called in any get() method to spawn a new request for data. This
-request will be granted once the latest thread loop has been run. This class can handle any 
-number of listener threads requesting data.
+The thread publishes every result with set(). Listener threads call wait() in any get() method
+to receive data newer than what they have already seen. Results are stored in a RingBuffer with
+sequence numbers, so listeners never have to register with the producer and the producer does
+the same amount of work no matter how many listeners there are.
 
 Classes:
-    Event: Stores all the listener threads waiting on data. Signals those threads when the data is
-        ready.
     ThreadManager: Manages the starting, waiting, and setting of a generic thread.
 
 '''
@@ -15,56 +14,7 @@ Classes:
 import time
 import threading
 
-try:
-    from greenlet import getcurrent as get_ident
-except ImportError:
-    try:
-        from thread import get_ident
-    except ImportError:
-        from _thread import get_ident
-
-
-class Event(object):
-    """ An Event-like class that signals all active clients when a new frame is
-    available.
-    """
-
-    def __init__(self):
-        self.events = {}
-
-    def wait(self):
-        """ Invoked from each client's thread to wait for the next frame."""
-        ident = get_ident()
-        if ident not in self.events:
-            # this is a new client
-            # add an entry for it in the self.events dict
-            # each entry has two elements, a threading.Event() and a timestamp
-            self.events[ident] = [threading.Event(), time.time()]
-        return self.events[ident][0].wait()
-
-    def set(self):
-        """ Invoked by the camera thread when a new frame is available."""
-        now = time.time()
-        remove = None
-        for ident, event in self.events.items():
-            if not event[0].isSet():
-                # if this client's event is not set, then set it
-                # also update the last set timestamp to now
-                event[0].set()
-                event[1] = now
-            else:
-                # if the client's event is already set, it means the client
-                # did not process a previous frame
-                # if the event stays set for more than 5 seconds, then assume
-                # the client is gone and remove it
-                if now - event[1] > 5:
-                    remove = ident
-        if remove:
-            del self.events[remove]
-
-    def clear(self):
-        """ Invoked from each client's thread after a frame was processed."""
-        self.events[get_ident()][0].clear()
+from ring_buffer import RingBuffer
 
 
 class ThreadManager(object):
@@ -73,12 +23,13 @@ class ThreadManager(object):
     Attributes:
         thread: Stores the background thread.
         last_access (float): The time that the thread was last requested for data.
-        event: Event() class that handles notifying all listeners.
+        buffer: RingBuffer that stores the newest results of the thread.
 
     '''
 
     def __init__(self,
-                 obj):
+                 obj,
+                 capacity=4):
         ''' Initializes thread.
 
         The object being passed as a parameter must defined a _thread() function. This function
@@ -86,19 +37,26 @@ class ThreadManager(object):
 
         Args:
             obj: The class with the thread to be managed.
+            capacity (int): Number of results kept for listeners that read in order.
 
         '''
 
         self.thread = None  # Background thread
         self.last_access = 0
-        self.event = Event()
+        self.buffer = RingBuffer(capacity)
+
+        # Last sequence number seen by each listener thread. This lives on the listener side,
+        # so the producer never has to know who is listening.
+        self._listener = threading.local()
 
         """Start the background thread if it isn't running yet."""
         if self.thread is None:
             self.last_access = time.time()
 
             # start background frame thread
-            self.thread = threading.Thread(target=obj._thread)
+            self.thread = threading.Thread(target=obj._thread,
+                                           name=type(obj).__name__,
+                                           daemon=True)
 
     def start(self):
         ''' Start the thread.
@@ -106,22 +64,69 @@ class ThreadManager(object):
 
         if not self.thread.is_alive():
             self.thread.start()
-    
-    def wait(self):
-        ''' Waits for the signal that the thread loop has completed.
+
+    def wait(self, timeout=None):
+        ''' Waits for data newer than the last data this thread received and returns it.
+
+        Results produced while the calling thread was busy are skipped, so the caller always
+        gets the newest data and never gets the same data twice.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait. 0 only checks for
+                new data without waiting.
+
+        Returns:
+            The newest data passed to set(), or None if the timeout expired.
+
+        '''
+
+        self.last_access = time.time()
+
+        seq, data = self.buffer.get_latest(self.last_seq(), timeout)
+        if seq is None:
+            return None
+
+        self._listener.seq = seq
+
+        return data
+
+    def wait_next(self):
+        ''' Waits for the data following the last data this thread received and returns it.
+
+        Unlike wait(), results are returned in order as long as the caller stays within the
+        buffer capacity.
+
+        Returns:
+            Tuple of (number of skipped results, data).
+
         '''
 
         self.last_access = time.time()
 
-        # wait for a signal from the camera thread
-        self.event.wait()
-        self.event.clear()
+        last_seq = self.last_seq()
+        seq, data = self.buffer.get_next(last_seq)
+        self._listener.seq = seq
 
-    def set(self):
-        ''' Notifies all listeners that new data is ready.
+        return seq - last_seq - 1 if last_seq >= 0 else 0, data
+
+    def last_seq(self):
+        ''' Returns the sequence number of the last data received by the calling thread.
         '''
 
-        self.event.set()
+        return getattr(self._listener, "seq", -1)
+
+    def set(self, data=None):
+        ''' Publishes new data to all listeners.
+
+        Args:
+            data: The newest result of the thread.
+
+        Returns:
+            The sequence number of the data.
+
+        '''
+
+        return self.buffer.put(data)
 
     def time_lapsed(self):
         return time.time() - self.last_access
@@ -131,4 +136,3 @@ class ThreadManager(object):
         '''
         
         self.thread = None
-
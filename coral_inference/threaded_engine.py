@@ -1,40 +1,224 @@
+import metrics
+import tracker
 from thread_manager import ThreadManager
+from tracing import tracer
+import threading
 import time
 
+import numpy as np
+
 # TODO: Find a better solution than putting the engine inside the threadedengine
 class ThreadedEngine(object):
 
     def __init__(self,
                  source,
-                 engine):
+                 engine,
+                 motion_gate=None,
+                 name="default"):
         self.source = source
         self.engine = engine
+        self.motion_gate = motion_gate
         self.thread_manager = ThreadManager(self)
         self.pred = None
+        self.frame = None
+
+        # Quality settings, lowered by the QualityController under load
+        self.stride = 1
+        self.max_detections = None
+        self.frames_since_detection = 0
+
+        # Engine waiting to replace the current one between two frames
+        self.pending_engine = None
+        self.retired_engine = None
+        self.swapped = threading.Event()
+        self.swap_lock = threading.Lock()
+        self.install_lock = threading.Lock()
+
+        # Labeled by model like the multiplexer's, so the series add up across pipelines
+        labels = {"model": name}
+        self.inferences = metrics.registry.counter("inferences_total",
+                                                   "Frames run through the inference engine.",
+                                                   labels=labels)
+        metrics.registry.rate("inference_fps", "Inferences per second.", self.inferences,
+                              labels=labels)
+        self.tracked = metrics.registry.counter("frames_tracked_total",
+                                                "Frames tracked without running the detector.",
+                                                labels=labels)
+        self.swaps = metrics.registry.counter("model_swaps_total",
+                                              "Times the model was swapped while running.")
 
     def __next__(self):
         return self.get_prediction()
 
     def _thread(self):
         predictions = self.inference_gen()
-        for prediction in predictions:
+        for prediction, frame, trace in predictions:
             self.pred = prediction
-            self.thread_manager.set()
+            self.frame = frame
+            self.thread_manager.set((prediction, frame, trace))
     
     def inference_gen(self):
+        last_frame_id = None
         while True:
-            self.frame = next(self.source)
-            yield self.engine.invoke(self.frame)
+            frame, trace = self.source.read()
+            last_frame_id = tracer.count_drops("engine", last_frame_id, trace)
+
+            trace.stamp("engine_queue")
+
+            if self.pending_engine is not None:
+                self._install_pending()
+
+            # Reuse the last prediction for frames where nothing changed
+            if (self.motion_gate is not None and not self.motion_gate.changed(frame) and
+                    self.pred is not None):
+                trace.stamp("motion_gate")
+                yield self.pred, frame, trace
+                continue
+
+            # Run the detector on every Nth frame only. A tracker keeps tracking in between.
+            self.frames_since_detection += 1
+            if (self.stride > 1 and self.frames_since_detection < self.stride and
+                    self.pred is not None and
+                    not isinstance(self.engine, tracker.TrackingDetector)):
+                trace.stamp("stride")
+                yield self.pred, frame, trace
+                continue
+
+            if isinstance(self.engine, tracker.TrackingDetector):
+                prediction = self.engine.invoke(frame, trace.frame_id)
+                detected = self.engine.detected
+            else:
+                prediction = self.engine.invoke(frame)
+                detected = True
+
+            if detected:
+                self.frames_since_detection = 0
+                trace.stamp("inference")
+                self.inferences.inc()
+            else:
+                trace.stamp("tracking")
+                self.tracked.inc()
+
+            yield self.limit(prediction), frame, trace
+
+    def _install_pending(self):
+        ''' Replaces the engine with the pending engine. Called by the engine thread between
+        two frames.
+        '''
+
+        with self.install_lock:
+            # A swap that timed out takes its engine back
+            if self.pending_engine is None:
+                return
+
+            self.retired_engine = self.engine
+            self.engine = self.pending_engine
+            self.pending_engine = None
+            self.set_stride(self.stride)
+
+            # The last prediction came from the old model, so the motion gate can't reuse it
+            self.pred = None
+            self.swaps.inc()
+            self.swapped.set()
+
+    def swap_engine(self, engine, warmup_frames=3, timeout=10.0):
+        ''' Warms up a new engine and switches to it between two frames.
+
+        The old engine keeps running the frames while the new one warms up, so no frames are
+        dropped and the listeners keep their connections. The warm-up runs the newest frame (or
+        a black frame before the first one) through the new engine. Blocks until the engine
+        thread switched, so run it in a background thread.
+
+        Args:
+            engine: The new inference engine. Must return as many detections as the old one.
+            warmup_frames (int): Number of inferences run before the switch.
+            timeout (float): Longest time in seconds to wait for the engine thread to switch,
+                for example while the source delivers no frames.
+
+        Returns:
+            The old engine. It is not closed, the caller owns it from now on.
+
+        Raises:
+            ValueError: The new engine returns a different number of detections, which would
+                change the SPI data length.
+            TimeoutError: The engine thread didn't switch in time. The old engine keeps
+                running and the new one is not used.
+
+        '''
+
+        if engine.get_max_length() != self.engine.get_max_length():
+            raise ValueError("The new model must keep top_k at {}.".format(
+                self.engine.get_max_length()))
+
+        # Warm up the detector itself, the tracker state starts out empty anyway
+        warmup_engine = engine.engine if isinstance(engine, tracker.TrackingDetector) else engine
+        frame = self.frame if self.frame is not None else np.zeros((480, 640, 3), np.uint8)
+        for _ in range(warmup_frames):
+            warmup_engine.invoke(frame)
+
+        with self.swap_lock:
+            self.swapped.clear()
+            self.pending_engine = engine
+
+            # Before the thread runs there is no frame to wait for
+            if self.thread_manager.thread is None or not self.thread_manager.thread.is_alive():
+                self._install_pending()
+
+            if not self.swapped.wait(timeout):
+                with self.install_lock:
+                    if not self.swapped.is_set():
+                        self.pending_engine = None
+                        raise TimeoutError("The engine thread didn't switch to the new model "
+                                           "within {} s.".format(timeout))
+
+            old_engine, self.retired_engine = self.retired_engine, None
+
+        return old_engine
+
+    def set_stride(self, stride):
+        ''' Runs the detector on every Nth frame only.
+
+        Without a tracker the frames in between reuse the last prediction. With a tracker the
+        configured detect_every of the TrackingDetector is multiplied by the stride, and the
+        tracker keeps tracking in between.
+
+        Args:
+            stride (int): Run the detector on every Nth frame. 1 runs it on every frame.
+
+        '''
+
+        engine = self.engine
+        if isinstance(engine, tracker.TrackingDetector):
+            if not hasattr(engine, "base_detect_every"):
+                engine.base_detect_every = engine.detect_every
+            engine.detect_every = engine.base_detect_every * stride
+
+        self.stride = stride
+
+    def limit(self, prediction):
+        ''' Keeps only the best max_detections of a prediction, ordered by score.
+
+        The number of SPI slots stays at get_max_length(), the dropped slots are sent empty.
+
+        '''
+
+        if self.max_detections is None or len(prediction) <= self.max_detections:
+            return prediction
+
+        if hasattr(prediction, "keep"):
+            prediction.keep(np.arange(len(prediction)) < self.max_detections)
+            return prediction
+
+        return prediction[:self.max_detections]
 
     def get_prediction(self):
-        self.thread_manager.wait()
-        return self.pred, self.frame
+        return self.thread_manager.wait()
 
     def get_max_length(self):
         return self.engine.get_max_length()
 
-    def label(self, pred):
-        return self.engine.label(pred)
+    def label(self, label_id):
+        return self.engine.label(label_id)
         
     def start(self):
         self.thread_manager.start()
@@ -0,0 +1,284 @@
+''' Per-frame latency tracing from capture to the SPI and HTTP outputs.
+
+Every frame gets a FrameTrace when it is captured. Each pipeline stage stamps the trace with a
+monotonic timestamp as the frame passes through it. Once the trace reaches the postprocessor, the
+time spent in every stage is recorded in rolling latency histograms. The outputs (SPI, HTTP) share
+the postprocessor's results, so they do not stamp the trace. They record their own latency
+since the postprocessor instead.
+
+Stages also count the frames they skipped. Frame IDs increase by one per captured frame, so a
+stage that receives frame 12 after frame 9 dropped two frames. The counts are cumulative: every
+captured frame a consumer never received is counted, including frames an earlier stage already
+skipped. The difference between two consumers is the number of frames dropped between them.
+
+time.monotonic() uses the system-wide monotonic clock on Linux, so traces can be stamped in
+different processes.
+
+Classes:
+    FrameTrace: Frame ID plus the time each stage handled the frame.
+    LatencyHistogram: Rolling window of latency samples.
+    Tracer: Collects the latency histograms and dropped frame counters of the pipeline.
+
+'''
+
+import threading
+import time
+
+import numpy as np
+
+
+class FrameTrace(object):
+    ''' Frame ID plus the time each stage handled the frame.
+
+    Attributes:
+        frame_id (int): Number of the frame, counted from the start of the source.
+        stages (list[str]): Stages that stamped the trace, in order.
+        times (list[float]): Monotonic time at which each stage stamped the trace.
+        source_id: ID of the source the frame came from when there are several sources.
+
+    '''
+
+    __slots__ = ("frame_id", "stages", "times", "source_id")
+
+    def __init__(self,
+                 frame_id,
+                 capture_time=None):
+        ''' Creates the trace with its capture stamp.
+
+        Args:
+            frame_id (int): Number of the frame.
+            capture_time (float, optional): Monotonic capture time. Defaults to now.
+
+        '''
+
+        self.frame_id = frame_id
+        self.source_id = None
+        self.stages = ["capture"]
+        self.times = [time.monotonic() if capture_time is None else capture_time]
+
+    def stamp(self, stage):
+        ''' Records that the frame passed through a stage now.
+        '''
+
+        self.stages.append(stage)
+        self.times.append(time.monotonic())
+
+    def copy(self):
+        ''' Returns an independent copy, for example to trace one frame through several models.
+        '''
+
+        trace = FrameTrace(self.frame_id, self.times[0])
+        trace.source_id = self.source_id
+        trace.stages = list(self.stages)
+        trace.times = list(self.times)
+
+        return trace
+
+    def capture_time(self):
+        return self.times[0]
+
+    def last_time(self):
+        return self.times[-1]
+
+    def stage_latencies(self):
+        ''' Returns (stage, seconds since the previous stamp) for every stage after capture.
+        '''
+
+        return [(self.stages[i], self.times[i] - self.times[i - 1])
+                for i in range(1, len(self.stages))]
+
+
+class LatencyHistogram(object):
+    ''' Rolling window of latency samples.
+
+    Samples are written into a preallocated array by a single stage thread without locking.
+    Percentiles are only computed when they are queried.
+
+    Attributes:
+        samples (array[float]): The newest latency samples in seconds.
+        count (int): Total number of samples ever recorded.
+        total (float): Sum of all samples ever recorded.
+
+    '''
+
+    def __init__(self,
+                 window=1000):
+
+        self.samples = np.zeros(window, dtype=np.float64)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, latency):
+        self.samples[self.count % len(self.samples)] = latency
+        self.count += 1
+        self.total += latency
+
+    def percentiles(self, percentiles=(50, 95, 99)):
+        ''' Returns the percentiles of the samples in the window.
+
+        Args:
+            percentiles (tuple[int]): The percentiles to compute.
+
+        Returns:
+            Dictionary like {"p50": seconds, ...}. Empty if there are no samples.
+
+        '''
+
+        window = self.samples[:min(self.count, len(self.samples))]
+        if not len(window):
+            return {}
+
+        values = np.percentile(window, percentiles)
+        return {"p{}".format(p): float(v) for p, v in zip(percentiles, values)}
+
+    def since(self, count):
+        ''' Returns the samples recorded after the histogram had count samples.
+
+        Only the samples still in the window are returned, so a caller that checks less often
+        than the window fills up gets the newest ones.
+
+        Args:
+            count (int): Value of the count attribute at the previous call.
+
+        Returns:
+            Array of the newer latency samples in seconds, oldest first.
+
+        '''
+
+        end = self.count
+        start = max(count, end - len(self.samples))
+        index = np.arange(start, end) % len(self.samples)
+
+        return self.samples[index]
+
+
+class Tracer(object):
+    ''' Collects the latency histograms and dropped frame counters of the pipeline.
+
+    Attributes:
+        window (int): Number of samples kept per histogram.
+        histograms (dict): LatencyHistogram for each stage.
+        dropped (dict): Number of frames dropped by each consumer.
+        received (dict): ID of the last frame received by each consumer.
+        captured (int): ID of the newest captured frame. -1 before the first frame.
+
+    '''
+
+    def __init__(self,
+                 window=1000):
+
+        self.window = window
+        self.histograms = {}
+        self.dropped = {}
+        self.received = {}
+        self.captured = -1
+        self.lock = threading.Lock()
+
+    def reset(self):
+        ''' Clears the histograms and dropped frame counters, for example after a warm-up.
+        '''
+
+        with self.lock:
+            self.histograms = {}
+            self.dropped = {}
+
+    def histogram(self, name):
+        ''' Returns the histogram for a stage, creating it on first use.
+        '''
+
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram(self.window))
+
+        return histogram
+
+    def record_capture(self, trace):
+        ''' Records the ID of a newly captured frame.
+        '''
+
+        self.captured = trace.frame_id
+
+    def frames_behind(self):
+        ''' Returns how many frames each consumer is behind the newest captured frame.
+
+        Returns:
+            Dictionary of consumer name to number of frames. Empty before the first capture.
+
+        '''
+
+        if self.captured < 0:
+            return {}
+
+        return {consumer: max(self.captured - frame_id, 0)
+                for consumer, frame_id in list(self.received.items())}
+
+    def record(self, name, latency):
+        self.histogram(name).record(latency)
+
+    def record_trace(self, trace):
+        ''' Records the latency of every stage the trace passed through.
+
+        Also records the total latency from capture to the last stage as "pipeline".
+
+        '''
+
+        for stage, latency in trace.stage_latencies():
+            self.record(stage, latency)
+
+        self.record("pipeline", trace.last_time() - trace.capture_time())
+
+    def record_output(self, name, trace):
+        ''' Records the latency of an output since the last pipeline stage, and since capture.
+
+        Args:
+            name (str): Name of the output, for example "spi" or "http".
+            trace: FrameTrace of the data that was sent.
+
+        '''
+
+        now = time.monotonic()
+        self.record(name, now - trace.last_time())
+        self.record(name + "_end_to_end", now - trace.capture_time())
+
+    def count_drops(self, consumer, last_frame_id, trace):
+        ''' Counts the frames a consumer skipped between two frames it received.
+
+        Args:
+            consumer (str): Name of the consumer.
+            last_frame_id (int): ID of the previous frame received, or None for the first one.
+            trace: FrameTrace of the frame just received.
+
+        Returns:
+            The frame ID of the trace, to be passed as last_frame_id next time.
+
+        '''
+
+        self.received[consumer] = trace.frame_id
+
+        if last_frame_id is not None and trace.frame_id > last_frame_id + 1:
+            with self.lock:
+                self.dropped[consumer] = (self.dropped.get(consumer, 0) +
+                                          trace.frame_id - last_frame_id - 1)
+
+        return trace.frame_id
+
+    def summary(self):
+        ''' Returns the latency percentiles of every stage and the dropped frame counters.
+
+        Returns:
+            Dictionary like {"latency": {stage: {"p50": ..., "count": ...}}, "dropped": {...}}.
+
+        '''
+
+        latency = {}
+        for name, histogram in list(self.histograms.items()):
+            stats = histogram.percentiles()
+            stats["count"] = histogram.count
+            latency[name] = stats
+
+        return {"latency": latency, "dropped": dict(self.dropped)}
+
+
+# Tracer shared by every stage in this process
+tracer = Tracer()
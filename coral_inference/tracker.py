@@ -0,0 +1,380 @@
+''' Multi-object tracking that lets the detector skip frames.
+
+The detector only runs every N frames. In between, a constant velocity Kalman filter predicts
+where every object has moved, so the postprocessor and SPI stream still get new detections at
+the camera rate. When the detector runs, its detections are matched to the tracks by IoU and
+correct them. Every track keeps its ID across detector runs.
+
+The confidence of a track decays with every frame since it was last detected. The detector is
+run early once the least confident track drops below a threshold.
+
+All tracks are filtered at once with batched NumPy operations.
+
+Classes:
+    MultiObjectTracker: IoU matched Kalman filter tracks for detection boxes.
+    TrackingDetector: Runs the detector every N frames and the tracker in between.
+
+'''
+
+import numpy as np
+
+from detections import Detections
+
+
+def box_iou(boxes_a, boxes_b):
+    ''' Computes the IoU between every pair of (x0, y0, x1, y1) boxes.
+
+    Args:
+        boxes_a (array[float]): (N, 4) boxes.
+        boxes_b (array[float]): (M, 4) boxes.
+
+    Returns:
+        (N, M) array of IoUs.
+
+    '''
+
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+
+    return np.where(union > 0, intersection / np.maximum(union, 1e-12), 0.0)
+
+
+class MultiObjectTracker(object):
+    ''' IoU matched Kalman filter tracks for detection boxes.
+
+    The state of every track is its box center, size, and their velocities in relative
+    coordinates per frame.
+
+    Attributes:
+        capacity (int): The maximum number of tracks.
+        iou_threshold (float): The minimum IoU for a detection to update a track.
+        max_misses (int): Number of detector runs in a row a track can be missed before it is
+            removed.
+        decay (float): Factor the confidence of a track is multiplied by every frame since it
+            was last detected.
+        ids (array[int]): Track IDs.
+        labels (array[float]): Label ID of each track.
+        scores (array[float]): Score of the last detection of each track.
+        age (array[int]): Frames since each track was last detected.
+        misses (array[int]): Detector runs in a row that missed each track.
+        state (array[float]): (N, 8) Kalman state of each track.
+        covariance (array[float]): (N, 8, 8) Kalman covariance of each track.
+
+    '''
+
+    def __init__(self,
+                 capacity=15,
+                 iou_threshold=0.3,
+                 max_misses=2,
+                 decay=0.9,
+                 position_noise=0.005,
+                 velocity_noise=0.002,
+                 measurement_noise=0.01):
+        ''' Creates an empty tracker.
+
+        Args:
+            capacity (int): The maximum number of tracks.
+            iou_threshold (float): The minimum IoU for a detection to update a track.
+            max_misses (int): Detector runs in a row a track can be missed before it is removed.
+            decay (float): Per frame decay of the confidence of tracks that are not detected.
+            position_noise (float): Process noise of the box center and size per frame.
+            velocity_noise (float): Process noise of the velocities per frame.
+            measurement_noise (float): Noise of the detected box coordinates.
+
+        '''
+
+        self.capacity = capacity
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.decay = decay
+
+        self.process_noise = np.diag([position_noise ** 2] * 4 + [velocity_noise ** 2] * 4)
+        self.measurement_noise = np.eye(4) * measurement_noise ** 2
+
+        # A new track knows its box but not its velocity
+        self.initial_covariance = np.diag([measurement_noise ** 2] * 4 + [0.05 ** 2] * 4)
+
+        self.next_id = 0
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.labels = np.zeros(0, dtype=np.float32)
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.age = np.zeros(0, dtype=np.int32)
+        self.misses = np.zeros(0, dtype=np.int32)
+        self.state = np.zeros((0, 8))
+        self.covariance = np.zeros((0, 8, 8))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def boxes(self):
+        ''' Returns the (x0, y0, x1, y1) box of every track.
+        '''
+
+        center = self.state[:, :2]
+        half_size = np.abs(self.state[:, 2:4]) / 2
+
+        return np.concatenate([center - half_size, center + half_size], axis=1)
+
+    def confidences(self):
+        ''' Returns the decayed confidence of every track.
+        '''
+
+        return self.scores * self.decay ** self.age
+
+    def confidence(self):
+        ''' Returns the confidence of the least confident track, or 1 if there are no tracks.
+        '''
+
+        if not len(self):
+            return 1.0
+
+        return float(self.confidences().min())
+
+    def predict(self, steps=1):
+        ''' Moves every track forward by a number of frames.
+
+        Args:
+            steps (int): Number of frames since the last call.
+
+        Returns:
+            Detections with the predicted boxes and their track IDs.
+
+        '''
+
+        self.advance(steps)
+
+        return self.detections()
+
+    def advance(self, steps):
+        ''' Runs the Kalman prediction step of every track.
+        '''
+
+        transition = np.eye(8)
+        transition[:4, 4:] = np.eye(4) * steps
+
+        self.state = self.state @ transition.T
+        self.covariance = (transition @ self.covariance @ transition.T +
+                           self.process_noise * steps)
+        self.age += steps
+
+    def update(self, detections, steps=1):
+        ''' Moves every track forward and corrects them with new detections.
+
+        Detections are matched to tracks of the same label, greedily by highest IoU. Matched
+        tracks are updated, unmatched detections start new tracks, and tracks that were missed
+        too many detector runs in a row are removed.
+
+        Args:
+            detections: Detections from the detector.
+            steps (int): Number of frames since the last call.
+
+        Returns:
+            Detections with the tracked boxes and their track IDs.
+
+        '''
+
+        self.advance(steps)
+
+        boxes = detections.boxes().astype(np.float64)
+        labels = detections.valid()["label_id"]
+        scores = detections.scores()
+
+        track_index, detection_index = self.match(boxes, labels)
+
+        # Correct the matched tracks in one batch
+        if len(track_index):
+            measurement = np.concatenate([(boxes[detection_index, :2] +
+                                           boxes[detection_index, 2:]) / 2,
+                                          boxes[detection_index, 2:] -
+                                          boxes[detection_index, :2]], axis=1)
+            covariance = self.covariance[track_index]
+            innovation = measurement - self.state[track_index, :4]
+            gain = covariance[:, :, :4] @ np.linalg.inv(covariance[:, :4, :4] +
+                                                        self.measurement_noise)
+
+            self.state[track_index] += np.einsum("nij,nj->ni", gain, innovation)
+            self.covariance[track_index] = covariance - gain @ covariance[:, :4, :]
+            self.scores[track_index] = scores[detection_index]
+            self.age[track_index] = 0
+            self.misses[track_index] = 0
+
+        missed = np.ones(len(self), dtype=bool)
+        missed[track_index] = False
+        self.misses[missed] += 1
+
+        unmatched = np.ones(len(boxes), dtype=bool)
+        unmatched[detection_index] = False
+
+        self.remove(self.misses >= self.max_misses)
+        self.add(boxes[unmatched], labels[unmatched], scores[unmatched])
+
+        return self.detections()
+
+    def match(self, boxes, labels):
+        ''' Matches detection boxes to tracks of the same label, greedily by highest IoU.
+
+        Returns:
+            Tuple of (track indices, detection indices) of the matched pairs.
+
+        '''
+
+        if not len(self) or not len(boxes):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        iou = box_iou(self.boxes(), boxes)
+        iou[self.labels[:, None] != labels[None, :]] = 0
+
+        track_index = []
+        detection_index = []
+        for flat in np.argsort(iou, axis=None)[::-1]:
+            track, detection = np.unravel_index(flat, iou.shape)
+            if iou[track, detection] < self.iou_threshold:
+                break
+            if track in track_index or detection in detection_index:
+                continue
+            track_index.append(track)
+            detection_index.append(detection)
+
+        return np.array(track_index, dtype=int), np.array(detection_index, dtype=int)
+
+    def add(self, boxes, labels, scores):
+        ''' Starts new tracks for detections, as long as there is room.
+        '''
+
+        n = min(len(boxes), self.capacity - len(self))
+        if n <= 0:
+            return
+
+        boxes = boxes[:n]
+        state = np.zeros((n, 8))
+        state[:, :2] = (boxes[:, :2] + boxes[:, 2:]) / 2
+        state[:, 2:4] = boxes[:, 2:] - boxes[:, :2]
+
+        self.ids = np.concatenate([self.ids,
+                                   np.arange(self.next_id, self.next_id + n, dtype=np.int32)])
+        self.next_id += n
+        self.labels = np.concatenate([self.labels, labels[:n]])
+        self.scores = np.concatenate([self.scores, scores[:n]])
+        self.age = np.concatenate([self.age, np.zeros(n, dtype=np.int32)])
+        self.misses = np.concatenate([self.misses, np.zeros(n, dtype=np.int32)])
+        self.state = np.concatenate([self.state, state])
+        self.covariance = np.concatenate([self.covariance,
+                                          np.repeat(self.initial_covariance[None], n, axis=0)])
+
+    def remove(self, mask):
+        ''' Removes the tracks where mask is True.
+        '''
+
+        keep = ~mask
+        self.ids = self.ids[keep]
+        self.labels = self.labels[keep]
+        self.scores = self.scores[keep]
+        self.age = self.age[keep]
+        self.misses = self.misses[keep]
+        self.state = self.state[keep]
+        self.covariance = self.covariance[keep]
+
+    def detections(self):
+        ''' Returns the tracks as Detections, most confident first.
+        '''
+
+        confidences = self.confidences()
+        order = np.argsort(confidences, kind="stable")[::-1][:self.capacity]
+
+        detections = Detections(self.capacity)
+        n = len(order)
+        records = detections.records[:n]
+        records["label_id"] = self.labels[order]
+        records["score"] = confidences[order]
+        detections.count = n
+        detections.boxes()[:] = np.clip(self.boxes()[order], 0.0, 1.0)
+        detections.track_ids[:n] = self.ids[order]
+
+        return detections
+
+
+class TrackingDetector(object):
+    ''' Runs the detector every N frames and the tracker in between.
+
+    Has the same interface as an engine, so it can be passed to a ThreadedEngine in place of
+    the engine. Pass the frame ID to invoke() so the tracker knows how many frames were skipped.
+
+    Attributes:
+        engine: The detection engine.
+        tracker: MultiObjectTracker that carries the detections between detector runs.
+        detect_every (int): Runs the detector on every Nth frame.
+        min_confidence (float): Runs the detector early once a track is less confident.
+        detected (bool): Whether the detector ran on the last frame.
+
+    '''
+
+    def __init__(self,
+                 engine,
+                 detect_every=3,
+                 min_confidence=0.3,
+                 **kwargs):
+        ''' Creates the tracker.
+
+        Args:
+            engine: The detection engine.
+            detect_every (int): Runs the detector on every Nth frame.
+            min_confidence (float): Runs the detector early once a track is less confident.
+            kwargs: Options passed to MultiObjectTracker.
+
+        '''
+
+        self.engine = engine
+        self.tracker = MultiObjectTracker(capacity=engine.get_max_length(), **kwargs)
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+
+        self.detected = False
+        self.last_frame_id = None
+        self.last_detection_id = None
+
+    def invoke(self, frame, frame_id=None):
+        ''' Detects or tracks the objects in a frame.
+
+        Args:
+            frame (array[int]): An image from 0-255.
+            frame_id (int, optional): ID of the frame. Defaults to the frame after the last one.
+
+        Returns:
+            Detections with track IDs.
+
+        '''
+
+        if frame_id is None:
+            frame_id = 0 if self.last_frame_id is None else self.last_frame_id + 1
+
+        steps = 1 if self.last_frame_id is None else max(frame_id - self.last_frame_id, 1)
+        self.last_frame_id = frame_id
+
+        self.detected = (self.last_detection_id is None or
+                         frame_id - self.last_detection_id >= self.detect_every or
+                         self.tracker.confidence() < self.min_confidence)
+
+        if self.detected:
+            self.last_detection_id = frame_id
+            return self.tracker.update(self.engine.invoke(frame), steps)
+
+        return self.tracker.predict(steps)
+
+    def close(self):
+        ''' Closes the detection engine if it has a close().
+        '''
+
+        close = getattr(self.engine, "close", None)
+        if close is not None:
+            close()
+
+    def get_max_length(self):
+        return self.engine.get_max_length()
+
+    def label(self, label_id):
+        return self.engine.label(label_id)
@@ -14,7 +14,9 @@ pass a model (using -m argument), the address of the coral (-a), and EITHER an i
 from paramiko import SSHClient
 from scp import SCPClient
 import argparse
+import hashlib
 import os
+import shlex
 from mdt.discoverer import Discoverer
 from learn_ml.utils.log_configurator import LogConfigurator
 
@@ -65,12 +67,16 @@ def deploy(address, model, identity_file=None, password=None):
         ssh.connect(hostname=address, username=DEFAULT_USERNAME, password=password)
     logger.info("Successfully connected to Anything Sensor v1!")
 
-    # Transfer model to coral
-    logger.info("Transferring model to Anything Sensor...")
-    # SCPCLient takes a paramiko transport as an argument
-    with SCPClient(ssh.get_transport()) as scp:
-        scp.put(model, "/home/mendel/learn_ml/coral_inference/classification/" + os.path.basename(model))
-    logger.info("Transfer Successful!")
+    # Transfer model to coral, unless the same model is already there
+    remote_path = "/home/mendel/learn_ml/coral_inference/classification/" + os.path.basename(model)
+    if(remote_hash(ssh, remote_path) == local_hash(model)):
+        logger.info("Model already on the Anything Sensor, skipping transfer")
+    else:
+        logger.info("Transferring model to Anything Sensor...")
+        # SCPCLient takes a paramiko transport as an argument
+        with SCPClient(ssh.get_transport()) as scp:
+            scp.put(model, remote_path)
+        logger.info("Transfer Successful!")
 
     # Start model execution
     ssh.exec_command("pkill screen")
@@ -82,6 +88,24 @@ def deploy(address, model, identity_file=None, password=None):
 
     ssh.close()
 
+def local_hash(path):
+    """ Returns the SHA-256 hex digest of a local file. """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def remote_hash(ssh, path):
+    """ Returns the SHA-256 hex digest of a file on the coral, or None if it doesn't exist. """
+
+    _, stdout, _ = ssh.exec_command("sha256sum " + shlex.quote(path))
+    output = stdout.read().decode().split()
+
+    return output[0] if output else None
+
 def deploy_usb(model):
     # Import a discoverer object from mendel development tools
     discoverer = Discoverer()
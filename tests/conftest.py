@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "coral_inference"))
+
+
+class FakeEngine(object):
+    ''' Engine stand-in that returns a fixed result and counts its calls.
+
+    Args:
+        result: Returned by invoke(). A function is called with the frame instead.
+        top_k (int): Returned by get_max_length().
+
+    '''
+
+    def __init__(self, result=None, top_k=5):
+        self.result = result
+        self.top_k = top_k
+        self.calls = 0
+        self.batches = []
+        self.closed = False
+
+    def invoke(self, frame):
+        self.calls += 1
+        return self.result(frame) if callable(self.result) else self.result
+
+    def invoke_batch(self, frames):
+        self.batches.append(len(frames))
+        return [self.invoke(frame) for frame in frames]
+
+    def get_max_length(self):
+        return self.top_k
+
+    def label(self, label_id):
+        return str(label_id)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSource(object):
+    ''' Source stand-in that returns the frames in order, or black frames, with new traces.
+
+    Args:
+        frames (list, optional): Frames to return. Defaults to black 4x4 frames forever.
+        delay (float): Seconds each read() takes.
+
+    '''
+
+    def __init__(self, frames=None, delay=0.0):
+        self.frames = frames
+        self.delay = delay
+        self.frame_id = 0
+
+    def read(self, timeout=None):
+        from tracing import FrameTrace
+
+        time.sleep(self.delay)
+        if self.frames is None:
+            frame = np.zeros((4, 4, 3), np.uint8)
+        else:
+            frame = self.frames[self.frame_id]
+        self.frame_id += 1
+
+        return frame, FrameTrace(self.frame_id - 1)
+
+
+@pytest.fixture
+def fake_engine():
+    return FakeEngine
+
+
+@pytest.fixture
+def fake_source():
+    return FakeSource
@@ -0,0 +1,22 @@
+import pytest
+
+
+class TestBenchmark:
+    def test_run_benchmark(self, tmp_path):
+        pytest.importorskip("cv2")
+        import json
+        from benchmark import run_benchmark, write_synthetic_recording, create_source
+
+        write_synthetic_recording(str(tmp_path), count=5, resolution=(64, 48))
+        results = run_benchmark(create_source(str(tmp_path), fps=100),
+                                duration=0.5,
+                                warmup=0.2,
+                                latency=0.001,
+                                output_resolution="64x48")
+
+        assert results["fps"]["inference"] > 0
+        assert results["fps"]["spi"] > 0
+        assert "inference" in results["latency"]
+        assert "ThreadedEngine" in results["cpu"]["threads"]
+        assert results["memory"]["rss_start_bytes"] > 0
+        json.dumps(results)
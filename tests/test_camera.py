@@ -0,0 +1,216 @@
+import time
+
+import pytest
+
+
+class FakeCapture(object):
+    ''' cv2.VideoCapture stand-in that snaps the requested size to the closest of its modes.
+    '''
+
+    def __init__(self, modes=((8, 6),)):
+        import cv2
+
+        self.modes = list(modes)
+        self.props = {cv2.CAP_PROP_FRAME_WIDTH: self.modes[0][0],
+                      cv2.CAP_PROP_FRAME_HEIGHT: self.modes[0][1],
+                      cv2.CAP_PROP_FPS: 30.0,
+                      cv2.CAP_PROP_FOURCC: cv2.VideoWriter_fourcc(*"YUYV")}
+        self.grabs = 0
+        self.retrieves = 0
+
+    def set(self, prop, value):
+        import cv2
+
+        self.props[prop] = value
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT):
+            width = self.props[cv2.CAP_PROP_FRAME_WIDTH]
+            mode = min(self.modes, key=lambda mode: abs(mode[0] - width))
+            self.props[cv2.CAP_PROP_FRAME_WIDTH], self.props[cv2.CAP_PROP_FRAME_HEIGHT] = mode
+        if prop == cv2.CAP_PROP_FPS:
+            self.props[prop] = min(value, 30.0)
+
+    def get(self, prop):
+        return self.props.get(prop, 0)
+
+    def grab(self):
+        time.sleep(0.001)
+        self.grabs += 1
+        return True
+
+    def retrieve(self, image=None):
+        self.retrieves += 1
+        image[:] = self.grabs % 256
+        return True, image
+
+
+def make_camera(capture, **kwargs):
+    from camera import OpenCVCamera
+
+    class Camera(OpenCVCamera):
+        def set_camera(self, source):
+            return capture
+
+    return Camera("/dev/video0", **kwargs)
+
+
+class TestOpenCVCamera:
+    def test_retrieves_only_requested_frames(self):
+        pytest.importorskip("cv2")
+
+        capture = FakeCapture()
+        camera = make_camera(capture)
+        camera.start()
+        first, trace = camera.read()
+        time.sleep(0.05)
+        second, second_trace = camera.read()
+
+        assert first.shape == (6, 8, 3)
+        assert capture.retrieves == 2 and capture.grabs > 10
+        assert second_trace.frame_id - trace.frame_id > 5, "Skipped grabs need frame IDs"
+
+        # Frames held by a listener are not decoded into
+        assert second is not first and first[0, 0, 0] == trace.frame_id % 256 + 1
+
+    def test_reuses_frames_older_than_hold(self):
+        pytest.importorskip("cv2")
+
+        camera = make_camera(FakeCapture())
+        camera.HOLD = 2
+        camera.start()
+        frames = [camera.read()[0] for _ in range(4)]
+
+        assert frames[1] is not frames[0] and frames[2] is not frames[0]
+        assert frames[3] is frames[0]
+
+    def test_direct_iteration_gets_every_frame(self):
+        pytest.importorskip("cv2")
+
+        capture = FakeCapture()
+        frames = make_camera(capture).frames()
+        for _ in range(3):
+            next(frames)
+
+        assert capture.retrieves == capture.grabs == 3
+
+    def test_polling_does_not_request(self):
+        pytest.importorskip("cv2")
+
+        capture = FakeCapture()
+        camera = make_camera(capture)
+        camera.start()
+        camera.read()
+        for _ in range(20):
+            assert camera.read(timeout=0) is None
+            time.sleep(0.002)
+
+        assert capture.retrieves == 1
+
+        camera.request()
+        time.sleep(0.05)
+        assert camera.read(timeout=0) is not None and capture.retrieves == 2
+
+
+class TestCameraNegotiation:
+    MODES = ((640, 480), (320, 240), (1280, 720))
+
+    def test_reports_granted_settings(self):
+        pytest.importorskip("cv2")
+
+        camera = make_camera(FakeCapture(self.MODES), resolution=(1280, 720), fps=60,
+                             pixel_format="mjpg")
+
+        assert camera.get_resolution() == (1280, 720)
+        assert camera.fps == 30.0 and camera.pixel_format == "MJPG"
+
+        with pytest.raises(ValueError):
+            camera.negotiate(pixel_format="H264")
+
+    def test_factory_fits_capture_to_model(self):
+        pytest.importorskip("cv2")
+        from engine import SimulatedEngine
+        from pipeline_factory import DetectionPipelineFactory
+
+        camera = make_camera(FakeCapture(self.MODES + ((400, 300),)))
+        params = {"stream_flask": False, "postprocessor": {"output_resolution": "640x480"}}
+        model = SimulatedEngine(input_size=(300, 300))
+
+        factory = DetectionPipelineFactory()
+
+        # Without "auto" the camera keeps the driver's choice
+        assert factory.fit_capture_size(camera, {}, model, params) is None
+        assert camera.get_resolution() == (640, 480)
+
+        # 400x300 is the smallest size with the camera's aspect that covers the model input
+        auto = {"resolution": "auto"}
+        assert factory.fit_capture_size(camera, auto, model, params) == (400, 300)
+        assert camera.get_resolution() == (400, 300)
+        assert factory.fit_capture_size(camera, {"resolution": "640x480"}, None, params) is None
+
+    def test_factory_keeps_resolution_above_model(self):
+        pytest.importorskip("cv2")
+        from engine import SimulatedEngine
+        from pipeline_factory import DetectionPipelineFactory
+
+        camera = make_camera(FakeCapture(self.MODES))
+        params = {"stream_flask": False, "postprocessor": {"output_resolution": "640x480"}}
+
+        # The driver snaps 400x300 to 320x240, which is smaller than the model input
+        assert DetectionPipelineFactory().fit_capture_size(
+            camera, {"resolution": "auto"}, SimulatedEngine(input_size=(300, 300)), params) is None
+        assert camera.get_resolution() == (640, 480)
+
+
+class TestReplaySources:
+    def write_images(self, path, count):
+        cv2 = pytest.importorskip("cv2")
+        import numpy as np
+
+        for i in range(count):
+            cv2.imwrite(str(path / "{:03d}.png".format(i)), np.full((24, 32, 3), i, np.uint8))
+
+    def test_image_directory_order(self, tmp_path):
+        from camera import ImageDirectorySource
+
+        self.write_images(tmp_path, 5)
+        source = ImageDirectorySource(str(tmp_path), loop=True, workers=3)
+
+        frames = source.frames()
+        values = [int(next(frames)[0, 0, 0]) for _ in range(7)]
+        frames.close()
+
+        assert source.get_resolution() == (32, 24)
+        assert values == [0, 1, 2, 3, 4, 0, 1]
+
+    def test_video_file_lockstep(self, tmp_path):
+        cv2 = pytest.importorskip("cv2")
+        import numpy as np
+        from camera import VideoFileSource
+
+        path = str(tmp_path / "video.avi")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (32, 24))
+        for i in range(6):
+            writer.write(np.full((24, 32, 3), i * 40, np.uint8))
+        writer.release()
+
+        source = VideoFileSource(path, lockstep=True)
+        source.start()
+
+        frame_ids = []
+        for _ in range(6):
+            frame, trace = source.read()
+            frame_ids.append(trace.frame_id)
+            assert abs(int(frame.mean()) - trace.frame_id * 40) < 8
+
+        assert frame_ids == list(range(6))
+        assert source.finished.wait(timeout=2)
+
+    def test_fixed_rate(self, tmp_path):
+        import time
+        from camera import ImageDirectorySource
+
+        self.write_images(tmp_path, 4)
+        source = ImageDirectorySource(str(tmp_path), fps=50)
+
+        start = time.monotonic()
+        assert len(list(source.frames())) == 4
+        assert time.monotonic() - start >= 3 / 50
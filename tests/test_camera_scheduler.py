@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+
+class TestCameraScheduler:
+    def make_scheduler(self, fake_engine, mode="fair_share", **kwargs):
+        from camera_scheduler import CameraScheduler
+        from tracing import FrameTrace
+
+        class Source(object):
+            # Always has a new frame, like a camera that is faster than the engine
+            def __init__(self, age=0.0):
+                self.age = age
+                self.frame_id = 0
+
+            def read(self, timeout=None):
+                self.frame_id += 1
+                trace = FrameTrace(self.frame_id)
+                trace.times[0] -= self.age
+                return None, trace
+
+        sources = {"front": Source(), "back": Source(age=1.0)}
+        return CameraScheduler(sources, fake_engine([], top_k=1), mode=mode, **kwargs), sources
+
+    def test_fair_share_follows_weights(self, fake_engine):
+        scheduler, _ = self.make_scheduler(fake_engine, weights={"front": 2})
+        picked = [scheduler.next_frame()[0] for _ in range(30)]
+
+        assert picked.count("front") == 20
+        assert picked.count("back") == 10
+
+    def test_idle_source_gets_no_credit(self, fake_engine):
+        scheduler, _ = self.make_scheduler(fake_engine)
+        scheduler.virtual_time["front"] = 100.0
+        scheduler.system_time = 100.0
+
+        # The back camera was idle, so it catches up instead of running 100 frames in a row
+        scheduler.pending.clear()
+        scheduler.add("back", None, scheduler.sources["back"].read()[1])
+
+        assert scheduler.virtual_time["back"] == 100.0
+
+    def test_deadline_runs_oldest_frame_first(self, fake_engine):
+        scheduler, _ = self.make_scheduler(fake_engine, "deadline",
+                                           deadlines={"front": 0.1, "back": 2.0})
+
+        # The back frame is 1 s old but has 2 s, the front frame only has 0.1 s
+        assert scheduler.next_frame()[0] == "front"
+
+    def test_results_are_tagged(self, fake_engine):
+        scheduler, _ = self.make_scheduler(fake_engine)
+        source_id, frame, trace = scheduler.next_frame()
+        scheduler.outputs[source_id].publish([], frame, trace)
+
+        _, _, published = scheduler.outputs[source_id].get_prediction()
+        assert published.source_id == source_id
+        assert published.copy().source_id == source_id
+
+    def test_invalid_mode(self, fake_engine):
+        with pytest.raises(ValueError):
+            self.make_scheduler(fake_engine, "lottery")
+
+    def test_wait_timeout(self, fake_engine):
+        from thread_manager import ThreadManager
+
+        scheduler, _ = self.make_scheduler(fake_engine)
+        assert ThreadManager(scheduler).wait(timeout=0) is None
+
+    def test_batches_waiting_frames(self, fake_engine):
+        scheduler, _ = self.make_scheduler(fake_engine, max_batch_size=4)
+        scheduler.thread_manager.start()
+
+        _, _, trace = scheduler.outputs["back"].get_prediction()
+
+        assert scheduler.engine.batches and set(scheduler.engine.batches) == {2}
+        assert trace.stages[-2:] == ["engine_queue", "inference"]
+
+    def test_batch_follows_schedule(self, fake_engine):
+        scheduler, _ = self.make_scheduler(fake_engine, max_batch_size=1)
+
+        assert [source_id for source_id, _, _ in scheduler.next_batch()] == ["front"]
+
+        scheduler.max_batch_size = 2
+        assert [source_id for source_id, _, _ in scheduler.next_batch()] == ["back", "front"]
+
+    def test_batch_waits_for_other_cameras(self, fake_engine):
+        scheduler, sources = self.make_scheduler(fake_engine, max_batch_size=2, max_wait=0.5)
+        read = sources["back"].read
+        sources["back"].read = lambda timeout=None: None
+
+        # Only the front camera has frames, so the batch waits for the back camera in vain
+        start = time.monotonic()
+        assert [source_id for source_id, _, _ in scheduler.next_batch()] == ["front"]
+        assert time.monotonic() - start >= 0.5
+
+        # The back camera delivers within max_wait, the front camera's new frame waits
+        calls = []
+
+        def delayed(timeout=None):
+            calls.append(timeout)
+            return read() if len(calls) > 3 else None
+
+        sources["back"].read = delayed
+        assert [source_id for source_id, _, _ in scheduler.next_batch()] == ["front", "back"]
+
+    def test_requests_only_cameras_without_a_frame(self, fake_engine):
+        scheduler, sources = self.make_scheduler(fake_engine)
+        requests = []
+        for source_id, source in sources.items():
+            source.request = lambda source_id=source_id: requests.append(source_id)
+
+        scheduler.poll()
+        scheduler.take("front")
+        scheduler.poll()
+
+        assert requests == ["front", "back", "front"]
+
+    def test_single_camera_rejects_batching(self):
+        from pipeline_factory import DetectionPipelineFactory
+
+        with pytest.raises(ValueError):
+            DetectionPipelineFactory().create_engine_stack(
+                {"type": "simulated", "top_k": 3, "batch": {"max_batch_size": 4}})
@@ -0,0 +1,43 @@
+import pytest
+
+
+class TestDetections:
+    def test_from_ssd(self):
+        import numpy as np
+        from detections import Detections, make_class_mask
+
+        boxes = np.array([[0.1, 0.2, 0.3, 0.4], [0.5, 0.5, 0.6, 0.6], [0.0, 0.0, 2.0, 1.0]])
+        classes = np.array([1.0, 7.0, 2.0])
+        scores = np.array([0.9, 0.8, 0.7])
+        mask = make_class_mask({1: "person", 2: "bicycle"})
+
+        detections = Detections.from_ssd(2, boxes, classes, scores, 3,
+                                         threshold=0.5, class_mask=mask)
+
+        assert len(detections) == 2
+        assert list(detections.label_ids()) == [1, 2], "Label mask not applied"
+        assert np.allclose(detections.boxes(), [[0.2, 0.1, 0.4, 0.3], [0.0, 0.0, 1.0, 1.0]])
+        assert list(detections.scaled_boxes((100, 10))[0]) == [20, 1, 40, 3]
+
+    def test_tobytes_layout(self):
+        import numpy as np
+        from detections import Detections
+
+        detections = Detections.from_ssd(3, np.array([[0.1, 0.2, 0.3, 0.4]]),
+                                         np.array([5.0]), np.array([0.5]), 1)
+        values = np.frombuffer(detections.tobytes(), dtype=np.float32)
+
+        assert len(values) == 18, "Every slot must be sent"
+        assert np.allclose(values[:6], [5, 0.5, 0.2, 0.1, 0.4, 0.3])
+        assert not values[6:].any(), "Empty slots must be 0"
+
+    def test_keep(self):
+        import numpy as np
+        from detections import Detections
+
+        detections = Detections.from_ssd(3, np.zeros((3, 4)), np.array([1.0, 2.0, 3.0]),
+                                         np.array([0.9, 0.8, 0.7]), 3)
+        detections.keep(np.array([True, False, True]))
+
+        assert list(detections.label_ids()) == [1, 3]
+        assert not detections.records[2].tolist()[0], "Removed slot not cleared"
@@ -0,0 +1,50 @@
+import pytest
+
+
+class TestTFLiteEngine:
+    def test_classification(self):
+        pytest.importorskip("tflite_runtime")
+        cv2 = pytest.importorskip("cv2")
+        import numpy as np
+        import engine
+
+        classifier = engine.TFLiteClassificationEngine("./examples/models/mnist_quant.tflite",
+                                                       top_k=3)
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+        preds = classifier.invoke(frame)
+
+        assert classifier.input_size == (28, 28)
+        assert len(preds) == 3, "Wrong number of classes returned"
+        assert preds[0].score >= preds[1].score >= preds[2].score, "Classes not sorted by score"
+        assert classifier.invoke_batch([frame, frame]) == [preds, preds]
+
+
+class TestSimulatedEngine:
+    def test_latency_and_detections(self):
+        pytest.importorskip("cv2")
+        import numpy as np
+        from engine import SimulatedEngine
+
+        engine = SimulatedEngine(latency=0.001, jitter=0.0005, distribution="lognormal",
+                                 detections=(2, 4), top_k=3, seed=0)
+        preds = engine.invoke(np.zeros((48, 64, 3), np.uint8))
+        boxes = preds.boxes()
+
+        assert 2 <= len(preds) <= 3
+        assert (boxes[:, 0] <= boxes[:, 2]).all() and (boxes[:, 1] <= boxes[:, 3]).all()
+        assert engine.label(preds.label_ids()[0]).startswith("object")
+        assert all(engine.sample_latency() >= 0 for _ in range(100))
+
+    def test_batch_takes_one_latency(self):
+        pytest.importorskip("cv2")
+        import time
+        import numpy as np
+        from engine import SimulatedEngine
+
+        engine = SimulatedEngine(latency=0.05, jitter=0.0, top_k=3, seed=0)
+        frames = [np.zeros((48, 64, 3), np.uint8)] * 4
+        start = time.monotonic()
+        preds = engine.invoke_batch(frames)
+
+        assert len(preds) == 4
+        assert time.monotonic() - start < 0.15, "The batch slept once per frame"
@@ -0,0 +1,37 @@
+import numpy as np
+
+
+class TestFramePool:
+    def test_reuses_released_frames(self):
+        from frame_pool import FramePool
+
+        pool = FramePool(max_size=2)
+        first = pool.acquire((2, 2))
+        second = pool.acquire((2, 2))
+        assert first is not second
+
+        # Frames are only reused once they are released
+        assert pool.acquire((2, 2)) is not first
+        pool.release(first)
+        assert pool.acquire((2, 3)) is not first
+        assert pool.acquire((2, 2)) is first
+        assert not pool.frames
+
+    def test_ignores_views_and_full_pool(self):
+        from frame_pool import FramePool
+
+        pool = FramePool(max_size=1)
+        frame = pool.acquire((2, 2))
+        pool.release(frame[1:])
+        pool.release(np.zeros((2, 2), np.float32))
+        assert not pool.frames
+
+        pool.release(frame)
+        pool.release(frame)
+        pool.release(np.empty((2, 2), np.uint8))
+        assert len(pool.frames) == 1 and pool.frames[0] is frame
+
+        # A buffer of a new shape replaces one of the old shape
+        resized = np.empty((4, 4), np.uint8)
+        pool.release(resized)
+        assert len(pool.frames) == 1 and pool.frames[0] is resized
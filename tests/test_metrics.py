@@ -0,0 +1,43 @@
+import pytest
+
+
+class TestMetrics:
+    def test_render(self):
+        from metrics import MetricsRegistry
+        from tracing import FrameTrace, Tracer
+
+        registry = MetricsRegistry(prefix="test_")
+        counter = registry.counter("frames_total", "Frames.", labels={"camera": "0"})
+        counter.inc(3)
+        registry.gauge("clients", "Clients.", lambda: 2)
+        registry.gauge("broken", "Fails on scrape.", lambda: 1 / 0)
+
+        tracer = Tracer()
+        trace = FrameTrace(7)
+        tracer.record_capture(FrameTrace(9))
+        tracer.count_drops("spi", 5, trace)
+        tracer.record("inference", 0.25)
+
+        text = registry.render(tracer)
+
+        assert 'test_frames_total{camera="0"} 3' in text
+        assert "# TYPE test_frames_total counter" in text
+        assert "test_clients 2" in text
+        assert "test_broken" not in text
+        assert 'test_stage_latency_seconds{quantile="0.5",stage="inference"} 0.25' in text
+        assert 'test_stage_latency_seconds_count{stage="inference"} 1' in text
+        assert 'test_frames_dropped_total{consumer="spi"} 1' in text
+        assert 'test_frames_behind{consumer="spi"} 2' in text
+        assert "test_process_resident_memory_bytes" in text
+
+    def test_rate(self):
+        from metrics import MetricsRegistry
+
+        registry = MetricsRegistry(prefix="test_")
+        counter = registry.counter("frames_total", "Frames.")
+        registry.rate("fps", "Frames per second.", counter)
+
+        assert "test_fps 0.0" in registry.render()
+        counter.inc(10)
+        rate = float(registry.render().split("\ntest_fps ")[1].split()[0])
+        assert rate > 0
@@ -0,0 +1,32 @@
+import pytest
+
+
+class TestMJPEGBroadcaster:
+    def test_clients_share_encoded_frames(self):
+        import itertools
+        from mjpeg import MJPEGBroadcaster
+        from tracing import FrameTrace
+
+        class Source:
+            def __init__(self):
+                self.frames = itertools.count()
+
+            def read_frame_bytes(self):
+                frame_id = next(self.frames)
+                return str(frame_id).encode(), FrameTrace(frame_id)
+
+        broadcaster = MJPEGBroadcaster(Source())
+        broadcaster.start()
+        first = broadcaster.stream()
+        second = broadcaster.stream()
+        chunk = next(first)
+
+        assert chunk.startswith(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n')
+        assert chunk.endswith(b'\r\n')
+        frame_id = int(chunk[len(broadcaster.header):-2])
+        assert int(next(second)[len(broadcaster.header):-2]) >= frame_id, \
+            "Second client got an older frame"
+        assert broadcaster.subscribers == 2
+
+        first.close()
+        assert broadcaster.subscribers == 1
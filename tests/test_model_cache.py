@@ -0,0 +1,61 @@
+import pytest
+
+
+class TestModelCache:
+    def make_cache(self, fake_engine, tmp_path, **kwargs):
+        from model_cache import ModelCache
+
+        loads = []
+
+        def load(params):
+            loads.append(params["model_path"])
+            return fake_engine(params)
+
+        return ModelCache(state_path=str(tmp_path / "models.json"), **kwargs), load, loads
+
+    def write_model(self, path, content):
+        path.write_bytes(content)
+        return {"model_path": str(path), "top_k": 5}
+
+    def test_reuses_models_by_content(self, fake_engine, tmp_path):
+        cache, load, loads = self.make_cache(fake_engine, tmp_path)
+        params = self.write_model(tmp_path / "a.tflite", b"model a")
+
+        engine = cache.acquire(params, load)
+        cache.release(engine)
+
+        # The same model under another path is not loaded again
+        copy = self.write_model(tmp_path / "copy.tflite", b"model a")
+        assert cache.acquire(copy, load) is engine
+        assert len(loads) == 1
+
+        # An engine in use is not handed out twice
+        assert cache.acquire(params, load) is not engine
+        assert len(loads) == 2
+
+    def test_evicts_least_recently_used(self, fake_engine, tmp_path):
+        cache, load, loads = self.make_cache(fake_engine, tmp_path, memory_budget=20)
+        engines = []
+        for name in ("a", "b", "c"):
+            params = self.write_model(tmp_path / name, name.encode() * 8)
+            engines.append(cache.acquire(params, load))
+        for engine in engines:
+            cache.release(engine)
+
+        assert engines[0].closed and not engines[1].closed and not engines[2].closed
+        assert cache.loaded_bytes() == 16
+
+    def test_prewarm_from_state(self, fake_engine, tmp_path):
+        from model_cache import ModelCache
+
+        cache, load, loads = self.make_cache(fake_engine, tmp_path)
+        for name in ("a", "b", "c"):
+            cache.release(cache.acquire(self.write_model(tmp_path / name, name.encode()), load))
+
+        restarted = ModelCache(state_path=cache.state_path)
+        assert restarted.prewarm(load, count=2) == 2
+        assert loads[-2:] == [str(tmp_path / "c"), str(tmp_path / "b")]
+
+        del loads[:]
+        restarted.acquire({"model_path": str(tmp_path / "c"), "top_k": 5}, load)
+        assert loads == []
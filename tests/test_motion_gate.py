@@ -0,0 +1,52 @@
+import pytest
+
+
+class TestMotionGate:
+    def test_skips_static_frames(self):
+        pytest.importorskip("cv2")
+        import numpy as np
+        from motion_gate import MotionGate
+
+        gate = MotionGate(refresh_interval=None)
+        frame = np.full((480, 640, 3), 100, np.uint8)
+
+        assert gate.changed(frame)
+        assert not gate.changed(frame + 5)
+
+        moved = frame.copy()
+        moved[100:300, 100:300] = 255
+        assert gate.changed(moved)
+        assert not gate.changed(moved)
+        assert (gate.passed, gate.skipped) == (2, 2)
+
+    def test_forced_refresh(self):
+        pytest.importorskip("cv2")
+        import numpy as np
+        from motion_gate import MotionGate
+
+        gate = MotionGate(refresh_interval=0.0)
+        frame = np.zeros((48, 64, 3), np.uint8)
+
+        assert gate.changed(frame)
+        assert gate.changed(frame)
+
+    def test_threaded_engine_reuses_prediction(self, fake_engine, fake_source):
+        pytest.importorskip("cv2")
+        import numpy as np
+        from motion_gate import MotionGate
+        from threaded_engine import ThreadedEngine
+
+        frames = [np.zeros((48, 64, 3), np.uint8)] * 3 + [np.full((48, 64, 3), 255, np.uint8)]
+        inference = fake_engine(lambda frame: inference.calls)
+
+        engine = ThreadedEngine(fake_source(frames), inference,
+                                motion_gate=MotionGate(refresh_interval=None))
+        predictions = engine.inference_gen()
+        results = []
+        for _ in range(4):
+            prediction, _, trace = next(predictions)
+            engine.pred = prediction
+            results.append((prediction, trace.stages[-1]))
+
+        assert results == [(1, "inference"), (1, "motion_gate"), (1, "motion_gate"),
+                           (2, "inference")]
@@ -0,0 +1,44 @@
+import pytest
+
+
+class TestMultiplexer:
+    def make_multiplexer(self, fake_engine, mode, **kwargs):
+        from multiplexer import EngineMultiplexer
+
+        engines = {"cheap": fake_engine([(1, 0.9)], top_k=2),
+                   "expensive": fake_engine([(2, 0.8)], top_k=2)}
+        return EngineMultiplexer(None, engines, mode=mode, **kwargs), engines
+
+    def test_round_robin(self, fake_engine):
+        from tracing import FrameTrace
+
+        multiplexer, engines = self.make_multiplexer(fake_engine, "round_robin")
+        ran = [multiplexer.run(None, FrameTrace(i)) for i in range(4)]
+
+        assert ran == [["cheap"], ["expensive"], ["cheap"], ["expensive"]]
+        pred, _, trace = multiplexer.outputs["expensive"].get_prediction()
+        assert pred == [(2, 0.8)]
+        assert trace.frame_id == 3 and trace.stages[-1] == "inference_expensive"
+
+    def test_rates(self, fake_engine):
+        from tracing import FrameTrace
+
+        multiplexer, engines = self.make_multiplexer(fake_engine, "rates",
+                                                     rates={"expensive": 0.001})
+        ran = [multiplexer.run(None, FrameTrace(i)) for i in range(3)]
+
+        assert ran == [["expensive", "cheap"], ["cheap"], ["cheap"]]
+
+    def test_cascade(self, fake_engine):
+        from tracing import FrameTrace
+
+        cascade = {"gate": "cheap", "model": "expensive", "labels": [1], "min_score": 0.95}
+        multiplexer, engines = self.make_multiplexer(fake_engine, "cascade", cascade=cascade)
+        assert multiplexer.run(None, FrameTrace(0)) == ["cheap"]
+
+        cascade["min_score"] = 0.5
+        assert multiplexer.run(None, FrameTrace(1)) == ["cheap", "expensive"]
+
+    def test_invalid_cascade(self, fake_engine):
+        with pytest.raises(ValueError):
+            self.make_multiplexer(fake_engine, "cascade", cascade={"gate": "cheap"})
@@ -0,0 +1,43 @@
+import pytest
+
+
+class TestDetectionPostProcessor:
+    def test_compact_format(self, fake_engine):
+        pytest.importorskip("cv2")
+        from detections import Detections
+        from postprocessor import DetectionPostProcessor
+
+        detections = Detections(5)
+        detections.records[0] = (1, 0.9, 0.1, 0.1, 0.2, 0.2)
+        detections.count = 1
+
+        compact = DetectionPostProcessor(fake_engine(), spi_format="compact")
+        legacy = DetectionPostProcessor(fake_engine())
+
+        assert len(compact.pack(detections)) == 11
+        assert len(legacy.pack(detections)) == 5 * 24
+        assert compact.get_format_message() == [1, 5, 10, 0]
+        assert legacy.get_format_message() == [0, 30, 0, 0]
+
+        with pytest.raises(ValueError):
+            DetectionPostProcessor(fake_engine(), spi_format="float16")
+
+        # 43 detections of 6 floats don't fit in the byte of the config message
+        assert DetectionPostProcessor(fake_engine(top_k=42)).get_format_message()[1] == 252
+        with pytest.raises(ValueError):
+            DetectionPostProcessor(fake_engine(top_k=43))
+        assert DetectionPostProcessor(fake_engine(top_k=43),
+                                      spi_format="compact").get_format_message()[1] == 43
+
+
+class TestClassificationPostProcessor:
+    def test_pack(self, fake_engine):
+        pytest.importorskip("cv2")
+        import numpy as np
+        from postprocessor import ClassificationPostProcessor
+
+        postprocessor = ClassificationPostProcessor(fake_engine(top_k=2))
+        data = np.frombuffer(postprocessor.pack([(3, 0.5)]), dtype=np.float32)
+
+        assert postprocessor.get_flatten_length() == 4
+        assert data.tolist() == [3.0, 0.5, 0.0, 0.0]
@@ -0,0 +1,40 @@
+import pytest
+
+
+class TestFusedPreprocessor:
+    def test_matches_resize_and_color_swap(self):
+        cv2 = pytest.importorskip("cv2")
+        import numpy as np
+        from preprocess import FusedPreprocessor
+
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+        frame[..., 0] = 255  # Blue in BGR
+        preprocessor = FusedPreprocessor((300, 300))
+        out = np.zeros((1, 300, 300, 3), dtype=np.uint8)
+
+        assert preprocessor(frame, out) is out, "Did not write into the given buffer"
+        assert (out[0, ..., 2] == 255).all() and (out[0, ..., :2] == 0).all(), "Not RGB"
+
+    def test_scaling_lookup_table(self):
+        cv2 = pytest.importorskip("cv2")
+        import numpy as np
+        from preprocess import FusedPreprocessor
+
+        frame = np.full((100, 100, 3), 255, dtype=np.uint8)
+        preprocessor = FusedPreprocessor((10, 10), dtype=np.float32,
+                                         scale=1 / 127.5, offset=-1.0)
+
+        assert np.allclose(preprocessor(frame), 1.0)
+
+    def test_letterbox(self):
+        cv2 = pytest.importorskip("cv2")
+        import numpy as np
+        from preprocess import FusedPreprocessor
+
+        frame = np.full((100, 200, 3), 255, dtype=np.uint8)
+        preprocessor = FusedPreprocessor((100, 100), letterbox=True)
+        out = preprocessor(frame)
+
+        assert (out[:20] == 0).all() and (out[30:70] == 255).all(), "Frame not letterboxed"
+        assert np.allclose(preprocessor.unletterbox(np.array([0.0, 0.25, 1.0, 0.75])),
+                           [0.0, 0.0, 1.0, 1.0])
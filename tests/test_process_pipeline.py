@@ -0,0 +1,201 @@
+import queue
+import threading
+
+import numpy as np
+import pytest
+
+
+def run_worker(target, *args):
+    ''' Runs a worker in a thread of this process and returns its stop event and thread.
+    '''
+
+    stop = threading.Event()
+    thread = threading.Thread(target=target, args=args + (stop,), daemon=True)
+    thread.start()
+
+    return stop, thread
+
+
+class TestSharedFramePool:
+    def test_attach_by_name(self):
+        from process_pipeline import SharedFramePool
+
+        pool = SharedFramePool(2, 48)
+        attached = SharedFramePool(2, 48, name=pool.name)
+        try:
+            pool.view(1, (4, 4, 3))[:] = 7
+
+            assert (attached.view(1, (4, 4, 3)) == 7).all()
+            assert not attached.view(0, (4, 4, 3)).any()
+            assert pool.fits((4, 4, 3)) and not pool.fits((4, 4, 4))
+            with pytest.raises(ValueError):
+                pool.view(0, (4, 4, 4))
+        finally:
+            attached.close()
+            pool.close()
+
+    def test_jpeg_slot_fits_small_frames(self):
+        cv2 = pytest.importorskip("cv2")
+        from process_pipeline import jpeg_slot_size
+
+        # Noise at a high quality encodes to more than the raw frame
+        frame = np.random.default_rng(0).integers(0, 256, (16, 16, 3), dtype=np.uint8)
+        jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 95])[1]
+
+        assert len(jpeg) > frame.nbytes
+        assert len(jpeg) <= jpeg_slot_size((16, 16))
+
+
+class TestWorkers:
+    def test_source_scales_large_frames(self):
+        pytest.importorskip("cv2")
+        from process_pipeline import SharedFramePool, _source_worker
+        from tracing import FrameTrace
+
+        class Source(object):
+            def __init__(self):
+                self.reads = 0
+
+            def start(self):
+                pass
+
+            def read(self, timeout=None):
+                self.reads += 1
+                return np.full((48, 64, 3), 9, np.uint8), FrameTrace(5)
+
+        source = Source()
+
+        class Factory(object):
+            def create_source(self, params):
+                return source
+
+        pool = SharedFramePool(1, 16 * 12 * 3)
+        free_frames, frames = queue.Queue(), queue.Queue()
+        free_frames.put(0)
+        stop, thread = run_worker(_source_worker, Factory(), {},
+                                  (pool.slots, pool.slot_size, pool.name), free_frames, frames)
+        try:
+            slot, shape, trace = frames.get(timeout=5)
+            assert shape == (12, 16, 3) and trace.frame_id == 5
+            assert (pool.view(slot, shape) == 9).all()
+
+            # The only slot is still in use downstream, so no other frame is read
+            with pytest.raises(queue.Empty):
+                frames.get(timeout=0.3)
+            assert source.reads == 1
+        finally:
+            stop.set()
+            thread.join()
+            pool.close()
+
+    def test_engine_and_postprocessor(self):
+        pytest.importorskip("cv2")
+        from pipeline_factory import DetectionPipelineFactory
+        from process_pipeline import (SharedFramePool, _engine_worker, _postprocessor_worker,
+                                      jpeg_slot_size)
+        from tracing import FrameTrace
+
+        factory = DetectionPipelineFactory()
+        frames = SharedFramePool(1, 16 * 16 * 3)
+        outputs = SharedFramePool(1, jpeg_slot_size((16, 16)))
+        frame_pool = (frames.slots, frames.slot_size, frames.name)
+        output_pool = (outputs.slots, outputs.slot_size, outputs.name)
+        frames_in, preds, results = queue.Queue(), queue.Queue(), queue.Queue()
+        free_frames, free_outputs = queue.Queue(), queue.Queue()
+        free_outputs.put(0)
+
+        frames.view(0, (16, 16, 3))[:] = np.random.default_rng(0).integers(
+            0, 256, (16, 16, 3), dtype=np.uint8)
+        frames_in.put((0, (16, 16, 3), FrameTrace(0)))
+
+        engine_stop, engine_thread = run_worker(
+            _engine_worker, factory, {"type": "simulated", "latency": 0, "top_k": 3},
+            frame_pool, frames_in, preds)
+        postprocessor_stop, postprocessor_thread = run_worker(
+            _postprocessor_worker, factory,
+            {"output_resolution": "16x16", "jpeg_quality": 95}, True, frame_pool,
+            output_pool, free_frames, free_outputs, preds, results)
+        try:
+            pred, data, output, trace = results.get(timeout=5)
+
+            assert len(data) == 3 * 24
+            assert trace.stages[-1] == "postprocess"
+            assert free_frames.get_nowait() == 0, "The frame slot was not handed back"
+            slot, length = output
+            assert outputs.view(slot, (length,)).tobytes().startswith(b"\xff\xd8")
+        finally:
+            engine_stop.set()
+            postprocessor_stop.set()
+            engine_thread.join()
+            postprocessor_thread.join()
+            frames.close()
+            outputs.close()
+
+    def test_postprocessor_drops_oversize_jpeg(self):
+        pytest.importorskip("cv2")
+        from detections import Detections
+        from pipeline_factory import DetectionPipelineFactory
+        from process_pipeline import SharedFramePool, _postprocessor_worker
+        from tracing import FrameTrace
+
+        frames = SharedFramePool(1, 16 * 16 * 3)
+        outputs = SharedFramePool(1, 16)
+        frames_in, results, free_frames, free_outputs = (queue.Queue(), queue.Queue(),
+                                                         queue.Queue(), queue.Queue())
+        free_outputs.put(0)
+        frames_in.put((3, {}))
+        frames_in.put((0, (16, 16, 3), Detections(3), FrameTrace(0)))
+
+        stop, thread = run_worker(
+            _postprocessor_worker, DetectionPipelineFactory(), {"output_resolution": "16x16"},
+            True, (frames.slots, frames.slot_size, frames.name),
+            (outputs.slots, outputs.slot_size, outputs.name), free_frames, free_outputs,
+            frames_in, results)
+        try:
+            _, _, output, _ = results.get(timeout=5)
+
+            assert output is None and thread.is_alive()
+            assert free_outputs.get_nowait() == 0
+        finally:
+            stop.set()
+            thread.join()
+            frames.close()
+            outputs.close()
+
+
+class TestProcessPipeline:
+    def test_runs_in_processes(self, tmp_path):
+        cv2 = pytest.importorskip("cv2")
+        from pipeline_factory import DetectionPipelineFactory
+
+        for i in range(3):
+            cv2.imwrite(str(tmp_path / "{}.png".format(i)), np.full((24, 32, 3), i, np.uint8))
+
+        params = {"mode": "multiprocess",
+                  "source": {"type": "images", "source": str(tmp_path), "loop": True,
+                             "fps": 50},
+                  "engine": {"type": "simulated", "latency": 0.001, "top_k": 3},
+                  "postprocessor": {"output_resolution": "32x24"},
+                  "multiprocess": {"frame_slots": 2, "max_resolution": "32x24"},
+                  "stream_spi": False,
+                  "stream_flask": True}
+
+        pipeline = DetectionPipelineFactory().create_pipeline(params)
+        pipeline.start()
+        try:
+            assert len(pipeline.get_prediction()) <= 3
+            assert pipeline.get_output_frame_bytes().startswith(b"\xff\xd8")
+            assert pipeline.postprocessor.read_bytes(timeout=5) is not None
+            assert "pipeline" in pipeline.get_stats()["latency"]
+            assert all(process.is_alive() for process in pipeline.processes)
+        finally:
+            pipeline.stop()
+
+        assert not any(process.is_alive() for process in pipeline.processes)
+
+    def test_rejects_several_models_or_sources(self):
+        from pipeline_factory import DetectionPipelineFactory
+
+        for key in ("models", "sources"):
+            with pytest.raises(ValueError):
+                DetectionPipelineFactory().create_pipeline({"mode": "multiprocess", key: {}})
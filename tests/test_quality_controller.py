@@ -0,0 +1,72 @@
+import pytest
+
+
+class TestQualityController:
+    def make_controller(self, **kwargs):
+        from quality_controller import Knob, QualityController
+
+        applied = []
+        knobs = [Knob("jpeg_quality", [95, 80, 65], lambda value: applied.append(value)),
+                 Knob("stride", [1, 2], lambda value: applied.append(value))]
+
+        return QualityController(knobs, target_latency=0.1, **kwargs), knobs, applied
+
+    def test_lowers_in_order_with_hysteresis(self):
+        controller, knobs, applied = self.make_controller(degrade_after=2, upgrade_after=3)
+
+        # A single slow interval is not enough
+        assert controller.update(0.2) == 0
+        assert controller.update(0.2) == -1
+        assert [knob.value for knob in knobs] == [80, 1]
+
+        for _ in range(4):
+            controller.update(0.2)
+        assert [knob.value for knob in knobs] == [65, 2]
+        assert controller.level() == 3
+
+        # Latency inside the hysteresis band changes nothing
+        assert all(controller.update(0.09) == 0 for _ in range(10))
+
+        # The knob lowered last is raised first
+        assert [controller.update(0.05) for _ in range(3)] == [0, 0, 1]
+        assert [knob.value for knob in knobs] == [65, 1]
+        assert applied == [80, 65, 2, 1]
+
+    def test_reverted_raise_waits_longer(self):
+        controller, knobs, _ = self.make_controller(degrade_after=1, upgrade_after=2)
+
+        controller.update(0.2)
+        controller.update(0.05)
+        assert controller.update(0.05) == 1
+
+        # Raising brought the overload back
+        assert controller.update(0.2) == -1
+        assert controller.upgrade_wait == 4
+        assert [controller.update(0.05) for _ in range(4)] == [0, 0, 0, 1]
+
+    def test_frame_rate_target(self):
+        controller, knobs, _ = self.make_controller(degrade_after=1, target_fps=20)
+
+        assert controller.update(0.05, fps=12, capture_fps=30) == -1
+
+        # The camera only delivers 12 frames per second, lowering the quality won't help
+        assert controller.update(0.05, fps=12, capture_fps=12) == 0
+
+    def test_measures_new_samples(self):
+        from tracing import Tracer
+
+        tracer = Tracer(window=10)
+        controller, _, _ = self.make_controller(tracer=tracer)
+        for latency in (0.5, 0.5):
+            tracer.record("pipeline", latency)
+        controller.measure()
+
+        for latency in range(20):
+            tracer.record("pipeline", 0.01)
+        tracer.record("http_end_to_end", 0.3)
+        tracer.captured = 30
+        latency, fps, capture_fps = controller.measure()
+
+        assert latency == pytest.approx(0.3)
+        assert fps > 0 and capture_fps > 0
+        assert len(tracer.histogram("pipeline").since(0)) == 10
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+
+class TestRingBuffer:
+    def test_get_latest_skips_old_items(self):
+        from ring_buffer import RingBuffer
+
+        buffer = RingBuffer(capacity=3)
+        for i in range(5):
+            buffer.put(i)
+
+        assert buffer.get_latest(-1) == (4, 4), "Newest item not returned"
+        assert buffer.get_latest(4, timeout=0.01) == (None, None), "Returned an old item"
+
+    def test_get_next_in_order(self):
+        from ring_buffer import RingBuffer
+
+        buffer = RingBuffer(capacity=3)
+        for i in range(3):
+            buffer.put(i * 10)
+
+        assert buffer.get_next(-1) == (0, 0)
+        assert buffer.get_next(0) == (1, 10)
+        assert buffer.get_next(1) == (2, 20)
+
+    def test_get_next_falls_behind(self):
+        from ring_buffer import RingBuffer
+
+        buffer = RingBuffer(capacity=2)
+        for i in range(6):
+            buffer.put(i)
+
+        seq, item = buffer.get_next(0)
+        assert seq == 4 and item == 4, "Stale reader should skip to the oldest available item"
+
+    def test_wakes_waiting_reader(self):
+        from ring_buffer import RingBuffer
+
+        buffer = RingBuffer()
+        result = []
+        reader = threading.Thread(target=lambda: result.append(buffer.get_latest(-1, timeout=5)))
+        reader.start()
+        buffer.put("frame")
+        reader.join()
+
+        assert result == [(0, "frame")]
+
+    def test_invalid_capacity(self):
+        from ring_buffer import RingBuffer
+
+        with pytest.raises(ValueError):
+            RingBuffer(capacity=0)
+
+    def test_triple_buffer_keeps_read_payload(self):
+        from ring_buffer import TripleBuffer
+
+        buffer = TripleBuffer()
+        buffer.write(b"first", "trace")
+        seq, payload, item = buffer.read()
+        assert (seq, bytes(payload), item) == (0, b"first", "trace")
+
+        # The producer never writes into the payload being read
+        for i in range(5):
+            buffer.write(b"next %d" % i)
+        assert bytes(payload) == b"first"
+
+        seq, payload, _ = buffer.read(seq)
+        assert (seq, bytes(payload)) == (5, b"next 4")
+        assert buffer.read(seq, timeout=0.01) == (None, None, None)
+
+    def test_triple_buffer_consistent_under_load(self):
+        from ring_buffer import TripleBuffer
+
+        buffer = TripleBuffer()
+        done = threading.Event()
+
+        def produce():
+            for i in range(20000):
+                buffer.write(bytes([i % 256]) * 64)
+            done.set()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        seq = -1
+        while not done.is_set():
+            new_seq, payload, _ = buffer.read(seq, timeout=0.1)
+            if new_seq is not None:
+                assert new_seq > seq and len(set(payload)) == 1, "Torn payload"
+                seq = new_seq
+        producer.join()
@@ -0,0 +1,109 @@
+import pytest
+
+
+class TestSPICodec:
+    def test_round_trip(self):
+        import numpy as np
+        from detections import DETECTION_DTYPE
+        from spi_codec import CompactCodec
+
+        records = np.zeros(2, dtype=DETECTION_DTYPE)
+        records[0] = (17, 0.5, 0.1, 0.2, 0.3, 0.4)
+        records[1] = (3, 1.0, 0.0, 0.5, 1.0, 1.0)
+
+        codec = CompactCodec()
+        data = codec.encode(records)
+        decoded = codec.decode(data)
+
+        assert len(data) == 1 + 2 * 10
+        assert decoded["label_id"].tolist() == [17, 3]
+        for name in ("score", "x0", "y0", "x1", "y1"):
+            assert np.allclose(decoded[name], records[name], atol=1 / 255)
+
+    def test_empty_message_is_one_byte(self):
+        import numpy as np
+        from detections import DETECTION_DTYPE
+        from spi_codec import CompactCodec
+
+        codec = CompactCodec()
+        data = codec.encode(np.zeros(0, dtype=DETECTION_DTYPE))
+
+        assert data == b"\x00"
+        assert len(codec.decode(data)) == 0
+
+    def test_truncated_message(self):
+        from spi_codec import CompactCodec
+
+        with pytest.raises(ValueError):
+            CompactCodec().decode(b"\x02" + bytes(10))
+
+    def make_delta(self):
+        import numpy as np
+        from detections import DETECTION_DTYPE
+        from spi_codec import (COMPACT_DETECTION_DTYPE, DELTA, DeltaDecoder, DeltaEncoder,
+                               create_codec)
+
+        codec = create_codec(DELTA, COMPACT_DETECTION_DTYPE)
+        records = np.zeros(3, dtype=DETECTION_DTYPE)
+        records["label_id"] = [1, 2, 3]
+        records["score"] = 0.8
+        records["x1"] = records["y1"] = 0.5
+
+        return codec, DeltaEncoder(codec, tolerance=0.01), DeltaDecoder(codec), records
+
+    def test_delta_sends_only_changes(self):
+        codec, encoder, decoder, records = self.make_delta()
+        ids = [0, 1, 2]
+
+        keyframe = encoder.encode(codec.encode(records, ids))
+        assert keyframe[0] == 0 and len(decoder.decode(keyframe)) == 3
+
+        # Moves below the tolerance are not sent
+        records["x0"][1] = 0.005
+        assert encoder.encode(codec.encode(records, ids)) is None
+
+        records["x0"][1] = 0.2
+        delta = encoder.encode(codec.encode(records, ids))
+        assert delta[0] == 1 and len(delta) == 4 + 11
+
+        state = decoder.decode(delta)
+        assert sorted(state["id"].tolist()) == [0, 1, 2]
+        assert state[state["id"] == 1]["x0"][0] == round(0.2 * 65535)
+
+        removed = encoder.encode(codec.encode(records[:2], ids[:2]))
+        assert sorted(decoder.decode(removed)["id"].tolist()) == [0, 1]
+
+    def test_delta_gap_needs_keyframe(self):
+        codec, encoder, decoder, records = self.make_delta()
+        ids = [0, 1, 2]
+
+        decoder.decode(encoder.encode(codec.encode(records, ids)))
+        records["x0"][0] = 0.1
+        encoder.encode(codec.encode(records, ids))  # Lost on the way
+        records["x0"][0] = 0.2
+        assert decoder.decode(encoder.encode(codec.encode(records, ids))) is None
+        assert decoder.needs_keyframe and decoder.gaps == 1
+
+        encoder.request_keyframe()
+        state = decoder.decode(encoder.encode(codec.encode(records, ids)))
+        assert state is not None and not decoder.needs_keyframe
+
+    def test_colliding_ids_send_keyframe(self):
+        codec, encoder, decoder, records = self.make_delta()
+
+        decoder.decode(encoder.encode(codec.encode(records, [0, 1, 2])))
+
+        # Tracks 1 and 257 share their lowest byte
+        message = encoder.encode(codec.encode(records, [0, 1, 257]))
+        assert message[0] == 0 and len(decoder.decode(message)) == 3
+
+    def test_id_pool(self):
+        from spi_codec import IdPool
+
+        pool = IdPool(size=4)
+
+        assert pool.assign([1, 257]).tolist() == [0, 1]
+        assert pool.assign([257, 600]).tolist() == [1, 2]
+
+        # The freed byte of track 1 is handed out last
+        assert pool.assign([257, 600, 7, 8]).tolist() == [1, 2, 3, 0]
@@ -0,0 +1,80 @@
+import pytest
+
+
+class TestSPIEmulator:
+    def test_handshake_and_heartbeat(self):
+        from spi_emulator import LoopbackBus
+
+        bus = LoopbackBus(clock_speed=10 ** 9, init_delay=0)
+
+        assert bus.transfer(b"\xff\xff\xff\xff") == b"\x00\xff\xfe\xfd"
+        assert bus.read_signal()
+
+        bus.transfer(b"\x30")
+        responses = bus.transfer(b"\x00\x00\x00\x00")
+        assert responses[3] > responses[2]
+
+        bus.transfer(b"\x30")
+        bus.transfer([1, 5, 10, 0])
+        assert bus.data_format == 1 and bus.read_signal()
+
+        # Heartbeats keep counting up until the microcontroller is reset
+        assert bus.transfer(b"\x10")[0] < bus.transfer(b"\x10")[0]
+        bus.reset()
+        assert bus.transfer(b"\x10")[0] == bus.transfer(b"\x10")[0] == 0
+        assert not bus.read_signal() and not bus.wait_signal(0.01)
+
+    def test_start_bytes_only_answered_in_start_state(self):
+        from spi_emulator import LoopbackBus
+
+        bus = LoopbackBus(clock_speed=10 ** 9, init_delay=0)
+        assert bus.transfer(b"\x10\xff\xff\xff\xff")[-3:] == b"\xff\xfe\xfd"
+
+        # Connected, so more start bytes are unknown headers that only move the heartbeat
+        replies = bus.transfer(b"\xff\xff\xff\xff")
+        assert replies != b"\x00\xff\xfe\xfd" and bus.phase == "acknowledge"
+
+        # A bad acknowledgement sends the sketch back to the start bytes
+        bus.transfer(b"\x30\x01\x00\x00\x00")
+        assert bus.phase == "handshake" and not bus.read_signal()
+        assert bus.transfer(b"\xff\xff\xff\xff")[1:] == b"\xff\xfe\xfd"
+
+    def test_wait_signal_wakes_on_data_request(self):
+        import time
+        from spi_emulator import LoopbackBus
+
+        bus = LoopbackBus(clock_speed=10 ** 9, init_delay=0.05)
+        bus.transfer(b"\xff\xff\xff\xff\x30\x00\x00\x00\x00")
+        assert not bus.read_signal()
+
+        start = time.monotonic()
+        assert bus.wait_signal(1.0)
+        assert time.monotonic() - start < 0.5
+
+    def test_comms_deliver_messages(self):
+        pytest.importorskip("cv2")
+        import time
+        from postprocessor import DetectionPostProcessor
+        from spi_emulator import LoopbackBus, SyntheticDetections, _SyntheticEngine
+        from stream_spi import SPIComms
+
+        postprocessor = DetectionPostProcessor(_SyntheticEngine(5), spi_format="compact")
+        bus = LoopbackBus(clock_speed=10 ** 6, init_delay=0)
+        producer = SyntheticDetections(postprocessor, fps=200, count=2)
+        comms = SPIComms(postprocessor, bus=bus)
+
+        producer.start()
+        comms.start()
+        start = time.monotonic()
+        while bus.messages < 3 and time.monotonic() - start < 10:
+            time.sleep(0.01)
+        comms.stopped.set()
+        producer.stop()
+        comms.stop()
+
+        assert bus.messages >= 3
+        assert len(bus.records) == 2
+
+        # Every listener only gets new data once
+        assert postprocessor.read_bytes(timeout=0) is not None
+        assert postprocessor.read_bytes(timeout=0) is None
@@ -0,0 +1,19 @@
+import pytest
+
+
+class TestThreadManager:
+    def test_no_duplicate_data(self):
+        from thread_manager import ThreadManager
+
+        class Producer:
+            def _thread(self):
+                pass
+
+        manager = ThreadManager(Producer())
+        manager.set("a")
+        manager.set("b")
+
+        assert manager.wait() == "b"
+        assert manager.last_seq() == 1
+        manager.set("c")
+        assert manager.wait() == "c"
@@ -0,0 +1,116 @@
+import pytest
+
+
+class TestThreadedEngine:
+    def test_stride_and_limit(self, fake_engine, fake_source):
+        import numpy as np
+        from detections import Detections
+        from threaded_engine import ThreadedEngine
+
+        def detect(frame):
+            detections = Detections(4)
+            detections.records["score"] = [0.9, 0.8, 0.7, 0.6]
+            detections.count = 4
+            return detections
+
+        inference = fake_engine(detect, top_k=4)
+        engine = ThreadedEngine(fake_source(), inference)
+        engine.set_stride(3)
+        engine.max_detections = 2
+        predictions = engine.inference_gen()
+        results = []
+        for _ in range(6):
+            engine.pred = next(predictions)[0]
+            results.append(engine.pred)
+
+        assert inference.calls == 2
+        assert len(results[0]) == 2 and list(results[0].scores()) == pytest.approx([0.9, 0.8])
+        assert results[1] is results[0]
+
+    def test_metrics_labeled_by_model(self, fake_engine, fake_source):
+        import metrics
+        from threaded_engine import ThreadedEngine
+
+        ThreadedEngine(fake_source(), fake_engine(), name="detector")
+        text = metrics.registry.render()
+
+        assert 'inferences_total{model="detector"}' in text
+        assert 'inference_fps{model="detector"}' in text
+
+
+class TestModelSwap:
+    def test_swap_between_frames(self, fake_engine, fake_source):
+        from threaded_engine import ThreadedEngine
+
+        old, new = fake_engine("old"), fake_engine("new")
+        engine = ThreadedEngine(fake_source(delay=0.002), old)
+        engine.start()
+        assert engine.get_prediction()[0] == "old"
+
+        assert engine.swap_engine(new, warmup_frames=3) is old
+        # The caller owns the old engine, it may be reused later
+        assert not old.closed and new.calls >= 3
+        assert engine.get_prediction()[0] == "new"
+
+        with pytest.raises(ValueError):
+            engine.swap_engine(fake_engine("other", top_k=10))
+
+    def test_swap_timeout(self, fake_engine):
+        import threading
+        from threaded_engine import ThreadedEngine
+
+        class StalledSource(object):
+            def read(self, timeout=None):
+                threading.Event().wait()
+
+        old, new = fake_engine("old"), fake_engine("new")
+        engine = ThreadedEngine(StalledSource(), old)
+        engine.start()
+
+        with pytest.raises(TimeoutError):
+            engine.swap_engine(new, warmup_frames=0, timeout=0.05)
+
+        assert engine.engine is old and engine.pending_engine is None and not old.closed
+
+    def test_factory_keeps_params_until_swapped(self, fake_source):
+        pytest.importorskip("cv2")
+        from engine import SimulatedEngine
+        from pipeline_factory import DetectionPipelineFactory
+        from threaded_engine import ThreadedEngine
+
+        factory = DetectionPipelineFactory()
+        factory.engine = ThreadedEngine(fake_source(), SimulatedEngine(latency=0, top_k=3))
+        factory.pipeline = object()
+        factory.params = {"engine": {"type": "simulated", "latency": 0, "top_k": 3}}
+
+        with pytest.raises(ValueError):
+            factory.update_pipeline({"engine": {"type": "unknown"}})
+        assert factory.params["engine"]["type"] == "simulated"
+
+        new_params = {"engine": {"type": "simulated", "latency": 0.001}}
+        assert factory.update_pipeline(new_params) == (factory.pipeline, True)
+        assert factory.params["engine"] == new_params["engine"]
+        assert factory.engine.engine.latency == 0.001
+        assert factory.update_pipeline(new_params) == (factory.pipeline, False)
+
+    def test_factory_refuses_what_needs_a_restart(self, fake_engine, fake_source):
+        pytest.importorskip("cv2")
+        from pipeline_factory import DetectionPipelineFactory, RestartRequiredError
+        from threaded_engine import ThreadedEngine
+
+        factory = DetectionPipelineFactory()
+        factory.engine = ThreadedEngine(fake_source(), fake_engine())
+        factory.pipeline = object()
+        factory.params = {"engine": {"type": "simulated"}, "stream_flask": False}
+
+        with pytest.raises(RestartRequiredError) as error:
+            factory.update_pipeline({"engine": {"type": "simulated", "latency": 0.001},
+                                     "stream_flask": True})
+        assert error.value.keys == ["engine", "stream_flask"]
+        assert factory.params["stream_flask"] is False
+
+        # A multiplexed pipeline can't swap its models
+        factory.engine = object()
+        factory.params = {"models": [{"type": "simulated"}]}
+        with pytest.raises(RestartRequiredError):
+            factory.update_pipeline({"models": [{"type": "simulated", "latency": 0.001}]})
@@ -0,0 +1,36 @@
+import pytest
+
+
+class TestTracing:
+    def test_trace_stages(self):
+        from tracing import FrameTrace, Tracer
+
+        trace = FrameTrace(0, capture_time=0.0)
+        trace.stamp("inference")
+        trace.times[-1] = 0.5
+        tracer = Tracer()
+        tracer.record_trace(trace)
+
+        assert trace.stage_latencies() == [("inference", 0.5)]
+        assert tracer.summary()["latency"]["inference"]["p50"] == 0.5
+        assert tracer.summary()["latency"]["pipeline"]["count"] == 1
+
+    def test_count_drops(self):
+        from tracing import FrameTrace, Tracer
+
+        tracer = Tracer()
+        last_frame_id = tracer.count_drops("spi", None, FrameTrace(4))
+        last_frame_id = tracer.count_drops("spi", last_frame_id, FrameTrace(5))
+        tracer.count_drops("spi", last_frame_id, FrameTrace(9))
+
+        assert tracer.summary()["dropped"] == {"spi": 3}
+
+    def test_histogram_window(self):
+        from tracing import LatencyHistogram
+
+        histogram = LatencyHistogram(window=10)
+        for i in range(100):
+            histogram.record(i)
+
+        assert histogram.count == 100
+        assert histogram.percentiles((0, 100)) == {"p0": 90.0, "p100": 99.0}
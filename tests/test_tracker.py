@@ -0,0 +1,60 @@
+import pytest
+
+
+class TestTracker:
+    def make_detections(self, boxes, label_id=1.0):
+        import numpy as np
+        from detections import Detections
+
+        boxes = np.array(boxes, dtype=np.float32)
+        n = len(boxes)
+        return Detections.from_ssd(5, boxes[:, [1, 0, 3, 2]], np.full(n, label_id),
+                                   np.full(n, 0.9, dtype=np.float32), n)
+
+    def test_track_moving_box(self):
+        import numpy as np
+        from tracker import MultiObjectTracker
+
+        tracker = MultiObjectTracker(capacity=5)
+        for i in range(6):
+            x = 0.1 + 0.02 * i
+            preds = tracker.update(self.make_detections([[x, 0.2, x + 0.2, 0.4]]))
+            assert preds.track_ids[:1].tolist() == [0]
+
+        # The velocity carries the box forward without detections
+        preds = tracker.predict(steps=2)
+        assert abs(preds.boxes()[0, 0] - 0.24) < 0.01
+        assert preds.scores()[0] < 0.9
+
+    def test_new_and_missed_tracks(self):
+        from tracker import MultiObjectTracker
+
+        tracker = MultiObjectTracker(capacity=5, max_misses=1)
+        tracker.update(self.make_detections([[0.1, 0.1, 0.3, 0.3]]))
+        preds = tracker.update(self.make_detections([[0.6, 0.6, 0.8, 0.8]]))
+
+        assert len(tracker) == 1
+        assert preds.track_ids[:preds.count].tolist() == [1]
+        assert preds.track_ids[preds.count:].tolist() == [-1] * 4
+
+    def test_detect_every(self, fake_engine):
+        import numpy as np
+        from tracker import TrackingDetector
+
+        engine = fake_engine(lambda frame: self.make_detections([[0.1, 0.1, 0.3, 0.3]]))
+        detector = TrackingDetector(engine, detect_every=3, min_confidence=0.0)
+        frame = np.zeros((4, 4, 3), np.uint8)
+        detected = []
+        for frame_id in range(7):
+            preds = detector.invoke(frame, frame_id)
+            detected.append(detector.detected)
+            assert preds.track_ids[0] == 0
+
+        assert detected == [True, False, False, True, False, False, True]
+        assert engine.calls == 3
+
+        # A low confidence forces the detector to run early
+        detector.min_confidence = 0.89
+        detector.invoke(frame, 7)
+        detector.invoke(frame, 8)
+        assert detector.detected